@@ -0,0 +1,74 @@
+import argparse
+import json
+import sys
+
+"""
+Compare two benchmark results of run.py, stage by stage, for the sources and sizes they both ran:
+```
+python benchmarks/compare.py benchmarks/results/baseline.json benchmarks/results/new.json --threshold 0.1
+```
+A stage slower by more than the threshold is a regression, and the script exits with 1.
+Stages shorter than --min_seconds in the baseline are reported but never flagged, their timings are mostly noise.
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark results and flag the regressions")
+    parser.add_argument("baseline", help="Results file of the reference run")
+    parser.add_argument("current", help="Results file of the run to check")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown of a stage counted as a regression (default: 0.1, 10%%)"
+    )
+
+    parser.add_argument(
+        "--min_seconds",
+        type=float,
+        default=0.05,
+        help="Stages shorter than this in the baseline are never flagged (default: 0.05)"
+    )
+    return parser.parse_args(argv)
+
+
+def load_runs(path):
+    with open(path, "r", encoding="utf-8") as f:
+        results = json.load(f)
+    return {(run["source"], run["rows"]): run for run in results["runs"]}
+
+
+def compare(baseline, current, threshold=0.1, min_seconds=0.05):
+    """
+    Yield (source, rows, stage, baseline seconds, current seconds, ratio, regression) for the common runs.
+    """
+    for key in sorted(baseline.keys() & current.keys()):
+        source, rows = key
+        stages = baseline[key]["stages"]
+        for stage, result in stages.items():
+            if stage not in current[key]["stages"]:
+                continue
+            before = result["wall_seconds"]
+            after = current[key]["stages"][stage]["wall_seconds"]
+            ratio = after / before if before else None
+            regression = ratio is not None and before >= min_seconds and ratio > 1 + threshold
+            yield source, rows, stage, before, after, ratio, regression
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    regressions = 0
+    print(f"{'source':<8}{'rows':>10}  {'stage':<10}{'baseline':>10}{'current':>10}{'ratio':>8}")
+    for source, rows, stage, before, after, ratio, regression in compare(
+            load_runs(args.baseline), load_runs(args.current), args.threshold, args.min_seconds):
+        regressions += regression
+        ratio_text = f"{ratio:.2f}" if ratio is not None else "-"
+        print(f"{source:<8}{rows:>10}  {stage:<10}{before:>10.3f}{after:>10.3f}{ratio_text:>8}"
+              f"{'  REGRESSION' if regression else ''}")
+    if regressions:
+        print(f"{regressions} stages slower by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import json
+import math
+import random
+from datetime import date, datetime, time, timedelta
+
+from openpyxl import Workbook
+
+"""
+Synthetic inputs of the size wanted, shaped like the real ones.
+Airbyte JSONL: one line per day, its `_airbyte_data` holds the `stations` list and the `hourly` readings of every
+InfoClimat station (24 per station), with every field as a string like the InfoClimat API returns them.
+Weather Underground workbook: one sheet per day named DDMMYY, a header row, an empty row,
+then one reading every 5 minutes with its unit ("56.8 °F", "8.2 mph", "29.48 in", "0 w/m²").
+The values follow a daily cycle plus noise, from a seeded generator, so two runs produce the same file.
+"""
+
+infoclimat_stations = [
+    {"id": "07015", "name": "Lille-Lesquin"},
+    {"id": "000R5", "name": "Bergues"},
+    {"id": "STATIC0010", "name": "Armentières"},
+    {"id": "00052", "name": "Hazebrouck"},
+]
+
+wu_header = ["Time", "Temperature", "Dew Point", "Humidity", "Wind", "Speed", "Gust", "Pressure",
+             "Precip. Rate.", "Precip. Accum.", "UV", "Solar"]
+wind_directions = ["North", "NNE", "NE", "ENE", "East", "ESE", "SE", "SSE",
+                   "South", "SSW", "SW", "WSW", "West", "WNW", "NW", "NNW"]
+
+# Readings of a Weather Underground day, every 5 minutes
+wu_readings_per_day = 288
+
+
+def daily_cycle(minute_of_day):
+    # -1 at 4am, 1 at 4pm
+    return math.sin((minute_of_day / 1440 - 10 / 24) * 2 * math.pi)
+
+
+def infoclimat_reading(rng, station_id, moment):
+    temperature = 11 + 5 * daily_cycle(moment.hour * 60) + rng.gauss(0, 1)
+    humidity = min(100, max(30, round(80 - 15 * daily_cycle(moment.hour * 60) + rng.gauss(0, 5))))
+    rain = rng.random() < 0.15
+    wind = max(0.0, rng.gauss(15, 6))
+    return {
+        "id_station": station_id,
+        "dh_utc": moment.strftime("%Y-%m-%d %H:%M:%S"),
+        "temperature": f"{temperature:.1f}",
+        "pression": f"{1013 + rng.gauss(0, 8):.1f}",
+        "humidite": str(humidity),
+        "point_de_rosee": f"{temperature - (100 - humidity) / 5:.1f}",
+        "visibilite": str(rng.choice([6000, 10000, 20000, 30000])),
+        "vent_moyen": f"{wind:.1f}",
+        "vent_rafales": f"{wind * 1.6:.1f}",
+        "vent_direction": str(rng.randrange(0, 360, 10)),
+        "pluie_3h": f"{rng.expovariate(1) * 3:.1f}" if rain else None,
+        "pluie_1h": f"{rng.expovariate(1):.1f}" if rain else "0",
+        "neige_au_sol": None,
+        "nebulosite": rng.choice(["", "1", "4", "8"]),
+        "temps_omm": None,
+    }
+
+
+def write_airbyte_jsonl(path, rows, stations=4, start=date(2024, 10, 1), seed=0):
+    """
+    Write an Airbyte export of about `rows` hourly readings (whole days of `stations` stations) to `path`.
+    Returns the number of readings written.
+    """
+    rng = random.Random(seed)
+    station_list = []
+    for i in range(stations):
+        # Beyond the 4 real stations, copies with a numbered id and name
+        station = infoclimat_stations[i % len(infoclimat_stations)]
+        suffix = "" if i < len(infoclimat_stations) else f"_{i}"
+        station_list.append({"id": station["id"] + suffix, "name": station["name"] + suffix})
+    days = max(1, math.ceil(rows / (24 * stations)))
+    emitted_at = int(datetime(2025, 3, 14).timestamp() * 1000)
+    written = 0
+    with open(path, "w", encoding="utf-8") as file:
+        for day in range(days):
+            day_start = datetime.combine(start + timedelta(days=day), time())
+            hourly = {
+                station["id"]: [infoclimat_reading(rng, station["id"], day_start + timedelta(hours=hour))
+                                for hour in range(24)]
+                for station in station_list
+            }
+            hourly["_params"] = ["temperature", "pression", "humidite", "point_de_rosee", "vent_moyen"]
+            data = {"status": "OK", "stations": station_list, "hourly": hourly}
+            file.write(json.dumps({"_airbyte_ab_id": f"{seed}-{day}", "_airbyte_emitted_at": emitted_at + day,
+                                   "_airbyte_data": data}, ensure_ascii=False) + "\n")
+            written += 24 * len(station_list)
+    return written
+
+
+def wu_row(rng, moment, accumulated):
+    minute = moment.hour * 60 + moment.minute
+    temperature = 52 + 9 * daily_cycle(minute) + rng.gauss(0, 0.5)
+    humidity = min(100, max(30, round(85 - 20 * daily_cycle(minute) + rng.gauss(0, 2))))
+    speed = max(0.0, rng.gauss(8, 3))
+    rate = rng.expovariate(8) if rng.random() < 0.1 else 0.0
+    solar = max(0, round(600 * daily_cycle(minute)))
+    return [
+        moment.time(),
+        f"{temperature:.1f} °F",
+        f"{temperature - (100 - humidity) / 2.5:.1f} °F",
+        f"{humidity} %",
+        rng.choice(wind_directions),
+        f"{speed:.1f} mph",
+        f"{speed * 1.3:.1f} mph",
+        f"{29.9 + rng.gauss(0, 0.2):.2f} in",
+        f"{rate:.2f} in",
+        f"{accumulated + rate / 12:.2f} in",
+        max(0, round(solar / 100)),
+        f"{solar} w/m²",
+    ]
+
+
+def write_wu_workbook(path, rows, start=date(2024, 10, 1), seed=0):
+    """
+    Write a Weather Underground workbook of about `rows` readings (whole days of 288) to `path`, sheet by sheet
+    with the openpyxl write-only mode, so a workbook of millions of rows is written in bounded memory.
+    Sheet names have a 2-digit year, so the days must fit in 1969-2068: a large workbook starts earlier.
+    Returns the number of readings written.
+    """
+    rng = random.Random(seed)
+    days = max(1, math.ceil(rows / wu_readings_per_day))
+    if start + timedelta(days=days) > date(2068, 12, 31):
+        start = date(1969, 1, 1)
+    if start + timedelta(days=days) > date(2068, 12, 31):
+        raise ValueError(f"{rows} rows need {days} daily sheets, more than the 100 years of 2-digit sheet names")
+
+    workbook = Workbook(write_only=True)
+    for day in range(days):
+        day_start = datetime.combine(start + timedelta(days=day), time(0, 4))
+        sheet = workbook.create_sheet(day_start.strftime("%d%m%y"))
+        sheet.append(wu_header)
+        sheet.append([None] * len(wu_header))
+        accumulated = 0.0
+        for reading in range(wu_readings_per_day):
+            row = wu_row(rng, day_start + timedelta(minutes=5 * reading), accumulated)
+            accumulated = float(row[9].split()[0])
+            sheet.append(row)
+    workbook.save(path)
+    return days * wu_readings_per_day
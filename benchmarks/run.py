@@ -0,0 +1,299 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from contextlib import nullcontext
+from datetime import datetime
+
+import boto3
+import bson
+import mongomock
+from pymongo import MongoClient
+
+# The migration modules import each other by their flat names, as when they are run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "migration"))
+# The mock of a server without $median is the one of the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+
+import jsonl  # noqa: E402
+import xlsx  # noqa: E402
+from bulk_insert import insert_documents  # noqa: E402
+from common import bucket_name, upper_case  # noqa: E402
+from instrument import StageTimer  # noqa: E402
+from s3_source import download_objects, select_objects  # noqa: E402
+from verify import migration_stats  # noqa: E402
+
+from generators import write_airbyte_jsonl, write_wu_workbook  # noqa: E402
+from utils import MockServer  # noqa: E402
+
+"""
+Benchmark of the migration, stage by stage, on synthetic inputs (see generators.py):
+```
+python benchmarks/run.py --rows 10000 100000 1000000 --sources jsonl xlsx
+```
+For every source and size, the input is generated, uploaded to a local S3 stand-in (in-process moto by default,
+or `moto_server` with --s3_endpoint_url) and migrated with the functions of the scripts, each stage timed apart:
+download, parse, transform, ids, documents, insert and verify (wall and CPU time, RSS growth, see instrument.py).
+MongoDB is mongomock by default, enough to compare the Python stages; insert and verify are only meaningful
+with a local mongod (--mongodb_address), into the `weather_benchmark` database.
+The results are written as JSON, compare two of them with compare.py.
+"""
+
+logger = logging.getLogger(__name__)
+
+benchmark_database_name = "weather_benchmark"
+default_results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+source_keys = {
+    "jsonl": "greencoop-airbyte/benchmark/InfoClimat/{rows}.jsonl",
+    "xlsx": "greencoop-airbyte/benchmark/Ichtegem_{rows}.xlsx",
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time every stage of the migration on synthetic inputs")
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10_000],
+        help="Sizes of the generated inputs, in readings (default: 10000)"
+    )
+
+    parser.add_argument(
+        "--sources",
+        nargs="+",
+        choices=list(source_keys),
+        default=list(source_keys),
+        help="Formats to benchmark (default: jsonl xlsx)"
+    )
+
+    parser.add_argument(
+        "--mongodb_address",
+        default=None,
+        help=f"Local mongod to insert into (database {benchmark_database_name}), mongomock if not given"
+    )
+
+    parser.add_argument(
+        "--s3_endpoint_url",
+        default=None,
+        help="S3 stand-in such as moto_server (http://localhost:5000), in-process moto if not given"
+    )
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=5000,
+        help="Number of documents per insert_many call (default: 5000)"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads inserting chunks concurrently (default: 4)"
+    )
+
+    parser.add_argument(
+        "--excel_engine",
+        default="auto",
+        choices=["auto", "calamine", "openpyxl"],
+        help="Excel reader, auto uses calamine when python-calamine is installed (default: auto)"
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes parsing the sheets of large workbooks (default: number of CPUs)"
+    )
+
+    parser.add_argument(
+        "--raw_bson",
+        action="store_true",
+        help="Encode the documents straight from the columns into BSON (see bson_sink.py)"
+    )
+
+    parser.add_argument(
+        "--no-verify",
+        dest="no_verify",
+        action="store_true",
+        help="Skip the verify stage, slow on mongomock which has no $median"
+    )
+
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Results file (default: benchmarks/results/<date>_<commit>.json)"
+    )
+
+    parser.add_argument(
+        "-v", "--verbosity",
+        type=upper_case,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging verbosity level (default: INFO)"
+    )
+    return parser.parse_args(argv)
+
+
+class RawMockCollection:
+    """
+    mongomock collection accepting the RawBSONDocuments of --raw_bson, decoded as mongod would store them.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def insert_many(self, documents, ordered=False):
+        return self.collection.insert_many([bson.decode(document.raw) for document in documents], ordered=ordered)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate(source, rows, path):
+    if source == "jsonl":
+        return write_airbyte_jsonl(path, rows)
+    return write_wu_workbook(path, rows)
+
+
+def migrate_jsonl(s3, obj, collection, timer, args):
+    tag = "benchmark_InfoClimat"
+    with timer.stage("download"):
+        _, content = next(download_objects(s3, [obj]))
+    with timer.stage("parse"):
+        records = list(jsonl.export_records(obj["Key"], content.splitlines(), {}))
+    with timer.stage("transform"):
+        df = jsonl.convert_records(records)
+    with timer.stage("ids"):
+        df = jsonl.add_ids(df, tag)
+    with timer.stage("documents"):
+        documents = jsonl.frame_to_documents(df, args.raw_bson)
+    with timer.stage("insert"):
+        summary = insert_documents(collection, documents, args.chunk_size, args.workers)
+    return tag, summary
+
+
+def migrate_xlsx(s3, obj, collection, timer, args):
+    tag = "benchmark_Ichtegem"
+    with timer.stage("download"):
+        _, content = next(download_objects(s3, [obj]))
+    with timer.stage("parse"):
+        frame = xlsx.parse_workbook(bytes(content), args.excel_engine, args.processes)
+    with timer.stage("transform"):
+        frame = xlsx.convert(frame, "Ichtegem")
+    with timer.stage("ids"):
+        frame = xlsx.add_ids(frame, "Ichtegem")
+        frame["migrated"] = tag
+    with timer.stage("documents"):
+        documents = xlsx.to_documents(frame, args.raw_bson)
+    with timer.stage("insert"):
+        summary = insert_documents(collection, documents, args.chunk_size, args.workers)
+    return tag, summary
+
+
+def benchmark(source, rows, s3, collection, verified, work_dir, args):
+    """
+    Generate, upload and migrate one input, returns the result of the run.
+    """
+    path = os.path.join(work_dir, f"{source}_{rows}.{source}")
+    rows = generate(source, rows, path)
+    key = source_keys[source].format(rows=rows)
+    timer = StageTimer(source)
+    logger.info(f"{source}, {rows} rows, {os.path.getsize(path) / 1024 ** 2:.1f} MB")
+
+    with timer.stage("upload"):
+        s3.upload_file(path, bucket_name, key)
+    obj = select_objects(s3, key, None, None, latest=1)[0]
+    collection.delete_many({})
+    migrate = migrate_jsonl if source == "jsonl" else migrate_xlsx
+    tag, summary = migrate(s3, obj, collection, timer, args)
+    if not args.no_verify:
+        with timer.stage("verify"):
+            stats = migration_stats(verified, tag)
+        if stats["row_count"] != rows:
+            logger.warning(f"{rows} rows generated, {stats['row_count']} verified")
+    os.remove(path)
+
+    if summary["inserted"] != rows:
+        logger.warning(f"{rows} rows generated, {summary['inserted']} inserted")
+    timer.log_summary()
+    return {
+        "source": source,
+        "rows": rows,
+        "file_bytes": obj["Size"],
+        "inserted": summary["inserted"],
+        "stages": {
+            name: {**record, "rows_per_second": rows / record["wall_seconds"] if record["wall_seconds"] else None}
+            for name, record in timer.stages.items()
+        },
+        "total_seconds": sum(record["wall_seconds"] for record in timer.stages.values()),
+    }
+
+
+def run(args, s3):
+    if args.mongodb_address:
+        collection = MongoClient(args.mongodb_address)[benchmark_database_name]["weather_station"]
+        verified = collection
+    else:
+        collection = mongomock.MongoClient()[benchmark_database_name]["weather_station"]
+        verified = MockServer(collection)
+        if args.raw_bson:
+            collection = RawMockCollection(collection)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for source in args.sources:
+            for rows in args.rows:
+                runs.append(benchmark(source, rows, s3, collection, verified, work_dir, args))
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "mongodb": args.mongodb_address or "mongomock",
+        "s3": args.s3_endpoint_url or "moto",
+        "runs": runs,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.verbosity))
+
+    if args.s3_endpoint_url:
+        aws = nullcontext()
+    else:
+        from moto import mock_aws
+        aws = mock_aws()
+    with aws:
+        s3 = boto3.client("s3", region_name="eu-north-1", endpoint_url=args.s3_endpoint_url,
+                          aws_access_key_id="testing", aws_secret_access_key="testing")
+        if bucket_name not in [bucket["Name"] for bucket in s3.list_buckets()["Buckets"]]:
+            s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={"LocationConstraint": "eu-north-1"})
+        results = run(args, s3)
+
+    output = args.output or os.path.join(
+        default_results_dir, f"{datetime.now().strftime('%Y-%m-%d_%Hh%M')}_{results['commit'] or 'nocommit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+    logger.info(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
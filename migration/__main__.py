@@ -0,0 +1,407 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from contextlib import nullcontext
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+
+# The migration modules import each other by their flat names, as when they are run as scripts
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import jsonl  # noqa: E402
+import xlsx  # noqa: E402
+from cache import FrameCache, default_cache_dir, default_max_bytes  # noqa: E402
+from checkpoint import Checkpoint, checkpoint_collection  # noqa: E402
+from common import load_secrets, s3_client, upper_case, weather_collection  # noqa: E402
+from create_collection import create_collection, deferred_indexes, write_mode  # noqa: E402
+from dedup import Deduplicator  # noqa: E402
+from instrument import StageTimer, default_profile_dir, write_report  # noqa: E402
+from manifest import manifest_collection  # noqa: E402
+from rollups import rollup_collection  # noqa: E402
+from schema_check import open_quarantine  # noqa: E402
+from worker import job_collection, plan_job, run_worker, work_collection  # noqa: E402
+
+"""
+Single-process runner for every source:
+```
+python -m migration run Ichtegem Madeleine InfoClimat [--create_collection]
+```
+pandas, boto3 and pymongo are imported once, secrets.json is read once and a single S3 client and MongoClient
+are shared by the sources, which run concurrently in threads (S3 downloads and MongoDB writes overlap).
+Each source keeps its own migration tag and expected metrics file.
+To spread a migration over several containers, `plan` writes its work units and every container runs `worker`
+(see worker.py):
+```
+python -m migration plan Ichtegem Madeleine InfoClimat --latest 0
+python -m migration worker
+```
+"""
+
+logger = logging.getLogger(__name__)
+
+sources = {station: "xlsx" for station in xlsx.file_patterns}
+sources.update({source: "jsonl" for source in jsonl.file_patterns})
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m migration", description="Run several migrations in one process")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Arguments shared by the commands
+    connection = argparse.ArgumentParser(add_help=False)
+    connection.add_argument(
+        "--mongodb_address",
+        default="mongodb://localhost:27017/",
+        help="The MongoDB address (default: mongodb://localhost:27017/)"
+    )
+
+    connection.add_argument(
+        "-v", "--verbosity",
+        type=upper_case,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging verbosity level (default: INFO)"
+    )
+
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument(
+        "sources",
+        nargs="+",
+        choices=list(sources),
+        help="The sources to migrate"
+    )
+
+    selection.add_argument(
+        "--since",
+        type=date.fromisoformat,
+        default=None,
+        help="Only select the S3 objects of this date or later (YYYY-MM-DD)"
+    )
+
+    selection.add_argument(
+        "--until",
+        type=date.fromisoformat,
+        default=None,
+        help="Only select the S3 objects of this date or earlier (YYYY-MM-DD)"
+    )
+
+    selection.add_argument(
+        "--latest",
+        type=int,
+        default=1,
+        help="Number of most recent Airbyte exports migrated per JSONL source, 0 for all of them (default: 1)"
+    )
+
+    selection.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip the S3 objects whose ETag and size are unchanged in the migration_manifest collection"
+    )
+
+    selection.add_argument(
+        "--new_records_only",
+        action="store_true",
+        help="Only migrate the Airbyte records emitted after the last one already migrated (JSONL sources)"
+    )
+
+    loading = argparse.ArgumentParser(add_help=False)
+    loading.add_argument(
+        "--chunk_size",
+        type=int,
+        default=5000,
+        help="Number of documents per insert_many call (default: 5000)"
+    )
+
+    loading.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads inserting chunks concurrently, per source (default: 4)"
+    )
+
+    loading.add_argument(
+        "--mode",
+        default="insert",
+        choices=["insert", "upsert"],
+        help="insert or upsert, see xlsx.py and jsonl.py (default: insert)"
+    )
+
+    loading.add_argument(
+        "--excel_engine",
+        default="auto",
+        choices=["auto", "calamine", "openpyxl"],
+        help="Excel reader, auto uses calamine when python-calamine is installed (default: auto)"
+    )
+
+    loading.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes parsing the sheets of large workbooks, and the exports with --pipeline "
+             "(default: number of CPUs)"
+    )
+
+    loading.add_argument(
+        "--raw_bson",
+        action="store_true",
+        help="Encode the documents straight from the columns into BSON, see bson_sink.py (not with --mode upsert)"
+    )
+
+    loading.add_argument(
+        "--no-dedup",
+        dest="no_dedup",
+        action="store_true",
+        help="Send the duplicate _ids to MongoDB instead of skipping them client-side (see dedup.py)"
+    )
+
+    loading.add_argument(
+        "--no-rollups",
+        dest="no_rollups",
+        action="store_true",
+        help="Do not update the hourly and daily rollups of the weather_station_rollups collection"
+    )
+
+    loading.add_argument(
+        "--quarantine",
+        default="collection",
+        choices=["collection", "file", "none"],
+        help="Where the rows that do not match schema.json go: the weather_station_quarantine collection, "
+             "a JSONL file in quarantine/, or nowhere (default: collection)"
+    )
+
+    run_parser = subparsers.add_parser("run", parents=[connection, selection, loading],
+                                       help="Migrate the given sources")
+    run_parser.add_argument(
+        "--create_collection",
+        action="store_true",
+        help="Drop and create the collection with its schema validation before migrating"
+    )
+
+    run_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the JSONL sources line by line (see jsonl.py)"
+    )
+
+    run_parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=5000,
+        help="Number of records converted at once in streaming mode (default: 5000)"
+    )
+
+    run_parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="Do not read nor write the local cache of normalized S3 objects"
+    )
+
+    run_parser.add_argument(
+        "--cache_dir",
+        default=default_cache_dir,
+        help="Directory of the local cache of normalized S3 objects (default: .cache at the root of the project)"
+    )
+
+    run_parser.add_argument(
+        "--cache_size_mb",
+        type=int,
+        default=default_max_bytes // 1024 ** 2,
+        help="Size cap of the local cache, the least recently used files are evicted first (default: 2048)"
+    )
+
+    run_parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Download, parse and insert concurrently with bounded queues between the stages (see pipeline.py)"
+    )
+
+    run_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Save the progress of every source after each inserted chunk and resume the interrupted loads "
+             "from their last committed chunk (see checkpoint.py)"
+    )
+
+    run_parser.add_argument(
+        "--partial_indexes",
+        action="store_true",
+        help="With --create_collection, also create the optional partial indexes"
+    )
+
+    run_parser.add_argument(
+        "--timeseries",
+        action="store_true",
+        help="With --create_collection, create a time-series collection (MongoDB 6.0+)"
+    )
+
+    run_parser.add_argument(
+        "--bulk_load",
+        action="store_true",
+        help="Drop the secondary indexes of the collection during the load and rebuild them once afterwards"
+    )
+
+    run_parser.add_argument(
+        "--trace_memory",
+        action="store_true",
+        help="Record the peak Python allocations of every stage with tracemalloc (slower)"
+    )
+
+    run_parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=default_profile_dir,
+        default=None,
+        help="Dump a cProfile .pstats file of every hot stage in this directory (default: profiles)"
+    )
+
+    run_parser.add_argument(
+        "--prometheus",
+        action="store_true",
+        help="Also write the stage report in the Prometheus text format"
+    )
+
+    plan_parser = subparsers.add_parser("plan", parents=[connection, selection],
+                                        help="Write the work units of the given sources for the workers (see worker.py)")
+    plan_parser.add_argument(
+        "--create_collection",
+        action="store_true",
+        help="Drop and create the collection with its schema validation before planning"
+    )
+
+    worker_parser = subparsers.add_parser("worker", parents=[connection, loading],
+                                          help="Migrate the work units of a job with the other workers (see worker.py)")
+    worker_parser.add_argument(
+        "--job",
+        default=None,
+        help="The job to work on (default: the most recent running job, waiting for one to be planned)"
+    )
+    return parser.parse_args(argv)
+
+
+def run_source(source, s3, collection, manifest, cache, rollups, quarantine, mode, args, checkpoints=None,
+               deferred=None):
+    start = time.perf_counter()
+    logger.info(f"Migrating {source}")
+    timer = StageTimer(source, args.trace_memory, args.profile)
+    dedup = None if args.no_dedup else Deduplicator(collection, mode)
+    checkpoint = None if checkpoints is None else Checkpoint(checkpoints, source)
+    if sources[source] == "xlsx":
+        summary = xlsx.migrate(s3, collection, source, args.mongodb_address, args.chunk_size, args.workers,
+                               mode, since=args.since, until=args.until, manifest=manifest,
+                               incremental=args.incremental, cache=cache, engine=args.excel_engine,
+                               processes=args.processes, rollups=rollups, timer=timer,
+                               quarantine_target=quarantine, pipeline=args.pipeline, raw_bson=args.raw_bson,
+                               dedup=dedup, checkpoint=checkpoint, deferred=deferred)
+    else:
+        summary = jsonl.run(s3, collection, source, args.mongodb_address, args.stream, args.batch_size,
+                            args.chunk_size, args.workers, mode, since=args.since, until=args.until,
+                            latest=args.latest, manifest=manifest, incremental=args.incremental,
+                            new_records_only=args.new_records_only, cache=cache, rollups=rollups, timer=timer,
+                            quarantine_target=quarantine, pipeline=args.pipeline, processes=args.processes,
+                            raw_bson=args.raw_bson, dedup=dedup, checkpoint=checkpoint, deferred=deferred)
+    logger.info(f"{source} migrated in {time.perf_counter() - start:.2f}s")
+    timer.log_summary()
+    write_report(timer, args.prometheus)
+    return summary
+
+
+def run(args, s3, client):
+    """
+    Migrate every requested source concurrently with the shared clients, returns the summaries by source.
+    A failing source is logged and does not stop the others.
+    With --bulk_load, the secondary indexes are dropped once for all the sources and rebuilt after the last one,
+    then the rollups of the sources are updated.
+    With --resume, every source keeps a checkpoint and resumes its interrupted load (see checkpoint.py).
+    """
+    checkpoints = checkpoint_collection(client) if args.resume else None
+    if args.create_collection:
+        create_collection(client, args.partial_indexes, args.timeseries)
+        if checkpoints is not None:
+            # The documents of the interrupted loads were dropped with the collection
+            checkpoints.delete_many({})
+    collection = weather_collection(client)
+    mode = write_mode(collection, args.mode)
+    manifest = manifest_collection(client)
+    cache = None if args.no_cache else FrameCache(args.cache_dir, args.cache_size_mb * 1024 ** 2)
+    rollups = None if args.no_rollups else rollup_collection(client)
+    quarantine = open_quarantine(client, args.quarantine)
+
+    summaries = {}
+    failed = []
+    with deferred_indexes(collection) if args.bulk_load else nullcontext() as deferred, \
+            ThreadPoolExecutor(max_workers=len(args.sources)) as executor:
+        futures = {source: executor.submit(run_source, source, s3, collection, manifest, cache, rollups,
+                                               quarantine, mode, args, checkpoints, deferred)
+                   for source in dict.fromkeys(args.sources)}
+        for source, future in futures.items():
+            try:
+                summaries[source] = future.result()
+            except Exception:
+                logger.exception(f"Migration of {source} failed")
+                failed.append(source)
+    return summaries, failed
+
+
+def plan(args, s3, client):
+    """
+    Write the work units of the requested sources, returns the job id (None if there is nothing to migrate).
+    """
+    if args.create_collection:
+        create_collection(client)
+    return plan_job(work_collection(client), job_collection(client), s3,
+                    {source: sources[source] for source in args.sources}, args.since, args.until, args.latest,
+                    manifest_collection(client), args.incremental, args.new_records_only)
+
+
+def work(args, s3, client):
+    """
+    Migrate the work units of a job with the other workers, returns the finished job.
+    """
+    if args.raw_bson and args.mode == "upsert":
+        raise ValueError("--raw_bson can not be used with --mode upsert, which adds a content_hash to every document")
+    collection = weather_collection(client)
+    rollups = None if args.no_rollups else rollup_collection(client)
+    return run_worker(client, s3, collection, args.mongodb_address, args.job, manifest_collection(client), rollups,
+                      chunk_size=args.chunk_size, workers=args.workers, mode=write_mode(collection, args.mode),
+                      quarantine_target=open_quarantine(client, args.quarantine), raw_bson=args.raw_bson,
+                      dedup=not args.no_dedup, engine=args.excel_engine, processes=args.processes)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    log_level = getattr(logging, args.verbosity)
+    logging.basicConfig(level=log_level, format="%(asctime)s %(threadName)s %(name)s %(levelname)s %(message)s")
+
+    start = time.perf_counter()
+    s3 = s3_client(load_secrets('secrets.json'))
+    client = MongoClient(args.mongodb_address)
+
+    try:
+        if args.command == "plan":
+            job_id = plan(args, s3, client)
+            logger.info(f"Job planned: {job_id}" if job_id else "Nothing to migrate")
+            return
+        if args.command == "worker":
+            job = work(args, s3, client)
+            if job["state"] == "failed":
+                logger.error(f"Job {job['_id']} failed, units: {job['failed_units']}")
+                sys.exit(1)
+            return
+        summaries, failed = run(args, s3, client)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+    logger.info(f"{len(summaries)} sources migrated in {time.perf_counter() - start:.2f}s")
+    if failed:
+        logger.error(f"Failed sources: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+"""
+Encoding of the frames straight into BSON, without building a dict per row.
+Every column is encoded at once from its typed array: the numbers, dates, booleans and ObjectIds are written as
+fixed-width byte blocks, and the distinct strings (station, migration tag...) are encoded once and repeated.
+A batch of rows is assembled in a single preallocated buffer, reused by the next batches of the frame (it only grows
+for a larger batch), then copied once to bytes sliced into RawBSONDocuments that pymongo sends as they are.
+The bytes are the ones bson.encode gives for the dicts of the scripts (fields in the order of the columns, _id first).
+`nan_is_null` matches frame_to_documents of jsonl.py (a NaN is null), without it to_dict of xlsx.py (a NaN stays
+a double). Values of any other type are encoded one by one with bson.encode.
+"""
+
+# BSON element types
+double_type = b"\x01"
+objectid_type = b"\x07"
+bool_type = b"\x08"
+date_type = b"\x09"
+null_type = b"\x0a"
+int32_type = b"\x10"
+int64_type = b"\x12"
+
+int32_min = -2 ** 31
+int32_max = 2 ** 31 - 1
+
+# Rows encoded in one buffer, the index arrays of a batch take a few times its size
+default_batch_size = 5000
+
+
+class ColumnEncoding:
+    """
+    The elements of one column: the byte length of every row and the parts to copy into the buffer.
+    """
+
+    def __init__(self, size):
+        self.lengths = np.zeros(size, dtype=np.int64)
+        # (rows, element of every row as a 2D array)
+        self.fixed = []
+        # (rows, lengths, concatenated elements, start of the element of every row)
+        self.variable = []
+
+    def add_fixed(self, rows, element_type, key, values=None):
+        prefix = np.frombuffer(element_type + key + b"\x00", dtype=np.uint8)
+        width = len(prefix) + (0 if values is None else values.shape[1])
+        # The type and key, then the value, of every row
+        elements = np.empty((len(rows), width), dtype=np.uint8)
+        elements[:, :len(prefix)] = prefix
+        if values is not None:
+            elements[:, len(prefix):] = values
+        self.fixed.append((rows, elements))
+        self.lengths[rows] = width
+
+    def add_elements(self, rows, codes, elements):
+        """
+        Every row gets the whole encoded element of its code.
+        """
+        lengths = np.fromiter(map(len, elements), dtype=np.int64, count=len(elements))
+        flat = np.frombuffer(b"".join(elements), dtype=np.uint8)
+        starts = np.cumsum(lengths) - lengths
+        self.variable.append((rows, lengths[codes], flat, starts[codes]))
+        self.lengths[rows] = lengths[codes]
+
+    def write(self, buffer, positions):
+        for rows, elements in self.fixed:
+            buffer[positions[rows][:, None] + np.arange(elements.shape[1])] = elements
+        for rows, lengths, flat, starts in self.variable:
+            # Index of every byte within its element
+            within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            buffer[np.repeat(positions[rows], lengths) + within] = flat[np.repeat(starts, lengths) + within]
+
+
+def element(key, value):
+    # The element of one value, as bson.encode writes it in a document
+    if isinstance(value, np.generic):
+        value = value.item()
+    return bson.encode({key: value})[4:-1]
+
+
+def fixed_bytes(values, dtype, width):
+    return np.ascontiguousarray(values.astype(dtype)).view(np.uint8).reshape(-1, width)
+
+
+def encode_column(key, column, nan_is_null):
+    size = len(column)
+    encoding = ColumnEncoding(size)
+    name = key.encode()
+    rows = np.arange(size)
+    dtype = column.dtype
+
+    if pd.api.types.is_float_dtype(dtype):
+        values = column.to_numpy(dtype="float64", na_value=np.nan)
+        missing = np.isnan(values) if nan_is_null else np.zeros(size, dtype=bool)
+        encoding.add_fixed(rows[~missing], double_type, name, fixed_bytes(values[~missing], "<f8", 8))
+    elif pd.api.types.is_bool_dtype(dtype):
+        missing = column.isna().to_numpy()
+        values = column.to_numpy(dtype=object)[~missing].astype(bool)
+        encoding.add_fixed(rows[~missing], bool_type, name, fixed_bytes(values, np.uint8, 1))
+    elif pd.api.types.is_integer_dtype(dtype):
+        missing = column.isna().to_numpy()
+        values = column.to_numpy(dtype="int64", na_value=0)
+        small = (values >= int32_min) & (values <= int32_max) & ~missing
+        large = ~small & ~missing
+        encoding.add_fixed(rows[small], int32_type, name, fixed_bytes(values[small], "<i4", 4))
+        encoding.add_fixed(rows[large], int64_type, name, fixed_bytes(values[large], "<i8", 8))
+    elif pd.api.types.is_datetime64_any_dtype(dtype):
+        if getattr(dtype, "tz", None) is not None:
+            column = column.dt.tz_convert(None)
+        missing = column.isna().to_numpy()
+        # Milliseconds since the epoch, rounded down like the datetimes bson encodes
+        millis = column.to_numpy(dtype="datetime64[ns]").view("int64")[~missing] // 1_000_000
+        encoding.add_fixed(rows[~missing], date_type, name, fixed_bytes(millis, "<i8", 8))
+    else:
+        values = column.to_numpy(dtype=object)
+        if nan_is_null:
+            missing = column.isna().to_numpy()
+        else:
+            # A float NaN stays a double, only None, NaT and NA are null
+            missing = np.fromiter((value is None or value is pd.NaT or value is pd.NA for value in values),
+                                  dtype=bool, count=size)
+        present = values[~missing]
+        types = set(map(type, present))
+        if types == {ObjectId}:
+            binary = np.frombuffer(b"".join(value.binary for value in present), dtype=np.uint8).reshape(-1, 12)
+            encoding.add_fixed(rows[~missing], objectid_type, name, binary)
+        elif types == {str}:
+            # The distinct strings are encoded once
+            codes, uniques = pd.factorize(present)
+            encoding.add_elements(rows[~missing], codes, [element(key, value) for value in uniques])
+        elif len(present):
+            encoding.add_elements(rows[~missing], np.arange(len(present)), [element(key, value) for value in present])
+    if missing.any():
+        encoding.add_fixed(rows[missing], null_type, name)
+    return encoding
+
+
+def encode_batch(df, nan_is_null=False, buffer=None):
+    """
+    Encode every row of the frame into one buffer, returns one RawBSONDocument per row and the buffer.
+    A given buffer is reused when it is large enough.
+    """
+    if len(df) == 0:
+        return [], buffer
+    # Like bson.encode, _id is the first field of a top-level document
+    order = sorted(range(len(df.columns)), key=lambda i: df.columns[i] != "_id")
+    encodings = [encode_column(df.columns[i], df.iloc[:, i], nan_is_null) for i in order]
+    # Length, elements and the trailing null byte of every document
+    sizes = 5 + sum(encoding.lengths for encoding in encodings)
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    if buffer is None or len(buffer) < ends[-1]:
+        buffer = np.empty(ends[-1], dtype=np.uint8)
+    view = buffer[:ends[-1]]
+    view[starts[:, None] + np.arange(4)] = fixed_bytes(sizes, "<i4", 4)
+    positions = starts + 4
+    for encoding in encodings:
+        encoding.write(view, positions)
+        positions = positions + encoding.lengths
+    # Every byte is written but the trailing null of the documents, the buffer holds the previous batch
+    view[ends - 1] = 0
+    raw = view.tobytes()
+    return [RawBSONDocument(raw[start:end]) for start, end in zip(starts.tolist(), ends.tolist())], buffer
+
+
+def frame_to_raw_documents(df, nan_is_null=False, batch_size=default_batch_size):
+    """
+    The RawBSONDocuments of every row of the frame, encoded `batch_size` rows at a time.
+    """
+    documents = []
+    buffer = None
+    for start in range(0, len(df), batch_size):
+        batch, buffer = encode_batch(df.iloc[start:start + batch_size], nan_is_null, buffer)
+        documents.extend(batch)
+    return documents
@@ -0,0 +1,223 @@
+import hashlib
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+
+import bson
+from pymongo import ReplaceOne, errors
+
+"""
+Insert engine shared by the migration scripts.
+Documents are split into chunks that are written by a small thread pool over the MongoClient connection pool,
+so the BSON encoding of one chunk overlaps with the network round trip of the others.
+The counts of every chunk are added up in one Counter: documents, inserted, duplicate, validation, other.
+
+In "upsert" mode, a migration can be run again: every document carries a `content_hash`, documents whose hash
+is already stored are only re-tagged with the new migration tag, the others are replaced (or inserted).
+In "insert_new" mode, used for a time-series collection which has no unique index on _id, the documents
+already stored are skipped instead of failing with a duplicate key error.
+"""
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+VALIDATION_ERROR = 121
+
+# Number of failed documents of each kind logged at DEBUG level
+logged_errors_limit = 3
+
+
+def chunked(documents, chunk_size):
+    iterator = iter(documents)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def insert_chunk(collection, chunk):
+    """
+    Insert one chunk, set 'ordered=False' to continue on duplicate key error.
+    Returns the counts of the chunk and the first failed documents of each kind.
+    """
+    counts = Counter(documents=len(chunk))
+    samples = {"duplicate": [], "validation": [], "other": []}
+    try:
+        collection.insert_many(chunk, ordered=False)
+        # Every document is inserted without error, inserted_ids is empty for RawBSONDocuments
+        counts["inserted"] += len(chunk)
+    except errors.BulkWriteError as e:
+        # Extract useful summary info without dumping full error
+        counts["inserted"] += e.details.get('nInserted', 0)
+        # Separate errors into categories, in a single pass
+        for error in e.details.get('writeErrors', []):
+            if error.get('code') == DUPLICATE_KEY_ERROR:
+                kind = "duplicate"
+            elif error.get('code') == VALIDATION_ERROR:
+                kind = "validation"
+            else:
+                kind = "other"
+            counts[kind] += 1
+            if len(samples[kind]) < logged_errors_limit:
+                samples[kind].append(error)
+    return counts, samples
+
+
+def insert_new_chunk(collection, chunk):
+    """
+    Insert the documents of the chunk whose _id is not stored yet, they are counted as duplicates otherwise.
+    The stored _ids are looked up by station and time range, the fields a time-series collection prunes its buckets on.
+    """
+    times = [document["datetime"] for document in chunk if document.get("datetime") is not None]
+    stored = set()
+    if times:
+        query = {
+            "station": {"$in": list({document.get("station") for document in chunk})},
+            "datetime": {"$gte": min(times), "$lte": max(times)},
+        }
+        stored = {document["_id"] for document in collection.find(query, {"_id": 1})}
+    new_documents = [document for document in chunk if document["_id"] not in stored]
+    if new_documents:
+        counts, samples = insert_chunk(collection, new_documents)
+    else:
+        counts, samples = Counter(), {"duplicate": [], "validation": [], "other": []}
+    counts["documents"] = len(chunk)
+    counts["duplicate"] += len(chunk) - len(new_documents)
+    return counts, samples
+
+
+def content_hash(document):
+    """
+    md5 of the BSON encoding of the document, without the fields that change from one run to another.
+    """
+    content = {key: value for key, value in document.items() if key not in ("_id", "migrated", "content_hash")}
+    return hashlib.md5(bson.encode(content)).hexdigest()
+
+
+def upsert_chunk(collection, chunk):
+    """
+    Replace the documents of the chunk whose content changed, insert the new ones and re-tag the unchanged ones.
+    Returns the counts of the chunk and the first failed documents of each kind.
+    """
+    counts = Counter(documents=len(chunk))
+    samples = {"duplicate": [], "validation": [], "other": []}
+
+    ids = [document["_id"] for document in chunk]
+    stored_hashes = {
+        stored["_id"]: stored.get("content_hash")
+        for stored in collection.find({"_id": {"$in": ids}}, {"content_hash": 1})
+    }
+
+    requests = []
+    unchanged_ids = []
+    for document in chunk:
+        document["content_hash"] = content_hash(document)
+        if stored_hashes.get(document["_id"]) == document["content_hash"]:
+            unchanged_ids.append(document["_id"])
+        else:
+            requests.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+
+    if unchanged_ids:
+        # A single update for the whole chunk, the unchanged documents only get the new migration tag
+        collection.update_many({"_id": {"$in": unchanged_ids}}, {"$set": {"migrated": chunk[0]["migrated"]}})
+        counts["unchanged"] += len(unchanged_ids)
+
+    if requests:
+        try:
+            result = collection.bulk_write(requests, ordered=False)
+            counts["inserted"] += result.upserted_count
+            counts["updated"] += result.matched_count
+        except errors.BulkWriteError as e:
+            counts["inserted"] += e.details.get('nUpserted', 0)
+            counts["updated"] += e.details.get('nMatched', 0)
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == DUPLICATE_KEY_ERROR:
+                    kind = "duplicate"
+                elif error.get('code') == VALIDATION_ERROR:
+                    kind = "validation"
+                else:
+                    kind = "other"
+                counts[kind] += 1
+                if len(samples[kind]) < logged_errors_limit:
+                    samples[kind].append(error)
+    return counts, samples
+
+
+def log_samples(samples, logged):
+    # logged counts the errors of each kind already logged by the previous chunks
+    for kind, write_errors in samples.items():
+        for error in write_errors:
+            if logged[kind] >= logged_errors_limit:
+                break
+            logged[kind] += 1
+            errmsg = error.get('errmsg', 'No detailed message available')
+            if kind == "duplicate":
+                logger.debug(f"Duplicate key error: {errmsg}")
+                logger.debug(f"Duplicate _id: {error.get('keyValue', {}).get('_id', 'unknown')}")
+            elif kind == "validation":
+                logger.debug(f"Validation failed for document: {errmsg}")
+            else:
+                logger.debug(f"Write error {error.get('code')}: {errmsg}")
+            logger.debug(f"Failed document data: {error.get('op', {})}")
+
+
+def insert_documents(collection, documents, chunk_size=5000, workers=4, mode="insert"):
+    """
+    Insert (or upsert, see upsert_chunk, or only the new ones, see insert_new_chunk) an iterable of documents
+    in chunks of `chunk_size`, with `workers` threads.
+    The iterable is consumed lazily and at most 2 * workers chunks are in flight, so a generator keeps memory bounded.
+    Returns a Counter with the documents sent, inserted, duplicate, validation and other counts
+    (plus updated and unchanged in upsert mode), and the elapsed seconds.
+    """
+    write_chunk = {"upsert": upsert_chunk, "insert_new": insert_new_chunk}.get(mode, insert_chunk)
+    summary = Counter()
+    logged = Counter()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for chunk in chunked(documents, chunk_size):
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    counts, samples = future.result()
+                    summary.update(counts)
+                    log_samples(samples, logged)
+            pending.add(executor.submit(write_chunk, collection, chunk))
+        for future in pending:
+            counts, samples = future.result()
+            summary.update(counts)
+            log_samples(samples, logged)
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def log_insert_summary(summary, mongodb_address, mode="insert"):
+    duplicate_count = summary["duplicate"]
+    validation_count = summary["validation"]
+    other_count = summary["other"]
+    seconds = summary["seconds"]
+    rate = summary["documents"] / seconds if seconds else 0.0
+
+    if duplicate_count == 0 and validation_count == 0 and other_count == 0:
+        logger.info(f"Successfully inserted {summary['inserted']} documents into MongoDB at {mongodb_address} !")
+    else:
+        # Log the counts of different error types
+        logger.warning(f"Duplicate key error: {duplicate_count} documents were skipped.")
+        logger.warning(f"Validation error: {validation_count} documents failed validation.")
+        logger.warning(f"Other errors: {other_count} documents encountered other errors.")
+
+        # Successfully inserted documents
+        logger.info(f"{summary['inserted']} documents were successfully inserted despite this error.")
+
+    if summary["skipped_in_load"] or summary["skipped_stored"]:
+        logger.info(f"Dedup: {summary['skipped_in_load']} duplicates within the load and {summary['skipped_stored']} "
+                    f"documents already stored were skipped before sending.")
+    if summary["rejected"]:
+        logger.warning(f"Schema check: {summary['rejected']} documents did not match schema.json and were not sent.")
+    if mode == "upsert":
+        logger.info(f"{summary['inserted']} documents inserted, {summary['updated']} updated "
+                    f"and {summary['unchanged']} unchanged.")
+    logger.info(f"{summary['documents']} documents sent in {seconds:.2f}s ({rate:.0f} documents/s)")
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import pyarrow as pa
+
+"""
+On-disk cache of the normalized frames of the S3 objects, as uncompressed Arrow IPC files.
+A file is keyed by bucket, key and ETag, so a modified object is never read from the cache.
+A cached file is read through a memory map, so a warm run skips both the download and the parse; the table is then
+copied into the returned DataFrame, which is not a zero-copy view of the file.
+The cache is capped in size: the least recently used files (oldest mtime, refreshed on every hit) are evicted first.
+The concurrent sources of the runner and the pipelined parse threads share the cache: the evictions of a process
+run one at a time, and a file removed by another process in the meantime is skipped.
+"""
+
+logger = logging.getLogger(__name__)
+
+default_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache")
+default_max_bytes = 2 * 1024 ** 3
+
+# Arrow schema metadata key holding the extra information stored with a frame
+metadata_key = b"migration"
+
+# Part of every file key, bumped when the normalized frames change: since version 2 the frame of an export holds
+# every Airbyte record, not only the first one
+cache_version = 2
+
+# One eviction at a time in the process
+evict_lock = threading.Lock()
+
+
+class FrameCache:
+    def __init__(self, directory=default_cache_dir, max_bytes=default_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, bucket, key, etag):
+        digest = hashlib.sha256(f"{cache_version}/{bucket}/{key}/{etag}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.arrow")
+
+    def contains(self, bucket, key, etag):
+        return os.path.exists(self.path(bucket, key, etag))
+
+    def load(self, bucket, key, etag):
+        """
+        Return (frame, metadata) for the object, or (None, None) if it is not cached.
+        The frame is a copy of the memory-mapped table.
+        """
+        path = self.path(bucket, key, etag)
+        try:
+            with pa.memory_map(path) as source:
+                table = pa.ipc.open_file(source).read_all()
+        except FileNotFoundError:
+            return None, None
+        # Refresh the mtime, the eviction order, unless the file was evicted since it was read
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        metadata = json.loads((table.schema.metadata or {}).get(metadata_key, b"{}"))
+        logger.info(f"Cache hit for {key}")
+        return table.to_pandas(), metadata
+
+    def store(self, frame, bucket, key, etag, metadata=None):
+        """
+        Write the frame (and a JSON-serializable metadata dict) for the object, then evict to stay under the cap.
+        """
+        with self.writer(bucket, key, etag, metadata) as writer:
+            writer.write(frame)
+
+    @contextmanager
+    def writer(self, bucket, key, etag, metadata=None):
+        """
+        Write the frame of the object piece by piece, so it is never held whole: yields a CacheWriter whose `write`
+        takes the next piece (same columns). The file is renamed into place only if the block succeeds.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(bucket, key, etag)
+        writer = CacheWriter(f"{path}.{uuid.uuid4().hex}.tmp", metadata)
+        try:
+            yield writer
+        except BaseException:
+            writer.close()
+            writer.discard()
+            raise
+        writer.close()
+        if writer.failed or writer.writer is None:
+            writer.discard()
+            return
+        os.replace(writer.path, path)
+        self.evict()
+
+    def evict(self):
+        with evict_lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".arrow"):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    logger.debug(f"Evicted {name} from the cache")
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class CacheWriter:
+    """
+    An Arrow IPC file written a frame at a time, with the schema of the first frame.
+    A frame that can not be cast to it (a column of another type) stops the writing, the file is then not cached.
+    """
+
+    def __init__(self, path, metadata=None):
+        self.path = path
+        self.metadata = metadata
+        self.sink = None
+        self.writer = None
+        self.schema = None
+        self.failed = False
+
+    def write(self, frame):
+        if self.failed:
+            return
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self.writer is None:
+            table = table.replace_schema_metadata({
+                **(table.schema.metadata or {}),
+                metadata_key: json.dumps(self.metadata or {}).encode(),
+            })
+            self.schema = table.schema
+            self.sink = pa.OSFile(self.path, "wb")
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+        try:
+            self.writer.write_table(table.cast(self.schema))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError) as e:
+            logger.warning(f"Frame not cached, a piece does not match the schema of the first one: {e}")
+            self.failed = True
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.sink.close()
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
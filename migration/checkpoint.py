@@ -0,0 +1,105 @@
+import logging
+from datetime import datetime
+
+from common import database_name
+
+"""
+Checkpoints of the loads, kept in the `migration_checkpoints` collection of `weather_data`, one per source.
+With --resume, the chunked modes save their progress after every chunk whose documents are inserted:
+the byte offset after the last Airbyte line of the chunk in the current export (jsonl.py) or the sheets already
+inserted (xlsx.py), with the migration tag, the insert counts, the manifest stats and the running metrics
+(exact moments and KLL sketches, see metrics.py). An interrupted load run again with --resume keeps its migration tag,
+skips what was committed and reads the rest of the export with a ranged GET from the offset, so only the chunk
+in flight is sent again. Its documents already inserted are re-sent and counted as duplicates, the metrics count
+them once. The checkpoint is deleted once the load is complete.
+"""
+
+logger = logging.getLogger(__name__)
+
+checkpoint_collection_name = "migration_checkpoints"
+
+
+def checkpoint_collection(client):
+    return client[database_name][checkpoint_collection_name]
+
+
+def object_versions(objects):
+    return [{"key": obj["Key"], "etag": obj["ETag"]} for obj in objects]
+
+
+def stats_list(stats):
+    """
+    The manifest stats by S3 key as a list, the dots of the keys are not valid in the field names of MongoDB 4.4.
+    """
+    return [{"key": key, **object_stats} for key, object_stats in stats.items()]
+
+
+def stats_dict(entries):
+    return {entry["key"]: {name: value for name, value in entry.items() if name != "key"} for entry in entries}
+
+
+class Checkpoint:
+    """
+    The progress of the load of one source. `state` is the saved document once the load is started or resumed.
+    """
+
+    def __init__(self, collection, source):
+        self.collection = collection
+        self.source = source
+        self.state = None
+
+    def resume(self, objects):
+        """
+        The saved state of an interrupted load of the same objects (keys and ETags), None if there is none.
+        """
+        state = self.collection.find_one({"_id": self.source})
+        if state is None:
+            return None
+        if state["objects"] != object_versions(objects):
+            logger.warning(f"The checkpoint of {self.source} is for other S3 objects, the load starts over")
+            return None
+        logger.info(f"Resuming migration {state['migration_tag']} of {self.source}, "
+                    f"{state['metrics']['row_count'] if state['metrics'] else 0} documents already committed")
+        self.state = state
+        return state
+
+    def start(self, objects, migration_tag):
+        self.state = {
+            "_id": self.source,
+            "migration_tag": migration_tag,
+            "objects": object_versions(objects),
+            # Exports fully loaded, and position in the current one
+            "done_keys": [],
+            "key": None,
+            "offset": 0,
+            # Sheets of the workbook already inserted
+            "sheets": [],
+            "summary": {},
+            "rejected": 0,
+            "stats": [],
+            "metrics": None,
+            "started_at": datetime.now(),
+        }
+        self.save()
+        return self.state
+
+    def open(self, objects, migration_tag):
+        """
+        Resume the load of the objects if it was interrupted, else start it with the migration tag.
+        """
+        return self.resume(objects) or self.start(objects, migration_tag)
+
+    def commit(self, **progress):
+        """
+        Save the progress after a chunk whose documents are inserted.
+        """
+        self.state.update(progress)
+        self.save()
+
+    def save(self):
+        self.state["updated_at"] = datetime.now()
+        self.collection.replace_one({"_id": self.source}, self.state, upsert=True)
+
+    def finish(self):
+        self.collection.delete_one({"_id": self.source})
+        logger.debug(f"Checkpoint of {self.source} deleted")
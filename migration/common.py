@@ -0,0 +1,70 @@
+import json
+import logging
+import multiprocessing
+import os
+from datetime import datetime
+
+import boto3
+
+"""
+Helpers shared by the migration scripts and by the single-process runner (`python -m migration run ...`):
+secrets, S3 and MongoDB clients, migration tag and expected metrics file.
+"""
+
+logger = logging.getLogger(__name__)
+
+bucket_name = 'greencoop-airbyte'
+database_name = "weather_data"
+collection_name = "weather_station"
+
+# Start method of the process pools: the scripts run pymongo and boto3 threads, a forked child could inherit
+# one of their locks held and deadlock, so the workers are forked from a clean server process (spawned on Windows)
+process_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+def upper_case(string):
+    return string.upper()
+
+
+def load_secrets(file_path='secrets.json'):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    full_path = os.path.join(script_dir, file_path)
+    with open(full_path, 'r') as file:
+        return json.load(file)
+
+
+def s3_client(secrets):
+    # An optional S3_ENDPOINT_URL points the scripts to a local S3 stand-in, such as `moto_server`
+    return boto3.client('s3',
+                        aws_access_key_id=secrets['AWS_ACCESS_KEY_ID'],
+                        aws_secret_access_key=secrets['AWS_SECRET_ACCESS_KEY'],
+                        region_name=secrets['AWS_REGION'],
+                        endpoint_url=secrets.get('S3_ENDPOINT_URL'))
+
+
+def weather_collection(client):
+    """
+    The collection every source is migrated into. MongoClient is thread-safe, so one client serves every source.
+    """
+    return client[database_name][collection_name]
+
+
+def make_migration_tag(source):
+    return f"{datetime.now().strftime('%Y-%m-%d_%Hh%M')}_{source}"
+
+
+def data_file_path(file_name):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(script_dir, "..", "tests","test_data")
+
+    # Ensure the directory exists
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, file_name)
+
+
+def write_metrics(metrics, source):
+    file_path = data_file_path(f"expected_{source}_metrics.json")
+
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(metrics, f, indent=4, ensure_ascii=False)
@@ -1,42 +1,216 @@
 import os
-from pymongo import MongoClient, errors
+from contextlib import contextmanager
+from pymongo import ASCENDING, IndexModel, MongoClient
 import argparse
 import json
 import logging
 
-logging.basicConfig(level=logging.INFO)  # You can adjust the logging level (e.g., DEBUG, INFO, ERROR)
-logger = logging.getLogger()
+from bulk_insert import insert_documents, log_insert_summary
+from common import collection_name, database_name
 
-parser = argparse.ArgumentParser(description="Create a mongoDB collection with schema validation. Drop the collection if it already exists.")
-parser.add_argument(
-    "--mongodb_address", 
-    default="mongodb://localhost:27017/", 
-    help="The MongoDB address (default: mongodb://localhost:27017/)"
-)
-args = parser.parse_args()
+logger = logging.getLogger(__name__)
 
-client = MongoClient(args.mongodb_address)
-db = client["weather_data"]
-collection_name = "weather_station"
+# Secondary indexes of the weather collection: the dashboard queries a station over a time range,
+# the verification and the re-runs filter on the migration tag
+indexes = [
+    IndexModel([("station", ASCENDING), ("datetime", ASCENDING)], name="station_datetime"),
+    IndexModel([("migrated", ASCENDING)], name="migrated"),
+]
 
-try:
-    # Drop the collection if it already exists
-    db.drop_collection(collection_name)
-    logger.info(f"Collection '{collection_name}' dropped (if it existed).")
+# Optional partial indexes (--partial_indexes), they only hold the documents matching their filter
+partial_indexes = [
+    # Rainy readings of a station, most readings have no rain
+    IndexModel([("station", ASCENDING), ("datetime", ASCENDING)], name="station_datetime_rain",
+               partialFilterExpression={"precip_rate_mm/hr": {"$gt": 0}}),
+    # InfoClimat readings with a snow depth
+    IndexModel([("datetime", ASCENDING)], name="datetime_snow",
+               partialFilterExpression={"snow_depth_mm": {"$gt": 0}}),
+]
+
+# Time-series storage (MongoDB 6.0+): the readings of a station are stored in compressed buckets keyed by the station,
+# readings are every 5 minutes (Weather Underground) or every hour (InfoClimat)
+timeseries_options = {"timeField": "datetime", "metaField": "station", "granularity": "minutes"}
+
+# Name the plain collection is renamed to when it is converted into a time-series collection
+plain_collection_name = f"{collection_name}_plain"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Create a mongoDB collection with schema validation. Drop the collection if it already exists.")
+    parser.add_argument(
+        "--mongodb_address",
+        default="mongodb://localhost:27017/",
+        help="The MongoDB address (default: mongodb://localhost:27017/)"
+    )
+
+    parser.add_argument(
+        "--partial_indexes",
+        action="store_true",
+        help="Also create the optional partial indexes"
+    )
+
+    parser.add_argument(
+        "--indexes_only",
+        action="store_true",
+        help="Do not drop the collection, only create the missing indexes"
+    )
 
+    parser.add_argument(
+        "--timeseries",
+        action="store_true",
+        help="Create a time-series collection (timeField datetime, metaField station), MongoDB 6.0+"
+    )
+
+    parser.add_argument(
+        "--from_existing",
+        action="store_true",
+        help=f"With --timeseries, copy the documents of the existing collection, kept as '{plain_collection_name}'"
+    )
+    return parser.parse_args(argv)
+
+
+def load_schema():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     schema_path = os.path.join(script_dir, 'schema.json')
     # Load schema from schema.json
     with open(schema_path, 'r', encoding='utf-8') as schema_file:
-        validation_schema = json.load(schema_file)
+        return json.load(schema_file)
+
+
+def index_names(models):
+    return [model.document["name"] for model in models]
+
+
+def ensure_indexes(collection, partial=False):
+    """
+    Create the indexes of the plan that are missing (creating an existing index is a no-op).
+    """
+    models = indexes + partial_indexes if partial else indexes
+    collection.create_indexes(models)
+    logger.info(f"Indexes of '{collection.name}': {index_names(models)}")
+
+
+# Indexes kept during a bulk load: the duplicate checks (dedup.py, and the insert_new mode of the time-series
+# collections) look up every batch by station and datetime range
+kept_indexes = ["station_datetime"]
+
+
+class DeferredIndexes:
+    """
+    The work to run once the deferred indexes are rebuilt, such as the rollups that match on the migration tag.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def after(self, callback):
+        self.callbacks.append(callback)
+
+
+@contextmanager
+def deferred_indexes(collection):
+    """
+    Bulk-load mode: drop the secondary indexes of the plan (but kept_indexes), so the inserts do not maintain them,
+    and build them once after the load, even if it failed. The partial indexes are rebuilt if they existed.
+    Yields a DeferredIndexes, whose callbacks run after the rebuild of a successful load.
+    """
+    existing = collection.index_information()
+    dropped = [name for name in index_names(indexes + partial_indexes) if name in existing and name not in kept_indexes]
+    for name in dropped:
+        collection.drop_index(name)
+    logger.info(f"Indexes deferred during the load: {dropped}")
+    deferred = DeferredIndexes()
+    try:
+        yield deferred
+    finally:
+        rebuilt = indexes + [model for model in partial_indexes if model.document["name"] in dropped]
+        collection.create_indexes(rebuilt)
+        logger.info(f"Indexes rebuilt after the load: {index_names(rebuilt)}")
+    for callback in deferred.callbacks:
+        callback()
+
+
+def is_timeseries(collection):
+    return "timeseries" in collection.options()
+
+
+def write_mode(collection, mode):
+    """
+    The insert mode to use with the collection. A time-series collection has no unique index on _id,
+    so in insert mode the documents already stored are skipped ("insert_new", see bulk_insert.insert_new_chunk),
+    and its documents cannot be replaced, so the upsert mode is rejected.
+    """
+    if not is_timeseries(collection):
+        return mode
+    if mode == "upsert":
+        raise ValueError(f"The upsert mode is not supported by the time-series collection '{collection.name}'")
+    return "insert_new"
+
+
+def create_collection(client, partial=False, timeseries=False):
+    """
+    Drop the weather collection and create it again with the schema validation and the indexes of the plan,
+    using an existing MongoClient. With timeseries, the collection is a time-series collection, without
+    a validator: the rows are only checked against schema.json client-side (see schema_check.py).
+    A failure is raised, so a migration never starts without its collection.
+    """
+    db = client[database_name]
+    # Drop the collection if it already exists
+    db.drop_collection(collection_name)
+    logger.info(f"Collection '{collection_name}' dropped (if it existed).")
+
+    if timeseries:
+        # Time-series collections do not support schema validators
+        db.create_collection(collection_name, timeseries=timeseries_options)
+        logger.info(f"Collection '{collection_name}' created as a time-series collection, without schema validation.")
+    else:
+        # Create the collection with schema validation
+        db.create_collection(
+            collection_name,
+            validator=load_schema(),
+            validationLevel="moderate",  # accept but file a warning, "strict" for full enforcement
+        )
+        logger.info(f"Collection '{collection_name}' created with schema validation.")
+
+    ensure_indexes(db[collection_name], partial)
+
+
+def convert_to_timeseries(client, mongodb_address, partial=False, chunk_size=5000, workers=4):
+    """
+    Rename the plain weather collection to plain_collection_name, create the time-series collection
+    and copy the documents, sorted by station and datetime so that they fill the buckets in order.
+    The plain collection is kept, it can be dropped once the verification tests pass on the new one.
+    If the time-series collection can not be created, the plain collection is renamed back.
+    """
+    db = client[database_name]
+    db[collection_name].rename(plain_collection_name)
+    logger.info(f"Collection '{collection_name}' renamed to '{plain_collection_name}'")
+    try:
+        create_collection(client, partial, timeseries=True)
+    except Exception:
+        db.drop_collection(collection_name)
+        db[plain_collection_name].rename(collection_name)
+        logger.error(f"Collection '{plain_collection_name}' renamed back to '{collection_name}'")
+        raise
+
+    documents = db[plain_collection_name].find({}, sort=[("station", ASCENDING), ("datetime", ASCENDING)],
+                                               batch_size=chunk_size)
+    summary = insert_documents(db[collection_name], documents, chunk_size, workers)
+    log_insert_summary(summary, mongodb_address)
+    return summary
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)  # You can adjust the logging level (e.g., DEBUG, INFO, ERROR)
+    args = parse_args(argv)
+    client = MongoClient(args.mongodb_address)
+    if args.indexes_only:
+        ensure_indexes(client[database_name][collection_name], args.partial_indexes)
+    elif args.timeseries and args.from_existing:
+        convert_to_timeseries(client, args.mongodb_address, args.partial_indexes)
+    else:
+        create_collection(client, args.partial_indexes, args.timeseries)
 
-    # Create the collection with schema validation
-    db.create_collection(
-        collection_name,
-        validator=validation_schema,
-        validationLevel="moderate"  # accept but file a warning, "strict" for full enforcement
-    )
 
-    logger.info(f"Collection '{collection_name}' created with schema validation.")
-except errors.PyMongoError as e:
-    logger.error(f"An error occurred: {e}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import logging
+import math
+from collections import Counter
+
+import numpy as np
+
+"""
+Client-side duplicate filtering, before the documents are encoded and sent.
+Two kinds of duplicates are skipped instead of coming back as code-11000 errors:
+- the _ids met earlier in the same load (InfoClimat records overlap across Airbyte partitions),
+- the _ids already stored, prefetched once per batch for its stations and time range with an `_id` projection.
+Up to `set_limit` stored _ids are kept in a set. Above, they go into a Bloom filter and only the _ids it
+reports are checked exactly, with an `_id: {$in: ...}` query covered by the _id index.
+The prefetch walks the `station_datetime` index, which does not hold the _id: the documents of the range are fetched
+(only their _id is sent back). Adding _id to the index would cover it, at the cost of a larger index on every insert
+and of rebuilding the index of the existing collections, so the prefetch stays a fetch bounded by the batch range.
+The _ids of the load are kept in a set up to `seen_limit`, then moved to a Bloom filter; the _ids it reports are
+checked against the collection (an earlier one was inserted by then), the others are sent and an unconfirmed
+duplicate comes back as a code-11000 error, as without the filter.
+In upsert mode the stored documents are re-tagged or replaced, so only the duplicates within the load are skipped.
+A resumed load (see checkpoint.py) does not skip the documents of its own migration tag: those of the chunk in flight
+when it stopped are sent again, come back as duplicates and are counted once in the metrics.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Stored _ids kept in a set (about 100 bytes each), above a Bloom filter is used
+set_limit = 2_000_000
+
+# False positive rate of the Bloom filter, its positives are checked against the collection
+bloom_error_rate = 0.001
+
+# _ids of the load kept in a set, the older ones are moved to Bloom filters of this capacity
+seen_limit = 1_000_000
+
+
+def mix(values):
+    # splitmix64 finalizer, spreads the bits of every uint64
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class BloomFilter:
+    """
+    Bloom filter of ObjectIds: an _id it does not contain is certainly not stored, the others may be.
+    """
+
+    def __init__(self, capacity, error_rate=bloom_error_rate):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def positions(self, ids):
+        words = np.frombuffer(b"".join(_id.binary for _id in ids), dtype="<u4").reshape(-1, 3).astype(np.uint64)
+        first = mix(mix(words[:, 0] | (words[:, 1] << np.uint64(32))) ^ words[:, 2])
+        second = mix(first ^ np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+        # Double hashing: the i-th position is first + i * second
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        return (first[:, None] + steps * second[:, None]) % np.uint64(self.size)
+
+    def add(self, ids):
+        if len(ids):
+            positions = self.positions(ids)
+            masks = np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3), masks)
+
+    def contains(self, ids):
+        if not len(ids):
+            return np.zeros(0, dtype=bool)
+        positions = self.positions(ids)
+        bits = self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8) & 1
+        return bits.all(axis=1)
+
+
+class Deduplicator:
+    """
+    Drop the duplicate rows of the frames of one load, and count them in `counts`:
+    `skipped_in_load` (an _id already met in the load) and `skipped_stored` (an _id already in the collection).
+    """
+
+    def __init__(self, collection, mode="insert", set_limit=set_limit, seen_limit=seen_limit):
+        self.collection = collection
+        self.stored = mode != "upsert"
+        self.set_limit = set_limit
+        self.seen_limit = seen_limit
+        self.seen = set()
+        self.seen_blooms = []
+        self.counts = Counter()
+        # Migration tag of the interrupted load being resumed
+        self.resumed_tag = None
+
+    def stored_mask(self, df):
+        """
+        Mask of the rows of the frame whose _id is stored, the stored _ids of its stations and time range are fetched.
+        """
+        datetimes = df["datetime"].dropna()
+        if datetimes.empty:
+            return np.zeros(len(df), dtype=bool)
+        query = {"station": {"$in": df["station"].dropna().unique().tolist()},
+                 "datetime": {"$gte": datetimes.min().to_pydatetime(), "$lte": datetimes.max().to_pydatetime()}}
+        if self.resumed_tag is not None:
+            query["migrated"] = {"$ne": self.resumed_tag}
+        ids = df["_id"].to_numpy(dtype=object)
+        count = self.collection.count_documents(query)
+        if count == 0:
+            return np.zeros(len(df), dtype=bool)
+        if count <= self.set_limit:
+            stored = {document["_id"] for document in self.collection.find(query, {"_id": 1})}
+            return np.fromiter((_id in stored for _id in ids), dtype=bool, count=len(ids))
+
+        bloom = BloomFilter(count)
+        batch = []
+        for document in self.collection.find(query, {"_id": 1}):
+            batch.append(document["_id"])
+            if len(batch) == 100_000:
+                bloom.add(batch)
+                batch = []
+        bloom.add(batch)
+        candidates = bloom.contains(ids)
+        # Only the positives of the filter are checked, the query is covered by the _id index
+        exact = {"_id": {"$in": ids[candidates].tolist()}}
+        if self.resumed_tag is not None:
+            exact["migrated"] = query["migrated"]
+        confirmed = {document["_id"] for document in self.collection.find(exact, {"_id": 1})}
+        logger.debug(f"{count} stored _ids in a Bloom filter, {candidates.sum()} candidates, {len(confirmed)} stored")
+        return np.fromiter((_id in confirmed for _id in ids), dtype=bool, count=len(ids))
+
+    def seen_mask(self, ids):
+        """
+        Mask of the _ids met earlier in the load: in the set, or reported by a Bloom filter and stored.
+        """
+        seen = np.fromiter((_id in self.seen for _id in ids), dtype=bool, count=len(ids))
+        if not self.seen_blooms:
+            return seen
+        candidates = np.zeros(len(ids), dtype=bool)
+        for bloom in self.seen_blooms:
+            candidates |= bloom.contains(ids)
+        candidates &= ~seen
+        if candidates.any():
+            confirmed = {document["_id"] for document in
+                         self.collection.find({"_id": {"$in": ids[candidates].tolist()}}, {"_id": 1})}
+            seen |= np.fromiter((_id in confirmed for _id in ids), dtype=bool, count=len(ids))
+        return seen
+
+    def remember(self, ids):
+        self.seen.update(ids)
+        if len(self.seen) > self.seen_limit:
+            bloom = BloomFilter(len(self.seen))
+            bloom.add(list(self.seen))
+            self.seen_blooms.append(bloom)
+            self.seen = set()
+            logger.debug(f"_ids of the load moved to Bloom filter {len(self.seen_blooms)}")
+
+    def filter(self, df):
+        """
+        Returns the rows of the frame that are neither a duplicate within the load nor already stored.
+        """
+        if df.empty:
+            return df
+        ids = df["_id"].to_numpy(dtype=object)
+        in_load = df["_id"].duplicated().to_numpy() | self.seen_mask(ids)
+        stored = self.stored_mask(df) & ~in_load if self.stored else np.zeros(len(df), dtype=bool)
+        self.remember(ids[~in_load])
+        self.counts["skipped_in_load"] += int(in_load.sum())
+        self.counts["skipped_stored"] += int(stored.sum())
+        if in_load.any() or stored.any():
+            logger.info(f"{in_load.sum()} duplicate _ids within the load and {stored.sum()} already stored skipped")
+            return df[~(in_load | stored)]
+        return df
@@ -0,0 +1,307 @@
+import argparse
+import io
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pymongo import ASCENDING, DESCENDING, MongoClient
+
+from common import bucket_name, database_name, load_secrets, s3_client, upper_case, weather_collection
+from create_collection import load_schema
+from instrument import StageTimer
+from pipeline import Pipeline, Step
+from s3_source import part_ranges, part_size
+
+"""
+Export of the weather collection back to S3, as Parquet files partitioned Hive-style by station and date:
+exports/weather_station/station=<station>/date=<YYYY-MM-DD>/<export tag>.parquet (month=<YYYY-MM> with --period month).
+The collection is read once, sorted on the station_datetime index, with large cursor batches and a projection
+on the fields of schema.json, so only one partition at a time is held. The partitions are encoded and uploaded
+by a pipeline (see pipeline.py), a file larger than `part_size` goes up in a multipart upload whose parts are sent
+concurrently. The station is in the path and not in the files; the numbers are doubles (a value that is not a number
+is null), the dates UTC timestamps and the _id its hex string.
+Every export is recorded in the `export_manifest` collection, with the migration tags and the last datetime it holds.
+An incremental export takes either the migration tags not exported yet (--incremental tag, run it after the
+migrations, not during one) or the readings after the last exported datetime (--incremental datetime, which misses
+the readings loaded later for an older period). If an export fails, the files it uploaded are deleted.
+"""
+
+logger = logging.getLogger(__name__)
+
+export_prefix = "exports/weather_station/"
+export_manifest_name = "export_manifest"
+
+# Documents per getMore of the cursor
+cursor_batch_size = 10_000
+
+# Files encoded and uploaded at the same time
+upload_workers = 4
+
+# Parts of one multipart upload sent at the same time
+part_workers = 4
+
+# Fields exported besides those of schema.json
+extra_fields = ["migrated"]
+
+
+def export_manifest(client):
+    return client[database_name][export_manifest_name]
+
+
+def export_schema(schema=None):
+    """
+    The Arrow schema of the exported files: the fields of schema.json (but the station) and the migration tag.
+    """
+    properties = (schema or load_schema())["$jsonSchema"]["properties"]
+    fields = []
+    for name, rule in properties.items():
+        types = rule["bsonType"] if isinstance(rule["bsonType"], list) else [rule["bsonType"]]
+        if name == "station":
+            continue
+        if "int" in types or "double" in types:
+            fields.append(pa.field(name, pa.float64()))
+        elif "date" in types:
+            fields.append(pa.field(name, pa.timestamp("ms", tz="UTC")))
+        else:
+            fields.append(pa.field(name, pa.string()))
+    fields.extend(pa.field(name, pa.string()) for name in extra_fields)
+    return pa.schema(fields)
+
+
+def column_array(values, data_type):
+    if pa.types.is_floating(data_type):
+        return pa.array(pd.to_numeric(pd.Series(values, dtype=object), errors="coerce"), type=data_type,
+                        from_pandas=True)
+    if pa.types.is_timestamp(data_type):
+        return pa.array(values, type=data_type)
+    return pa.array([None if value is None else str(value) for value in values], type=data_type)
+
+
+def to_table(documents, schema):
+    columns = [column_array([document.get(field.name) for document in documents], field.type) for field in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def partition_value(date, period):
+    return date.strftime("%Y-%m-%d") if period == "day" else date.strftime("%Y-%m")
+
+
+def partition_key(prefix, station, date, period, export_tag):
+    # Hive partitions, the station is URI-encoded like pyarrow decodes it
+    name = "date" if period == "day" else "month"
+    return f"{prefix}station={quote(station, safe='')}/{name}={date}/{export_tag}.parquet"
+
+
+def partitions(cursor, period):
+    """
+    Group the documents of a cursor sorted by station and datetime into (station, date, documents).
+    """
+    current = None
+    documents = []
+    for document in cursor:
+        key = (document["station"], partition_value(document["datetime"], period))
+        if key != current and documents:
+            yield (*current, documents)
+            documents = []
+        current = key
+        documents.append(document)
+    if documents:
+        yield (*current, documents)
+
+
+def upload_object(s3, key, content, bucket=bucket_name, part_size=part_size, workers=part_workers):
+    """
+    Upload the content with a single PUT, or in a multipart upload of `part_size` parts above it.
+    A failed multipart upload is aborted, S3 would otherwise keep (and bill) its parts.
+    """
+    if len(content) <= part_size:
+        s3.put_object(Bucket=bucket, Key=key, Body=content)
+        return
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    view = memoryview(content)
+
+    def upload_part(number, part):
+        start, end = part
+        response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                  Body=view[start:end + 1].tobytes())
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(upload_part, number, part)
+                       for number, part in enumerate(part_ranges(len(content), part_size), 1)]
+            parts = [future.result() for future in futures]
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    logger.debug(f"Uploaded {key} ({len(content)} bytes in {len(parts)} parts)")
+
+
+def delete_objects(s3, keys, bucket=bucket_name):
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]]})
+
+
+def export_query(collection, manifest, incremental):
+    """
+    The filter of the documents to export, None if an incremental export has nothing new.
+    """
+    if incremental is None:
+        return {}
+    if incremental == "tag":
+        exported = set(manifest.distinct("tags"))
+        tags = sorted(set(collection.distinct("migrated")) - exported)
+        logger.info(f"Migration tags not exported yet: {tags}")
+        return {"migrated": {"$in": tags}} if tags else None
+    last = manifest.find_one({"watermark": {"$ne": None}}, sort=[("watermark", DESCENDING)])
+    if last is None:
+        return {}
+    logger.info(f"Exporting the readings after {last['watermark']}")
+    return {"datetime": {"$gt": last["watermark"]}}
+
+
+def export(collection, manifest, s3, incremental=None, period="day", compression="zstd", prefix=export_prefix,
+           batch_size=cursor_batch_size, workers=upload_workers, bucket=bucket_name, part_size=part_size,
+           timer=None):
+    """
+    Export the documents to Parquet on S3 and record the export, returns its manifest entry (None if nothing new).
+    """
+    start = time.perf_counter()
+    timer = timer or StageTimer("export")
+    query = export_query(collection, manifest, incremental)
+    if query is None:
+        logger.info("Nothing to export")
+        return None
+    # Two exports within a second get distinct tags, their files never overwrite each other
+    export_tag = f"{datetime.now().strftime('%Y-%m-%d_%Hh%M%S')}_export_{uuid.uuid4().hex[:8]}"
+    schema = export_schema()
+    projection = {field.name: 1 for field in schema}
+    projection["station"] = 1
+    cursor = collection.find(query, projection, batch_size=batch_size).sort([("station", ASCENDING),
+                                                                              ("datetime", ASCENDING)])
+    tags = set()
+    watermarks = []
+    uploaded = []
+
+    def encode(partition):
+        station, date, documents = partition
+        with timer.stage("encode", rows_in=len(documents)) as stage:
+            tags.update(document.get("migrated") for document in documents)
+            watermarks.append(documents[-1]["datetime"])
+            sink = io.BytesIO()
+            pq.write_table(to_table(documents, schema), sink, compression=compression)
+            stage.bytes_out = sink.tell()
+        return partition_key(prefix, station, date, period, export_tag), len(documents), sink.getvalue()
+
+    def upload(file):
+        key, rows, content = file
+        with timer.stage("upload", rows_in=rows, bytes_in=len(content)):
+            upload_object(s3, key, content, bucket, part_size)
+        uploaded.append(key)
+        return key, rows, len(content)
+
+    steps = [Step("encode", encode, workers=max(1, workers // 2)), Step("upload", upload, workers=workers)]
+    try:
+        files = Pipeline(steps).run(partitions(cursor, period))
+    except Exception:
+        logger.error(f"Export {export_tag} failed, deleting its {len(uploaded)} files")
+        delete_objects(s3, uploaded, bucket)
+        raise
+
+    if not files:
+        logger.info("Nothing to export")
+        return None
+    entry = {
+        "_id": export_tag,
+        "incremental": incremental,
+        "period": period,
+        "prefix": prefix,
+        "tags": sorted(tag for tag in tags if tag is not None),
+        "watermark": max(watermarks),
+        "files": len(files),
+        "rows": sum(rows for _, rows, _ in files),
+        "bytes": sum(size for _, _, size in files),
+        "exported_at": datetime.now(),
+    }
+    manifest.insert_one(entry)
+    seconds = time.perf_counter() - start
+    logger.info(f"Export {export_tag}: {entry['rows']} documents in {entry['files']} files ({entry['bytes']} bytes) "
+                f"under s3://{bucket}/{prefix} in {seconds:.2f}s ({entry['rows'] / seconds:.0f} documents/s)")
+    timer.log_summary()
+    return entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the weather collection to Parquet files on S3")
+    parser.add_argument(
+        "--mongodb_address",
+        default="mongodb://localhost:27017/",
+        help="The MongoDB address (default: mongodb://localhost:27017/)"
+    )
+
+    parser.add_argument(
+        "-v", "--verbosity",
+        type=upper_case,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging verbosity level (default: INFO)"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        default=None,
+        choices=["tag", "datetime"],
+        help="Only export the migration tags not exported yet, or the readings after the last exported datetime"
+    )
+
+    parser.add_argument(
+        "--period",
+        default="day",
+        choices=["day", "month"],
+        help="Partition the files of a station by day or by month (default: day)"
+    )
+
+    parser.add_argument(
+        "--compression",
+        default="zstd",
+        choices=["zstd", "snappy", "gzip", "none"],
+        help="Parquet compression codec (default: zstd)"
+    )
+
+    parser.add_argument(
+        "--prefix",
+        default=export_prefix,
+        help=f"S3 prefix of the exported files (default: {export_prefix})"
+    )
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=cursor_batch_size,
+        help=f"Number of documents per cursor batch (default: {cursor_batch_size})"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=upload_workers,
+        help=f"Number of threads uploading the files (default: {upload_workers})"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=getattr(logging, args.verbosity))
+    s3 = s3_client(load_secrets('secrets.json'))
+    client = MongoClient(args.mongodb_address)
+    export(weather_collection(client), export_manifest(client), s3, args.incremental, args.period,
+           args.compression, args.prefix, args.batch_size, args.workers)
+
+
+if __name__ == "__main__":
+    main()
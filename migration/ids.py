@@ -0,0 +1,97 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+
+from common import process_context
+
+"""
+Deterministic `_id` shared by the migration scripts.
+The `_id` of a reading is the first 12 bytes of md5(str(datetime) + station), so running a migration
+again gives the same ObjectIds and MongoDB rejects the readings that are already stored.
+"""
+
+# Above this number of rows, the hashing is spread over a process pool
+parallel_threshold = 1_000_000
+
+
+# Function to generate ObjectId from a unique key
+def generate_objectid(unique_str):
+    hash_hex = hashlib.md5(unique_str.encode()).hexdigest()[:24]  # Ensure 24 chars
+    return ObjectId(hash_hex)
+
+
+def _put_digits(buffer, start, width, numbers):
+    # Write the numbers as zero-padded ASCII digits in the columns start..start+width of the buffer
+    for position in range(width):
+        buffer[:, start + width - 1 - position] = ord("0") + numbers // 10 ** position % 10
+
+
+def datetime_keys(datetimes):
+    """
+    str() of every datetime of the column as utf-8 bytes, as used in the unique key (b'2024-10-01 00:04:00').
+    """
+    values = pd.Series(datetimes).to_numpy(dtype="datetime64[ns]")
+    seconds = values.astype("datetime64[s]")
+    days = seconds.astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    second_of_day = (seconds - days).astype("int64")
+
+    # Build the 19 bytes of every key in one array: YYYY-MM-DD HH:MM:SS
+    buffer = np.empty((len(values), 19), dtype=np.uint8)
+    buffer[:, [4, 7]] = ord("-")
+    buffer[:, 10] = ord(" ")
+    buffer[:, [13, 16]] = ord(":")
+    _put_digits(buffer, 0, 4, months.astype("datetime64[Y]").astype("int64") + 1970)
+    _put_digits(buffer, 5, 2, months.astype("int64") % 12 + 1)
+    _put_digits(buffer, 8, 2, (days - months).astype("int64") + 1)
+    _put_digits(buffer, 11, 2, second_of_day // 3600)
+    _put_digits(buffer, 14, 2, second_of_day // 60 % 60)
+    _put_digits(buffer, 17, 2, second_of_day % 60)
+    keys = buffer.view("S19").ravel().tolist()
+
+    # str() adds the fractional part of the second when there is one, and gives 'NaT' for a missing datetime
+    special = np.flatnonzero(np.isnat(values) | (values.astype("int64") % 1_000_000_000 != 0))
+    for i in special:
+        keys[i] = str(pd.Timestamp(values[i])).encode()
+    return keys
+
+
+def _digests(keys, stations):
+    # md5 is the only per-row work, the 12 bytes ObjectIds of the chunk are returned as one bytes object
+    md5 = hashlib.md5
+    if isinstance(stations, bytes):
+        return b"".join([md5(key + stations).digest()[:12] for key in keys])
+    return b"".join([md5(key + station).digest()[:12] for key, station in zip(keys, stations)])
+
+
+def generate_objectids(datetimes, stations, processes=None):
+    """
+    Return the list of ObjectIds of whole datetime and station columns, in one pass.
+    `stations` is either a column or a single station name.
+    Gives the same ObjectIds as generate_objectid(str(datetime) + station) row by row.
+    """
+    keys = datetime_keys(datetimes)
+    if isinstance(stations, str):
+        stations = stations.encode()
+    else:
+        stations = [station.encode() for station in stations]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if len(keys) < parallel_threshold or processes < 2:
+        digests = _digests(keys, stations)
+    else:
+        chunk_size = -(-len(keys) // (processes * 4))
+        starts = range(0, len(keys), chunk_size)
+        with ProcessPoolExecutor(max_workers=processes, mp_context=process_context) as executor:
+            digests = b"".join(executor.map(
+                _digests,
+                [keys[i:i + chunk_size] for i in starts],
+                [stations if isinstance(stations, bytes) else stations[i:i + chunk_size] for i in starts],
+            ))
+
+    return list(map(ObjectId, [digests[i:i + 12] for i in range(0, len(digests), 12)]))
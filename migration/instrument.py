@@ -0,0 +1,191 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from common import data_file_path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+"""
+Instrumentation of the migration stages (list, download, parse, transform, ids, metrics, insert...).
+Every stage records its wall time, CPU time, growth of the peak RSS, rows in and out and bytes read or written;
+with trace_memory, the peak of the Python allocations during the stage (tracemalloc, which slows the run down).
+A stage run several times (one per export or batch) adds up. CPU time and memory are those of the process:
+with the runner, the sources run concurrently and their stages overlap.
+The report is written next to expected_<source>_metrics.json, optionally in the Prometheus text format too,
+and with a profile directory the hot stages are profiled with cProfile: the profiles of the runs of a stage
+are added together and written with the report, one .pstats file per stage.
+"""
+
+logger = logging.getLogger(__name__)
+
+default_profile_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "profiles")
+
+# Stages spent in Python code, the ones worth profiling
+hot_stages = {"parse", "transform", "ids", "documents", "metrics"}
+
+# Only one cProfile profiler can be active at a time, concurrent sources profile in turn
+profile_lock = threading.Lock()
+
+counters = ["rows_in", "rows_out", "bytes_in", "bytes_out"]
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stage:
+    """
+    Counters of one run of a stage, set by the code of the stage.
+    """
+
+    def __init__(self, rows_in=None, bytes_in=None):
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_in = bytes_in
+        self.bytes_out = None
+
+
+class StageTimer:
+    def __init__(self, source=None, trace_memory=False, profile_dir=None):
+        self.source = source
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.stages = {}
+        # pstats.Stats of the profiled runs of every hot stage
+        self.profiles = {}
+        self.lock = threading.Lock()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, rows_in=None, bytes_in=None):
+        stage = Stage(rows_in, bytes_in)
+        profiler = None
+        if self.profile_dir is not None and name in hot_stages and profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        rss_before = peak_rss_bytes()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profile_lock.release()
+            record = {
+                "calls": 1,
+                "wall_seconds": time.perf_counter() - wall_start,
+                "cpu_seconds": time.process_time() - cpu_start,
+                "rss_peak_growth_bytes": peak_rss_bytes() - rss_before if rss_before is not None else None,
+            }
+            if self.trace_memory:
+                record["python_peak_bytes"] = tracemalloc.get_traced_memory()[1] - traced_before
+            for counter in counters:
+                record[counter] = getattr(stage, counter)
+            self.add(name, record)
+            if profiler is not None:
+                self.add_profile(profiler, name)
+            logger.debug(f"Stage {name}: {record['wall_seconds']:.3f}s wall, {record['cpu_seconds']:.3f}s CPU")
+
+    def add(self, name, record):
+        with self.lock:
+            total = self.stages.get(name)
+            if total is None:
+                self.stages[name] = record
+                return
+            for key, value in record.items():
+                if value is None:
+                    continue
+                if key in ("rss_peak_growth_bytes", "python_peak_bytes"):
+                    total[key] = max(total[key] or 0, value)
+                else:
+                    total[key] = (total[key] or 0) + value
+
+    def add_profile(self, profiler, name):
+        with self.lock:
+            stats = self.profiles.get(name)
+            if stats is None:
+                self.profiles[name] = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+
+    def dump_profiles(self):
+        """
+        Write the profile of every profiled stage, all its runs added together.
+        """
+        if not self.profiles:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        for name, stats in self.profiles.items():
+            path = os.path.join(self.profile_dir, f"{self.source}_{name}.pstats")
+            stats.dump_stats(path)
+            logger.info(f"Profile of the {name} stage written to {path}")
+
+    def report(self):
+        return {
+            "source": self.source,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "stages": self.stages,
+        }
+
+    def log_summary(self):
+        for name, record in self.stages.items():
+            rows = record["rows_out"] if record["rows_out"] is not None else record["rows_in"]
+            rate = f", {rows / record['wall_seconds']:.0f} rows/s" if rows and record["wall_seconds"] else ""
+            logger.info(f"{name}: {record['wall_seconds']:.2f}s wall, {record['cpu_seconds']:.2f}s CPU{rate}")
+
+
+def prometheus_text(report):
+    """
+    The report in the Prometheus text exposition format, for the node_exporter textfile collector.
+    """
+    lines = []
+    names = ["wall_seconds", "cpu_seconds", "rss_peak_growth_bytes", "python_peak_bytes"] + counters
+    for name in names:
+        samples = [(stage, record[name]) for stage, record in report["stages"].items() if record.get(name) is not None]
+        if not samples:
+            continue
+        lines.append(f"# HELP migration_stage_{name} Migration stage {name.replace('_', ' ')}")
+        lines.append(f"# TYPE migration_stage_{name} gauge")
+        for stage, value in samples:
+            lines.append(f'migration_stage_{name}{{source="{report["source"]}",stage="{stage}"}} {value}')
+    if report["peak_rss_bytes"] is not None:
+        lines.append("# HELP migration_peak_rss_bytes Peak resident set size of the migration process")
+        lines.append("# TYPE migration_peak_rss_bytes gauge")
+        lines.append(f'migration_peak_rss_bytes{{source="{report["source"]}"}} {report["peak_rss_bytes"]}')
+    return "\n".join(lines) + "\n"
+
+
+def write_report(timer, prometheus=False):
+    """
+    Write stages_<source>.json next to the expected metrics file, and stages_<source>.prom with prometheus,
+    and the profiles of the stages.
+    """
+    timer.dump_profiles()
+    report = timer.report()
+    path = data_file_path(f"stages_{timer.source}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    if prometheus:
+        with open(data_file_path(f"stages_{timer.source}.prom"), 'w', encoding='utf-8') as f:
+            f.write(prometheus_text(report))
+    logger.info(f"Stage report written to {path}")
+    return report
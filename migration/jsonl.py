@@ -1,331 +1,863 @@
 import sys
-import boto3
 import json
-import pandas as pd
-from io import BytesIO
 import argparse
 import logging
-from pymongo import MongoClient, errors
-from bson import ObjectId
-from datetime import datetime
-import hashlib
-import copy
-import statistics
 import os
-
-parser = argparse.ArgumentParser(description="Process an Excel file")
-parser.add_argument(
-    'file',
-    default='InfoClimat',
-    help='The name of the station to process. Only accepts InfoClimat'
-)
-
-parser.add_argument(
-    "--mongodb_address", 
-    default="mongodb://localhost:27017/", 
-    help="The MongoDB address (default: mongodb://localhost:27017/)"
-)
-
-def upper_case(string):
-    return string.upper()
-parser.add_argument(
-    "-v", "--verbosity",
-    type=upper_case,
-    default="INFO", 
-    choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
-    help="Set the logging verbosity level (default: INFO)"
-)
-args = parser.parse_args()
-
-log_level = getattr(logging, args.verbosity)
-logging.basicConfig(level=log_level)
-logger = logging.getLogger(__name__)
-
-def load_secrets(file_path):
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    full_path = os.path.join(script_dir, file_path)
-    with open(full_path, 'r') as file:
-        return json.load(file)
-secrets = load_secrets('secrets.json')
-
-aws_access_key_id = secrets['AWS_ACCESS_KEY_ID']
-aws_secret_access_key = secrets['AWS_SECRET_ACCESS_KEY']
-aws_region = secrets['AWS_REGION']
-
-s3 = boto3.client('s3', 
-                  aws_access_key_id=aws_access_key_id, 
-                  aws_secret_access_key=aws_secret_access_key, 
-                  region_name=aws_region)
-
-mongodb_address = args.mongodb_address
-# After parsing arguments
-logger.info(f"Station: {args.file}")  
-logger.info(f"MongoDB adress: {mongodb_address}")  # Debug lines to check the parsed arguments
-
-if not args.file:
-    args.file = ['InfoClimat']
-
-if args.file == 'InfoClimat':
-    file_key = "greencoop-airbyte/Stations_meteorologiques_du_reseau_InfoClimat_(Bergues,_Hazebrouck,_Armentieres,_Lille-Lesquin)/2025_03_14_1741977939508_0.jsonl"
-
-bucket_name = 'greencoop-airbyte'
-s3_object = s3.get_object(Bucket=bucket_name, Key=file_key)
-file_content = s3_object['Body'].read().decode('utf-8')
-
-
-# Read the JSONL file from S3
-response = s3.get_object(Bucket=bucket_name, Key=file_key)
-content = response["Body"].read().decode("utf-8")
-
-# Convert JSONL to Pandas DataFrame
-json_list = [json.loads(line) for line in content.splitlines()]
-df = pd.DataFrame(json_list)
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import date
+from itertools import chain
 
 import pandas as pd
-from pandas import json_normalize
-
-# Assuming `df_clean` is the output of json_normalize
-df_clean = pd.json_normalize(df["_airbyte_data"])
-
-# Expand the 'stations' field
-stations_df = pd.json_normalize(df_clean["stations"].explode())
-
-# Expand the 'hourly' fields
-hourly_dfs = {}
-hourly_cols = [col for col in df_clean.columns if col.startswith("hourly.")]
-for col in hourly_cols:
-    hourly_dfs[col] = pd.json_normalize(df_clean[col].explode())
-
-data_to_insert = df_clean.to_dict(orient="records")
-
-# ✅ 1. Connect to MongoDB
-client = MongoClient(mongodb_address)  # Update if needed
-db = client["weather_data"]  # Your database name
-collection = db["weather_station"]  # Collection name
+from pymongo import MongoClient
+
+from bson_sink import frame_to_raw_documents
+from bulk_insert import chunked, insert_documents, log_insert_summary
+from cache import FrameCache, default_cache_dir, default_max_bytes
+from checkpoint import Checkpoint, checkpoint_collection, stats_dict, stats_list
+from common import (bucket_name, load_secrets, make_migration_tag, process_context, s3_client, upper_case,
+                    weather_collection, write_metrics)
+from create_collection import deferred_indexes, write_mode
+from dedup import Deduplicator
+from ids import generate_objectids
+from instrument import StageTimer, default_profile_dir, write_report
+from manifest import changed_objects, manifest_collection, record_objects, source_watermark
+from metrics import MetricsAccumulator
+from pipeline import Pipeline, Step, default_queue_size
+from rollups import rollup_collection, schedule_rollups
+from schema_check import SchemaCheck, open_quarantine, quarantine
+from s3_source import download_objects, select_objects
+
+"""
+This script reads the InfoClimat Airbyte export (JSONL) from an S3 bucket, processes it, and inserts the data into a MongoDB collection.
+The script can be run with the following command:
+```
+python jsonl.py InfoClimat [--stream] [--batch_size 5000]
+```
+With `--stream`, the S3 body is read line by line and the documents are sent to MongoDB in batches of `--batch_size`,
+so the memory used depends on the batch size and not on the size of the S3 object.
+Every mode migrates every line of an export, one Airbyte record each (the original script only took the first one).
+The exports are found by listing the bucket (see s3_source.py): by default the most recent one is migrated,
+`--since`, `--until` and `--latest` select other syncs.
+Migrated exports are recorded in the migration_manifest collection: `--incremental` skips the unchanged ones
+and `--new_records_only` ingests only the records newer than the last `_airbyte_emitted_at` migrated.
+With `--pipeline`, the next export is downloaded while the current one is parsed and the previous one inserted.
+With `--resume`, the exports are streamed and the progress is saved after every batch (see checkpoint.py):
+an interrupted run started again with `--resume` goes on from the last batch inserted.
+"""
 
+logger = logging.getLogger(__name__)
 
-# ✅ 2. Load the JSON data (assuming it's in a file or a variable)
-weather_data = data_to_insert
-
-# ✅ 3. Extract Relevant Data
-stations = weather_data[0].get("stations", [])  # Extract station metadata
-hourly_data = {
-    key: weather_data[0][key]
-    for key in weather_data[0]
-    if key.startswith("hourly.") and key != "hourly._params"
+# Key pattern of the Airbyte exports of every source, a new sync is picked up without code change
+file_patterns = {
+    'InfoClimat': "greencoop-airbyte/Stations_meteorologiques_du_reseau_InfoClimat_(Bergues,_Hazebrouck,_Armentieres,_Lille-Lesquin)/*.jsonl",
 }
 
-# ✅ 4. Flatten Hourly Data
-flattened_data = []
-for station_id, records in hourly_data.items():
-    for record in records:
-        flattened_data.append(record)  # Convert list of dicts into single list
-
-
-Id_to_station = {station['id']: station['name'] for station in data_to_insert[0]["stations"]}
-for doc in flattened_data:
-    doc['station'] = Id_to_station.get(doc['id_station'], 'Unknown')
-
-
-def process_data(document):
-    document = copy.deepcopy(document)
-    # Convert strings to appropriate types
-    document['dh_utc'] = datetime.strptime(document['dh_utc'], '%Y-%m-%d %H:%M:%S')  # Convert to datetime, must start as str
-    # Ensure all fields are converted properly, handling missing keys
-    document['temperature'] = float(document['temperature']) if document.get('temperature') else None
-    document['pression'] = float(document['pression']) if document.get('pression') else None
-    document['humidite'] = int(document['humidite']) if document.get('humidite') else None
-    document['point_de_rosee'] = float(document['point_de_rosee']) if document.get('point_de_rosee') else None
-    document['visibilite'] = int(document.get('visibilite', 0)) if document.get('visibilite') else None
-    document['vent_moyen'] = float(document['vent_moyen']) if document.get('vent_moyen') else None
-    document['vent_rafales'] = float(document['vent_rafales']) if document.get('vent_rafales') else None
-    document['vent_direction'] = int(document['vent_direction']) if document.get('vent_direction') else None
-    document['pluie_3h'] = float(document['pluie_3h']) if document.get('pluie_3h') else None
-    document['pluie_1h'] = float(document['pluie_1h']) if document.get('pluie_1h') else None
-    document['neige_au_sol'] = float(document.get('neige_au_sol', 0)) if document.get('neige_au_sol') else None
-    document['nebulosite'] = str(document.get('nebulosite', '')) if document.get('nebulosite') else ''
-    document['temps_omm'] = float(document.get('temps_omm', 0)) if document.get('temps_omm') else None
-    
-
-    return document
-
-
-def process_data2(document):
-    # Define a mapping of fields to their conversion functions
-    conversion_map = {
-        'dh_utc': lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S') if x else None,
-        'temperature': lambda x: float(x) if x else None,
-        'pression': lambda x: float(x) if x else None,
-        'humidite': lambda x: int(x) if x else None,
-        'point_de_rosee': lambda x: float(x) if x else None,
-        'visibilite': lambda x: int(x) if x else None,
-        'vent_moyen': lambda x: float(x) if x else None,
-        'vent_rafales': lambda x: float(x) if x else None,
-        'vent_direction': lambda x: int(x) if x else None,
-        'pluie_3h': lambda x: float(x) if x else None,
-        'pluie_1h': lambda x: float(x) if x else None,
-        'neige_au_sol': lambda x: float(x) if x else None,
-        'nebulosite': lambda x: str(x) if x else '',
-        'temps_omm': lambda x: float(x) if x else None
-    }
-
-    # Use deepcopy to avoid mutating the original document
-    document = copy.deepcopy(document)
-
-    # Loop over the conversion map and apply the transformation if the field exists in the document
-    for field, conversion_func in conversion_map.items():
-        if field in document:
-            document[field] = conversion_func(document[field])
-
-    return document
-
-
-def rename_columns(document):
-    # Column renaming and translation mapping
-    column_mapping = {
-        'dh_utc': 'datetime',
-        'temperature': 'temperature_°C',  # In Celsius
-        'pression': 'pressure_hPa',  # In hPa
-        'humidite': 'humidity_%',
-        'point_de_rosee': 'dew_point_°C',  # In Celsius
-        'visibilite': 'visibility_m',  # Assuming meters for visibility
-        'vent_moyen': 'wind_speed_kph',  # In km/h
-        'vent_rafales': 'wind_gust_kph',  # In km/h
-        'vent_direction': 'wind_dir',  # Wind direction (unchanged)
-        'pluie_3h': 'precip_rate_mm/hr (3hrs)',  # In mm/hr
-        'pluie_1h': 'precip_rate_mm/hr',  # In mm/hr
-        'neige_au_sol': 'snow_depth_mm',  # In mm
-        'nebulosite': 'cloud_coverage',  # General cloud coverage (string or percentage)
-        'temps_omm': 'solar_w/m²'  # Assuming temperature is related to solar irradiance
-    }
-
-    # Rename keys based on the mapping
-    for old_key, new_key in column_mapping.items():
-        if old_key in document:
-            document[new_key] = document.pop(old_key)
-
-    return document
-
-
-# ✅ 5.1. Convert into correct types
-for i in flattened_data:
-    i = process_data(i)
 
-processed_data = [process_data(doc) for doc in flattened_data]
-
-# ✅ 5.1.5 Convert the column names into the general ones
-processed_data = [rename_columns(doc) for doc in processed_data] 
-
-# Function to generate ObjectId from a unique key
-def generate_objectid(unique_str):
-    hash_hex = hashlib.md5(unique_str.encode()).hexdigest()[:24]  # Ensure 24 chars
-    return ObjectId(hash_hex)
-
-# Add the ObjectId to each document in the list
-for doc in processed_data:
-    unique_str = str(doc['datetime']) + doc['station']
-    doc['_id'] = generate_objectid(unique_str)
-
-migration_tag = f"{datetime.now().strftime('%Y-%m-%d_%Hh%M')}_{args.file}"
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process an Airbyte JSONL file")
+    parser.add_argument(
+        'file',
+        default='InfoClimat',
+        help='The name of the station to process. Only accepts InfoClimat'
+    )
+
+    parser.add_argument(
+        "--mongodb_address",
+        default="mongodb://localhost:27017/",
+        help="The MongoDB address (default: mongodb://localhost:27017/)"
+    )
+
+    parser.add_argument(
+        "-v", "--verbosity",
+        type=upper_case,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging verbosity level (default: INFO)"
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the S3 object line by line and insert fixed-size batches (bounded memory)"
+    )
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=5000,
+        help="Number of records converted at once in streaming mode (default: 5000)"
+    )
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=5000,
+        help="Number of documents per insert_many call (default: 5000)"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads inserting chunks concurrently (default: 4)"
+    )
+
+    parser.add_argument(
+        "--mode",
+        default="insert",
+        choices=["insert", "upsert"],
+        help="insert: duplicates are rejected by MongoDB; upsert: replace changed documents and re-tag unchanged ones "
+             "so the migration can be run again (default: insert)"
+    )
+
+    parser.add_argument(
+        "--pattern",
+        default=None,
+        help="Shell-style pattern of the S3 keys of the Airbyte exports (default: the pattern of the source)"
+    )
+
+    parser.add_argument(
+        "--since",
+        type=date.fromisoformat,
+        default=None,
+        help="Only select the objects of this date or later (YYYY-MM-DD)"
+    )
+
+    parser.add_argument(
+        "--until",
+        type=date.fromisoformat,
+        default=None,
+        help="Only select the objects of this date or earlier (YYYY-MM-DD)"
+    )
+
+    parser.add_argument(
+        "--latest",
+        type=int,
+        default=1,
+        help="Number of most recent matching exports to migrate, 0 for all of them (default: 1)"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip the exports whose ETag and size are unchanged in the migration_manifest collection"
+    )
+
+    parser.add_argument(
+        "--new_records_only",
+        action="store_true",
+        help="Only migrate the Airbyte records emitted after the last one already migrated for this source"
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="Do not read nor write the local cache of converted exports"
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        default=default_cache_dir,
+        help="Directory of the local cache of converted exports (default: .cache at the root of the project)"
+    )
+
+    parser.add_argument(
+        "--cache_size_mb",
+        type=int,
+        default=default_max_bytes // 1024 ** 2,
+        help="Size cap of the local cache, the least recently used files are evicted first (default: 2048)"
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Download, parse and insert the exports concurrently, with bounded queues between the stages "
+             "(not with --stream)"
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes parsing the exports in --pipeline mode (default: number of CPUs)"
+    )
+
+    parser.add_argument(
+        "--raw_bson",
+        action="store_true",
+        help="Encode the documents straight from the columns into BSON, without a dict per row (not with --mode upsert)"
+    )
+
+    parser.add_argument(
+        "--no-dedup",
+        dest="no_dedup",
+        action="store_true",
+        help="Send the duplicate _ids to MongoDB instead of skipping them client-side (see dedup.py)"
+    )
+
+    parser.add_argument(
+        "--bulk_load",
+        action="store_true",
+        help="Drop the secondary indexes of the collection during the load and rebuild them once afterwards"
+    )
+
+    parser.add_argument(
+        "--no-rollups",
+        dest="no_rollups",
+        action="store_true",
+        help="Do not update the hourly and daily rollups of the weather_station_rollups collection"
+    )
+
+    parser.add_argument(
+        "--trace_memory",
+        action="store_true",
+        help="Record the peak Python allocations of every stage with tracemalloc (slower)"
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=default_profile_dir,
+        default=None,
+        help="Dump a cProfile .pstats file of every hot stage in this directory (default: profiles)"
+    )
+
+    parser.add_argument(
+        "--prometheus",
+        action="store_true",
+        help="Also write the stage report in the Prometheus text format"
+    )
+
+    parser.add_argument(
+        "--quarantine",
+        default="collection",
+        choices=["collection", "file", "none"],
+        help="Where the rows that do not match schema.json go: the weather_station_quarantine collection, "
+             "a JSONL file in quarantine/, or nowhere (default: collection)"
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Stream the exports, save the progress after every batch and resume an interrupted load "
+             "from its last committed batch (see checkpoint.py)"
+    )
+    return parser.parse_args(argv)
+
+
+def iter_airbyte_records(lines):
+    """
+    Yield every non empty line of an Airbyte JSONL export, parsed.
+    `lines` can be any iterable of str or bytes, such as the `iter_lines()` of an S3 body.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        yield json.loads(line)
+
+
+def iter_airbyte_data(lines):
+    """
+    Yield the `_airbyte_data` payload of every non empty line of an Airbyte JSONL export.
+    """
+    for airbyte_record in iter_airbyte_records(lines):
+        yield airbyte_record["_airbyte_data"]
+
+
+def lines_with_offsets(chunks, start=0):
+    """
+    Yield every line of the byte chunks of an S3 body read from offset `start`,
+    with the offset just after it (newline included).
+    """
+    pending = bytearray()
+    offset = start
+    for chunk in chunks:
+        searched = len(pending)
+        pending.extend(chunk)
+        begin = 0
+        while (end := pending.find(b"\n", searched)) != -1:
+            offset += end + 1 - begin
+            yield bytes(pending[begin:end]), offset
+            begin = searched = end + 1
+        del pending[:begin]
+    if pending:
+        yield bytes(pending), offset + len(pending)
+
+
+def airbyte_emitted_at(airbyte_record):
+    """
+    When Airbyte emitted the record, in epoch milliseconds: `_airbyte_emitted_at` in the older exports,
+    `_airbyte_extracted_at` (integer or ISO 8601 string) in the newer ones. None if the record has neither.
+    """
+    value = airbyte_record.get("_airbyte_emitted_at", airbyte_record.get("_airbyte_extracted_at"))
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    # A naive timestamp is taken as UTC
+    return int(pd.Timestamp(value).timestamp() * 1000)
+
+
+def flatten_hourly(airbyte_data):
+    """
+    Yield every hourly record of one `_airbyte_data` payload, with the station name added.
+    The `hourly` field maps a station id to its list of readings, `_params` is not a station.
+    """
+    id_to_station = {station['id']: station['name'] for station in airbyte_data.get("stations", [])}
+    for station_id, records in airbyte_data.get("hourly", {}).items():
+        if station_id == "_params":
+            continue
+        for record in records:
+            record['station'] = id_to_station.get(record['id_station'], 'Unknown')
+            yield record
+
+
+def export_records(key, lines, stats, emitted_after=None):
+    """
+    Yield the hourly records of one export, counting them in stats[key] with the last `_airbyte_emitted_at` seen.
+    With `emitted_after`, the Airbyte records emitted at or before it are skipped.
+    """
+    object_stats = stats.setdefault(key, {"row_count": 0, "last_emitted_at": None})
+    for airbyte_record in iter_airbyte_records(lines):
+        emitted_at = airbyte_emitted_at(airbyte_record)
+        if emitted_after is not None and emitted_at is not None and emitted_at <= emitted_after:
+            continue
+        if emitted_at is not None:
+            object_stats["last_emitted_at"] = max(emitted_at, object_stats["last_emitted_at"] or emitted_at)
+        for record in flatten_hourly(airbyte_record["_airbyte_data"]):
+            object_stats["row_count"] += 1
+            yield record
+
+
+# Column renaming and translation mapping
+column_mapping = {
+    'dh_utc': 'datetime',
+    'temperature': 'temperature_°C',  # In Celsius
+    'pression': 'pressure_hPa',  # In hPa
+    'humidite': 'humidity_%',
+    'point_de_rosee': 'dew_point_°C',  # In Celsius
+    'visibilite': 'visibility_m',  # Assuming meters for visibility
+    'vent_moyen': 'wind_speed_kph',  # In km/h
+    'vent_rafales': 'wind_gust_kph',  # In km/h
+    'vent_direction': 'wind_dir',  # Wind direction (unchanged)
+    'pluie_3h': 'precip_rate_mm/hr (3hrs)',  # In mm/hr
+    'pluie_1h': 'precip_rate_mm/hr',  # In mm/hr
+    'neige_au_sol': 'snow_depth_mm',  # In mm
+    'nebulosite': 'cloud_coverage',  # General cloud coverage (string or percentage)
+    'temps_omm': 'solar_w/m²'  # Assuming temperature is related to solar irradiance
+}
 
-for doc in processed_data:  # assuming data is a list of dicts
-    doc["migrated"] = migration_tag
+# Type of every InfoClimat field, the raw values are all strings (or None)
+float_fields = ['temperature', 'pression', 'point_de_rosee', 'vent_moyen', 'vent_rafales',
+                'pluie_3h', 'pluie_1h', 'neige_au_sol', 'temps_omm']
+int_fields = ['humidite', 'visibilite', 'vent_direction']
+
+
+def _to_float(column):
+    """
+    Convert a column of raw strings to float64, a missing field (absent key, None or empty string) becomes NaN.
+    """
+    values = column.to_numpy(dtype=object)
+    empty = values == ''
+    if empty.any():
+        values = values.copy()
+        values[empty] = None
+    # NumPy turns None into NaN and parses the strings like float() does
+    return pd.Series(values.astype('float64'), index=column.index)
+
+
+def convert_records(records):
+    """
+    Build a typed frame from the flattened hourly records, one column at a time.
+    Missing values are NaN (float), <NA> (Int64) or NaT, and are turned into None by frame_to_documents.
+    Columns are renamed with column_mapping, the other columns (id_station, station) are kept first.
+    """
+    raw = pd.DataFrame.from_records(records)
+    empty = pd.Series([None] * len(raw), index=raw.index, dtype=object)
+
+    converted = {}
+    converted['dh_utc'] = pd.to_datetime(raw.get('dh_utc', empty), format='%Y-%m-%d %H:%M:%S')
+    for field in float_fields:
+        converted[field] = _to_float(raw.get(field, empty))
+    for field in int_fields:
+        converted[field] = _to_float(raw.get(field, empty)).astype('Int64')
+    nebulosite = raw.get('nebulosite', empty).to_numpy(dtype=object).copy()
+    nebulosite[pd.isna(nebulosite) | (nebulosite == '')] = ''
+    converted['nebulosite'] = pd.Series(nebulosite, index=raw.index).astype(str)
+
+    kept = raw[[col for col in raw.columns if col not in column_mapping]]
+    typed = pd.DataFrame({column_mapping[field]: converted[field] for field in column_mapping}, index=raw.index)
+    return pd.concat([kept, typed], axis=1)
+
+
+def frame_to_documents(df, raw_bson=False):
+    """
+    Materialize the frame as a list of dicts, with None for missing values and Python scalars
+    (int, float, str, datetime) as values. This is only done at the insert boundary.
+    With raw_bson, the rows are encoded straight into the same BSON, as RawBSONDocuments (see bson_sink.py).
+    """
+    if raw_bson:
+        return frame_to_raw_documents(df, nan_is_null=True)
+    columns = []
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            values = df[col].array.to_pydatetime().astype(object)
+            values[df[col].isna().to_numpy()] = None
+        else:
+            values = df[col].to_numpy(dtype=object, na_value=None)
+        columns.append(values)
+    names = list(df.columns)
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def add_ids(df, migration_tag):
+    """
+    Add the deterministic `_id` (md5 of datetime + station) and the migration tag to the frame.
+    """
+    df['_id'] = generate_objectids(df['datetime'], df['station'])
+    df["migrated"] = migration_tag
+    return df
 
 
 # Prepare info to make sure the data is rightly migrated
 numeric_keys = ["temperature_°C", "humidity_%", "pressure_hPa"]
 
-# Filter and flatten values
-metrics = {
-    "migration_tag": migration_tag,
-    "mongodb_address": mongodb_address,
-    "row_count": len(processed_data),
-}
-
-for key in numeric_keys:
-    values = [doc[key] for doc in processed_data if key in doc and isinstance(doc[key], (int, float)) and doc[key] is not None]
-    if values:
-        metrics[f"median_{key}"] = float(statistics.median(values))
-        metrics[f"min_{key}"] = float(min(values))
-        metrics[f"max_{key}"] = float(max(values))
-
-
-
-script_dir = os.path.dirname(os.path.abspath(__file__))
-data_dir = os.path.join(script_dir, "..", "tests","test_data")
-file_path = os.path.join(data_dir, f"expected_{args.file}_metrics.json")
-
-# Ensure the directory exists
-os.makedirs(data_dir, exist_ok=True)
-
-with open(file_path, 'w', encoding='utf-8') as f:
-    json.dump(metrics, f, indent=4, ensure_ascii=False)
-
-# Insert documents
-try:
-    # Insert documents, set 'ordered=False' to continue on duplicate key error
-    result = collection.insert_many(processed_data, ordered=False)
-
-    # Log the number of inserted documents
-    inserted_count = len(result.inserted_ids)
-    logger.info(f"Successfully inserted {inserted_count} documents into MongoDB at {mongodb_address} !")
-
-except errors.BulkWriteError as e:
-    # Extract useful summary info without dumping full error
-    inserted_count = e.details.get('nInserted', 0)
-    write_errors = e.details.get('writeErrors', [])
-    duplicate_count = 0
-    validation_count = 0
-    other_count = 0
-
-    # Separate errors into categories
-    for error in write_errors:
-        if error.get('code') == 11000:  # Duplicate key error
-            duplicate_count += 1
-        elif error.get('code') == 121:  # Validation error
-            validation_count += 1
-        else:  # Other errors
-            other_count += 1
-
-    # Log the counts of different error types
-    logger.warning(f"Duplicate key error: {duplicate_count} documents were skipped.")
-    logger.warning(f"Validation error: {validation_count} documents failed validation.")
-    logger.warning(f"Other errors: {other_count} documents encountered other errors.")
-
-    # Successfully inserted documents
-    logger.info(f"{inserted_count} documents were successfully inserted despite this error.")
-
-    # Log the first 3 duplicate _id values
-    duplicate_key_errors_handled = 0
-    for error in write_errors:
-        if error.get('code') == 11000 and duplicate_key_errors_handled < 3:  # Duplicate key error
-            errmsg = error.get('errmsg', 'No detailed message available')
-            logger.debug(f"Duplicate key error: {errmsg}")
-
-            # Extract the duplicate key information from the error details
-            dup_id = error.get('keyValue', {}).get('_id', 'unknown')
-            logger.debug(f"Duplicate _id: {dup_id}")
-
-            # Log the failed document data for duplicate key errors
-            logger.debug(f"Failed document data for duplicate key: {error.get('op', {})}")
-            duplicate_key_errors_handled += 1
-
-    if duplicate_count > 3:
-        logger.debug(f"...and {duplicate_count - 3} more duplicates were skipped.")
-
-    # Log the first 3 validation errors
-    validation_errors_handled = 0
-    for error in write_errors:
-        if error.get('code') == 121 and validation_errors_handled < 3:  # Validation error
-            errmsg = error.get('errmsg', 'No detailed message available')
-            logger.debug(f"Validation failed for document: {errmsg}")
-            logger.debug(f"Failed document data for validation error: {error.get('op', {})}")
-            validation_errors_handled += 1
-
-    if validation_count > 3:
-        logger.debug(f"...and {validation_count - 3} more validation errors occurred.")
-
-    # If there are any other errors (non-validation, non-duplicate), log them
-    if other_count > 0:
-        logger.debug(f"...and {other_count} other errors occurred.")
 
+def compute_metrics(migration_tag, mongodb_address, accumulator):
+    """
+    Expected metrics of the migration: exact count, min and max, median from the sketches,
+    plus the statistics and sketches of every numeric field, overall and per station.
+    """
+    metrics = {
+        "migration_tag": migration_tag,
+        "mongodb_address": mongodb_address,
+        "row_count": accumulator.row_count,
+    }
+    metrics.update(accumulator.summary(numeric_keys))
+    metrics.update(accumulator.to_dict())
+    return metrics
+
+
+def parse_export(key, content, emitted_after=None):
+    """
+    The typed frame of one downloaded export and its stats (row count, last `_airbyte_emitted_at`).
+    Every Airbyte record of the export is migrated, like in the streaming modes.
+    A module-level function, so the pipelined mode can run it in a worker process.
+    """
+    stats = {}
+    frame = convert_records(export_records(key, content.splitlines(), stats, emitted_after))
+    return frame, stats[key]
+
+
+def export_frames(s3, objects, stats, emitted_after=None, cache=None, timer=None):
+    """
+    Yield the typed frame of every export, read from the cache when it holds the export,
+    else downloaded (all the missing exports at once, see s3_source.py), converted and stored in the cache.
+    Frames filtered on `emitted_after` depend on the watermark, they are neither read from nor written to the cache.
+    """
+    timer = StageTimer() if timer is None else timer
+    if emitted_after is not None:
+        cache = None
+    cached = {obj['Key'] for obj in objects if cache is not None and cache.contains(bucket_name, obj['Key'], obj['ETag'])}
+    missing = [obj for obj in objects if obj['Key'] not in cached]
+    downloads = download_objects(s3, missing) if missing else iter(())
+
+    for obj in objects:
+        if obj['Key'] in cached:
+            with timer.stage("cache") as stage:
+                frame, metadata = cache.load(bucket_name, obj['Key'], obj['ETag'])
+                stage.rows_out = None if frame is None else len(frame)
+            if frame is not None:
+                stats[obj['Key']] = metadata
+                yield frame
+                continue
+            # Evicted in the meantime
+            downloaded = download_objects(s3, [obj])
+        else:
+            downloaded = downloads
+        with timer.stage("download") as stage:
+            _, content = next(downloaded)
+            stage.bytes_in = len(content)
+
+        with timer.stage("parse", bytes_in=len(content)) as stage:
+            frame, stats[obj['Key']] = parse_export(obj['Key'], content, emitted_after)
+            stage.rows_out = len(frame)
+        del content
+        if cache is not None:
+            with timer.stage("cache_store", rows_in=len(frame)) as stage:
+                cache.store(frame, bucket_name, obj['Key'], obj['ETag'], stats[obj['Key']])
+                stage.bytes_out = os.path.getsize(cache.path(bucket_name, obj['Key'], obj['ETag']))
+        yield frame
+
+
+def migrate(frames, collection, migration_tag, mongodb_address, source, chunk_size=5000, workers=4,
+            mode="insert", timer=None, quarantine_target=None, raw_bson=False, dedup=None, accumulator=None):
+    """
+    Gather the typed frames of every export, then insert every document in chunks.
+    The rows that do not match schema.json are not sent, they go to `quarantine_target` (see schema_check.py).
+    With a Deduplicator, the duplicate rows are dropped before the metrics and the insert (see dedup.py).
+    With a MetricsAccumulator, the metrics are added to it instead of being written (see worker.py).
+    """
+    timer = StageTimer(source) if timer is None else timer
+    # The frames are produced (downloaded, parsed) while they are gathered, in their own stages
+    frames = list(frames)
+    with timer.stage("ids") as stage:
+        df = add_ids(pd.concat(frames, ignore_index=True), migration_tag)
+        stage.rows_out = len(df)
+
+    # frame_to_documents turns NaN into None, so a NaN is null for the schema
+    with timer.stage("schema_check", rows_in=len(df)) as stage:
+        df, rejected, _ = SchemaCheck(nan_is_null=True).split(df)
+        stage.rows_out = len(df)
+    if len(rejected):
+        quarantine(frame_to_documents(rejected), quarantine_target, source, migration_tag)
+
+    if dedup is not None:
+        with timer.stage("dedup", rows_in=len(df)) as stage:
+            df = dedup.filter(df)
+            stage.rows_out = len(df)
+
+    with timer.stage("metrics", rows_in=len(df)):
+        if accumulator is None:
+            accumulator = MetricsAccumulator()
+            accumulator.update(df)
+            write_metrics(compute_metrics(migration_tag, mongodb_address, accumulator), source)
+        else:
+            accumulator.update(df)
+
+    with timer.stage("documents", rows_in=len(df)):
+        documents = frame_to_documents(df, raw_bson)
+    with timer.stage("insert", rows_in=len(documents)) as stage:
+        summary = insert_documents(collection, documents, chunk_size, workers, mode)
+        stage.rows_out = summary["inserted"]
+    summary["rejected"] = len(rejected)
+    if dedup is not None:
+        summary.update(dedup.counts)
+    log_insert_summary(summary, mongodb_address, mode)
+    return summary
+
+
+def migrate_stream(exports, collection, migration_tag, mongodb_address, source, batch_size,
+                   chunk_size=5000, workers=4, mode="insert", emitted_after=None, stats=None, timer=None,
+                   quarantine_target=None, raw_bson=False, dedup=None):
+    """
+    Read the S3 bodies line by line, given as (object, lines) pairs, and send fixed-size batches to MongoDB.
+    Only one Airbyte line and a few batches of documents are held in memory at a time,
+    the metrics are running aggregates updated batch by batch; only the _ids met by the Deduplicator grow with the load.
+    The stages are interleaved, the whole of it is timed as the "stream" stage.
+    """
+    timer = StageTimer(source) if timer is None else timer
+    stats = {} if stats is None else stats
+    records = chain.from_iterable(
+        export_records(obj['Key'], lines, stats, emitted_after) for obj, lines in exports
+    )
+
+    # Updated batch by batch, the rows are not kept for the metrics
+    accumulator = MetricsAccumulator()
+    check = SchemaCheck(nan_is_null=True)
+    rejected_count = Counter()
+
+    def documents():
+        for batch in chunked(records, batch_size):
+            df, rejected, counts = check.split(add_ids(convert_records(batch), migration_tag))
+            if len(rejected):
+                rejected_count.update(counts)
+                quarantine(frame_to_documents(rejected), quarantine_target, source, migration_tag)
+            if dedup is not None:
+                df = dedup.filter(df)
+            accumulator.update(df)
+            logger.debug(f"{accumulator.row_count} documents converted so far")
+            yield from frame_to_documents(df, raw_bson)
+
+    with timer.stage("stream") as stage:
+        summary = insert_documents(collection, documents(), chunk_size, workers, mode)
+        stage.rows_in = accumulator.row_count
+        stage.rows_out = summary["inserted"]
+    summary["rejected"] = rejected_count.total()
+    if dedup is not None:
+        summary.update(dedup.counts)
+
+    write_metrics(compute_metrics(migration_tag, mongodb_address, accumulator), source)
+    log_insert_summary(summary, mongodb_address, mode)
+    return summary
+
+
+def migrate_resumable(s3, objects, collection, migration_tag, mongodb_address, source, batch_size, checkpoint,
+                      chunk_size=5000, workers=4, mode="insert", emitted_after=None, stats=None, timer=None,
+                      quarantine_target=None, raw_bson=False, dedup=None):
+    """
+    Stream the exports like migrate_stream, but insert a batch of whole Airbyte lines at a time and commit
+    the checkpoint after each one: the offset after its last line, the insert counts, the stats and the metrics.
+    The exports and the offset already committed are skipped, the rest of an export is read with a ranged GET.
+    """
+    timer = StageTimer(source) if timer is None else timer
+    stats = {} if stats is None else stats
+    state = checkpoint.state
+    stats.update(stats_dict(state["stats"]))
+    summary = Counter(state["summary"])
+    rejected_count = state["rejected"]
+    accumulator = MetricsAccumulator.from_dict(state["metrics"]) if state["metrics"] else MetricsAccumulator()
+    check = SchemaCheck(nan_is_null=True)
+
+    def insert_batch(records):
+        nonlocal rejected_count
+        df, rejected, _ = check.split(add_ids(convert_records(records), migration_tag))
+        if len(rejected):
+            rejected_count += len(rejected)
+            quarantine(frame_to_documents(rejected), quarantine_target, source, migration_tag)
+        if dedup is not None:
+            df = dedup.filter(df)
+        accumulator.update(df)
+        summary.update(insert_documents(collection, frame_to_documents(df, raw_bson), chunk_size, workers, mode))
+
+    def commit(**progress):
+        checkpoint.commit(summary=dict(summary), rejected=rejected_count, stats=stats_list(stats),
+                          metrics={"row_count": accumulator.row_count, **accumulator.to_dict()}, **progress)
+
+    with timer.stage("stream") as stage:
+        for obj in objects:
+            if obj['Key'] in state["done_keys"]:
+                continue
+            offset = state["offset"] if state["key"] == obj['Key'] else 0
+            if offset < obj['Size']:
+                logger.info(f"Reading {obj['Key']} from byte {offset}")
+                request = {"Range": f"bytes={offset}-"} if offset else {}
+                body = s3.get_object(Bucket=bucket_name, Key=obj['Key'], IfMatch=obj['ETag'], **request)["Body"]
+                records = []
+                for line, end in lines_with_offsets(body.iter_chunks(), offset):
+                    records.extend(export_records(obj['Key'], [line], stats, emitted_after))
+                    if len(records) >= batch_size:
+                        insert_batch(records)
+                        commit(key=obj['Key'], offset=end)
+                        records = []
+                if records:
+                    insert_batch(records)
+            commit(done_keys=state["done_keys"] + [obj['Key']], key=None, offset=0)
+        stage.rows_in = accumulator.row_count
+        stage.rows_out = summary["inserted"]
+    summary["rejected"] = rejected_count
+    if dedup is not None:
+        summary.update(dedup.counts)
+
+    write_metrics(compute_metrics(migration_tag, mongodb_address, accumulator), source)
+    log_insert_summary(summary, mongodb_address, mode)
+    return summary
+
+
+def migrate_pipelined(s3, objects, collection, migration_tag, mongodb_address, source, chunk_size=5000, workers=4,
+                      mode="insert", emitted_after=None, stats=None, cache=None, timer=None, quarantine_target=None,
+                      processes=None, queue_size=default_queue_size, raw_bson=False, dedup=None):
+    """
+    Migrate the exports one by one through a pipeline (see pipeline.py): export N+1 is downloaded (or read from
+    the cache) while export N is parsed and export N-1 inserted. The parsing runs in a pool of `processes`
+    processes (number of CPUs by default, in the thread with less than 2), the downloads and inserts in threads.
+    The metrics are accumulated export by export, as in streaming mode.
+    """
+    timer = StageTimer(source) if timer is None else timer
+    stats = {} if stats is None else stats
+    if emitted_after is not None:
+        cache = None
+    if processes is None:
+        processes = os.cpu_count() or 1
+    accumulator = MetricsAccumulator()
+    check = SchemaCheck(nan_is_null=True)
+    rejected_count = Counter()
+
+    def fetch(obj):
+        if cache is not None and cache.contains(bucket_name, obj['Key'], obj['ETag']):
+            with timer.stage("cache") as stage:
+                frame, metadata = cache.load(bucket_name, obj['Key'], obj['ETag'])
+                stage.rows_out = None if frame is None else len(frame)
+            if frame is not None:
+                stats[obj['Key']] = metadata
+                return obj, None, frame
+        with timer.stage("download") as stage:
+            _, content = next(download_objects(s3, [obj]))
+            stage.bytes_in = len(content)
+        return obj, content, None
+
+    def parse(item):
+        obj, content, frame = item
+        if frame is not None:
+            return frame
+        with timer.stage("parse", bytes_in=len(content)) as stage:
+            if executor is None:
+                frame, stats[obj['Key']] = parse_export(obj['Key'], content, emitted_after)
+            else:
+                frame, stats[obj['Key']] = executor.submit(parse_export, obj['Key'], content, emitted_after).result()
+            stage.rows_out = len(frame)
+        if cache is not None:
+            with timer.stage("cache_store", rows_in=len(frame)) as stage:
+                cache.store(frame, bucket_name, obj['Key'], obj['ETag'], stats[obj['Key']])
+                stage.bytes_out = os.path.getsize(cache.path(bucket_name, obj['Key'], obj['ETag']))
+        return frame
+
+    # A single worker, the accumulator is not shared between threads
+    def prepare(frame):
+        with timer.stage("ids") as stage:
+            df = add_ids(frame, migration_tag)
+            stage.rows_out = len(df)
+        with timer.stage("schema_check", rows_in=len(df)) as stage:
+            df, rejected, counts = check.split(df)
+            stage.rows_out = len(df)
+        if len(rejected):
+            rejected_count.update(counts)
+            quarantine(frame_to_documents(rejected), quarantine_target, source, migration_tag)
+        if dedup is not None:
+            with timer.stage("dedup", rows_in=len(df)) as stage:
+                df = dedup.filter(df)
+                stage.rows_out = len(df)
+        with timer.stage("metrics", rows_in=len(df)):
+            accumulator.update(df)
+        with timer.stage("documents", rows_in=len(df)):
+            return frame_to_documents(df, raw_bson)
+
+    def insert(documents):
+        with timer.stage("insert", rows_in=len(documents)) as stage:
+            counts = insert_documents(collection, documents, chunk_size, workers, mode)
+            stage.rows_out = counts["inserted"]
+        return counts
+
+    steps = [Step("fetch", fetch, workers=2), Step("parse", parse, workers=max(processes, 1)),
+             Step("prepare", prepare), Step("insert", insert)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=process_context) if processes >= 2 else nullcontext() as executor, \
+            timer.stage("pipeline", rows_in=len(objects)) as stage:
+        summary = sum(Pipeline(steps, queue_size).run(objects), Counter())
+        stage.rows_out = summary["inserted"]
+    summary["seconds"] = time.perf_counter() - start
+    summary["rejected"] = rejected_count.total()
+    if dedup is not None:
+        summary.update(dedup.counts)
+
+    write_metrics(compute_metrics(migration_tag, mongodb_address, accumulator), source)
+    log_insert_summary(summary, mongodb_address, mode)
+    return summary
+
+
+def run(s3, collection, source, mongodb_address, stream=False, batch_size=5000, chunk_size=5000, workers=4,
+        mode="insert", pattern=None, since=None, until=None, latest=1, manifest=None, incremental=False,
+        new_records_only=False, cache=None, rollups=None, timer=None, quarantine_target=None, pipeline=False,
+        processes=None, raw_bson=False, dedup=None, checkpoint=None, deferred=None):
+    """
+    Migrate the selected exports of one source with the given S3 client and collection,
+    so the runner can share them between sources. Every selected export gets the same migration tag.
+    With a manifest collection, the migrated exports are recorded in it; `incremental` then skips the exports
+    already migrated and `new_records_only` the records emitted before the watermark of the source.
+    With a FrameCache, the typed frames of the exports are kept on disk (not in streaming mode).
+    With a rollup collection, the hourly and daily rollups of the days of the migrated records are recomputed.
+    Every stage is timed by the StageTimer.
+    The rows that do not match schema.json are not sent, they go to `quarantine_target` (see schema_check.py).
+    With `pipeline` (not in streaming mode), the exports are downloaded, parsed by `processes` processes
+    and inserted concurrently, see migrate_pipelined.
+    With `raw_bson`, the documents are encoded straight from the columns (see bson_sink.py), in the insert modes only.
+    With a Deduplicator, the duplicates within the load and the documents already stored are not sent (see dedup.py).
+    With a Checkpoint, the exports are streamed batch by batch and an interrupted load of the same exports is resumed
+    from its last committed batch, with its migration tag (see migrate_resumable).
+    In a bulk load, `deferred` is the DeferredIndexes, the rollups are updated once the indexes are rebuilt.
+    """
+    if raw_bson and mode == "upsert":
+        raise ValueError("--raw_bson can not be used with --mode upsert, which adds a content_hash to every document")
+    timer = StageTimer(source) if timer is None else timer
+    pattern = pattern or file_patterns[source]
+    with timer.stage("list") as stage:
+        objects = select_objects(s3, pattern, since, until, latest)
+        stage.rows_out = len(objects)
+    if not objects:
+        raise FileNotFoundError(f"No S3 object matches {pattern}")
+    if manifest is not None and incremental:
+        objects = changed_objects(manifest, objects)
+        if not objects:
+            logger.info(f"Nothing to migrate for {source}, every selected export is unchanged")
+            return Counter()
+    logger.info(f"{len(objects)} exports selected: {[obj['Key'] for obj in objects]}")
+
+    emitted_after = None
+    if manifest is not None and new_records_only:
+        emitted_after = source_watermark(manifest, source)
+        logger.info(f"Only the records emitted after {emitted_after} are migrated")
+
+    migration_tag = make_migration_tag(source)
+    stats = {}
+    if checkpoint is not None:
+        migration_tag = checkpoint.open(objects, migration_tag)["migration_tag"]
+        if dedup is not None:
+            # The documents of the interrupted run are sent again, so they are counted in the metrics
+            dedup.resumed_tag = migration_tag
+
+    if checkpoint is not None:
+        summary = migrate_resumable(s3, objects, collection, migration_tag, mongodb_address, source, batch_size,
+                                    checkpoint, chunk_size, workers, mode, emitted_after, stats, timer,
+                                    quarantine_target, raw_bson, dedup)
+    elif stream:
+        # One GET per export, each body is streamed
+        exports = ((obj, s3.get_object(Bucket=bucket_name, Key=obj['Key'])["Body"].iter_lines()) for obj in objects)
+        summary = migrate_stream(exports, collection, migration_tag, mongodb_address, source, batch_size,
+                                 chunk_size, workers, mode, emitted_after, stats, timer, quarantine_target,
+                                 raw_bson, dedup)
+    elif pipeline:
+        summary = migrate_pipelined(s3, objects, collection, migration_tag, mongodb_address, source, chunk_size,
+                                    workers, mode, emitted_after, stats, cache, timer, quarantine_target, processes,
+                                    raw_bson=raw_bson, dedup=dedup)
+    else:
+        frames = export_frames(s3, objects, stats, emitted_after, cache, timer)
+        summary = migrate(frames, collection, migration_tag, mongodb_address, source, chunk_size, workers, mode,
+                          timer, quarantine_target, raw_bson, dedup)
+
+    if manifest is not None:
+        with timer.stage("manifest"):
+            record_objects(manifest, objects, source, migration_tag, stats)
+    if rollups is not None:
+        schedule_rollups(collection, rollups, migration_tag, timer, deferred)
+    if checkpoint is not None:
+        checkpoint.finish()
+    return summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    log_level = getattr(logging, args.verbosity)
+    logging.basicConfig(level=log_level)
+
+    mongodb_address = args.mongodb_address
+    # After parsing arguments
+    logger.info(f"Station: {args.file}")
+    logger.info(f"MongoDB adress: {mongodb_address}")  # Debug lines to check the parsed arguments
+
+    if args.file not in file_patterns:
+        logger.error(f"Unknown station {args.file}, expected one of {list(file_patterns)}")
+        sys.exit(1)
+
+    s3 = s3_client(load_secrets('secrets.json'))
+    client = MongoClient(mongodb_address)
+    collection = weather_collection(client)
+
+    timer = StageTimer(args.file, args.trace_memory, args.profile)
+    try:
+        mode = write_mode(collection, args.mode)
+        with deferred_indexes(collection) if args.bulk_load else nullcontext() as deferred:
+            run(s3, collection, args.file, mongodb_address, stream=args.stream, batch_size=args.batch_size,
+                chunk_size=args.chunk_size, workers=args.workers, mode=mode, pattern=args.pattern,
+                since=args.since, until=args.until, latest=args.latest, manifest=manifest_collection(client),
+                incremental=args.incremental, new_records_only=args.new_records_only,
+                cache=None if args.no_cache else FrameCache(args.cache_dir, args.cache_size_mb * 1024 ** 2),
+                rollups=None if args.no_rollups else rollup_collection(client), timer=timer,
+                quarantine_target=open_quarantine(client, args.quarantine), pipeline=args.pipeline,
+                processes=args.processes, raw_bson=args.raw_bson,
+                dedup=None if args.no_dedup else Deduplicator(collection, mode),
+                checkpoint=Checkpoint(checkpoint_collection(client), args.file) if args.resume else None,
+                deferred=deferred)
+    except (FileNotFoundError, ValueError) as e:
+        logger.error(e)
+        sys.exit(1)
+    timer.log_summary()
+    write_report(timer, args.prometheus)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import logging
+from datetime import datetime
+
+from pymongo import DESCENDING
+
+from common import bucket_name, database_name
+
+"""
+Manifest of the S3 objects already migrated, kept in the `migration_manifest` collection of `weather_data`.
+Every migrated object is recorded with its key, ETag, size, LastModified, row count and migration tag,
+so an incremental run skips the objects whose ETag and size did not change.
+For the Airbyte exports, the last `_airbyte_emitted_at` seen (epoch milliseconds) is kept too:
+it is the watermark used to ingest only the newer records.
+"""
+
+logger = logging.getLogger(__name__)
+
+manifest_collection_name = "migration_manifest"
+
+
+def manifest_collection(client):
+    return client[database_name][manifest_collection_name]
+
+
+def manifest_id(key, bucket=bucket_name):
+    return f"{bucket}/{key}"
+
+
+def is_unchanged(entry, obj):
+    return entry is not None and entry["etag"] == obj["ETag"] and entry["size"] == obj["Size"]
+
+
+def changed_objects(manifest, objects, bucket=bucket_name):
+    """
+    Keep the objects that are new or whose ETag or size changed since they were migrated.
+    """
+    entries = {
+        entry["_id"]: entry
+        for entry in manifest.find({"_id": {"$in": [manifest_id(obj["Key"], bucket) for obj in objects]}})
+    }
+    changed = []
+    for obj in objects:
+        entry = entries.get(manifest_id(obj["Key"], bucket))
+        if is_unchanged(entry, obj):
+            logger.info(f"Skipping {obj['Key']}, unchanged since migration {entry['migration_tag']}")
+        else:
+            changed.append(obj)
+    return changed
+
+
+def source_watermark(manifest, source):
+    """
+    Last `_airbyte_emitted_at` migrated for the source, None if no export of the source was migrated yet.
+    """
+    entry = manifest.find_one({"source": source, "last_emitted_at": {"$ne": None}},
+                              sort=[("last_emitted_at", DESCENDING)])
+    return entry["last_emitted_at"] if entry else None
+
+
+def record_objects(manifest, objects, source, migration_tag, stats, bucket=bucket_name):
+    """
+    Record the migrated objects, `stats` maps a key to its row_count (and last_emitted_at for the exports).
+    The watermark of an object never goes back, even if none of its records were newer than the previous one.
+    """
+    for obj in objects:
+        object_stats = stats.get(obj["Key"], {})
+        update = {
+            "$set": {
+                "bucket": bucket,
+                "key": obj["Key"],
+                "etag": obj["ETag"],
+                "size": obj["Size"],
+                "last_modified": obj["LastModified"],
+                "source": source,
+                "row_count": object_stats.get("row_count", 0),
+                "migration_tag": migration_tag,
+                "recorded_at": datetime.now(),
+            }
+        }
+        if object_stats.get("last_emitted_at") is not None:
+            update["$max"] = {"last_emitted_at": object_stats["last_emitted_at"]}
+        manifest.update_one({"_id": manifest_id(obj["Key"], bucket)}, update, upsert=True)
+    logger.info(f"{len(objects)} objects recorded in the {manifest_collection_name} collection")
@@ -0,0 +1,241 @@
+import math
+import random
+
+import numpy as np
+import pandas as pd
+
+from verify import numeric_fields
+
+"""
+Migration metrics accumulated batch by batch, per numeric field, overall and per station.
+Count, min, max, mean and variance are exact (Welford's sums, merged with Chan's formula).
+Quantiles come from a KLL sketch: a few hundred values whatever the number of rows, and mergeable,
+so the accumulators of several batches, chunks or workers merge into the one of the whole migration.
+The sketch is written in the expected metrics file, so the verification tolerates exactly the sketch rank error.
+"""
+
+# Size of the KLL sketches, the normalized rank error is about 1.3% for k = 200 (99% confidence)
+default_k = 200
+
+
+def rank_error(k=default_k):
+    # Empirical bound of the KLL sketch (Apache DataSketches), single-sided rank error with 99% confidence
+    return 2.296 / k ** 0.9723
+
+
+class KLLSketch:
+    """
+    KLL quantile sketch: level h holds values of weight 2^h. A full level is sorted and every other value,
+    from a random offset, is promoted to the level above.
+    """
+
+    def __init__(self, k=default_k, seed=None):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.random = random.Random(seed)
+
+    def capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(2, math.ceil(self.k * (2 / 3) ** depth))
+
+    def update(self, values):
+        values = np.asarray(values, dtype="float64")
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def compress(self):
+        while sum(len(level) for level in self.levels) > sum(self.capacity(h) for h in range(len(self.levels))):
+            level = next(h for h in range(len(self.levels)) if len(self.levels[h]) > self.capacity(h))
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            values = np.sort(self.levels[level])
+            # With an odd number of values, the largest one stays at this level
+            kept = values[len(values) - len(values) % 2:]
+            promoted = values[self.random.randint(0, 1):len(values) - len(values) % 2:2]
+            self.levels[level] = kept
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.n += other.n
+        self.compress()
+        return self
+
+    def weighted(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        return values[order], weights[order]
+
+    def quantile(self, q):
+        if self.n == 0:
+            return None
+        values, weights = self.weighted()
+        cumulative = np.cumsum(weights)
+        index = np.searchsorted(cumulative, q * cumulative[-1])
+        return float(values[min(index, len(values) - 1)])
+
+    def rank_range(self, value):
+        """
+        Estimated fractions of the values strictly below and below or equal to the value.
+        """
+        values, weights = self.weighted()
+        total = weights.sum()
+        below = weights[values < value].sum()
+        return float(below / total), float((below + weights[values == value].sum()) / total)
+
+    def to_dict(self):
+        return {"k": self.k, "n": self.n, "levels": [level.tolist() for level in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["k"])
+        sketch.n = data["n"]
+        sketch.levels = [np.asarray(level, dtype="float64") for level in data["levels"]]
+        return sketch
+
+
+class FieldStats:
+    """
+    Exact count, min, max, mean and sum of squared deviations (m2) of a field, plus its KLL sketch.
+    """
+
+    def __init__(self, k=default_k):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sketch = KLLSketch(k)
+
+    def update(self, values):
+        if len(values) == 0:
+            return
+        batch = FieldStats(self.sketch.k)
+        batch.count = len(values)
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        batch.mean = float(values.mean())
+        batch.m2 = float(((values - batch.mean) ** 2).sum())
+        self.merge_moments(batch)
+        self.sketch.update(values)
+
+    def merge_moments(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.min, self.max, self.mean, self.m2 = other.count, other.min, other.max, other.mean, other.m2
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def merge(self, other):
+        self.merge_moments(other)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean if self.count else None,
+            "variance": self.m2 / (self.count - 1) if self.count > 1 else None,
+            "m2": self.m2,
+            "median": self.sketch.quantile(0.5),
+            "sketch": self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.count, stats.min, stats.max, stats.m2 = data["count"], data["min"], data["max"], data["m2"]
+        stats.mean = data["mean"] or 0.0
+        stats.sketch = KLLSketch.from_dict(data["sketch"])
+        return stats
+
+
+class MetricsAccumulator:
+    """
+    FieldStats of every numeric field of schema.json, overall and per station, updated with each frame.
+    """
+
+    def __init__(self, fields=None, k=default_k):
+        self.fields = numeric_fields() if fields is None else fields
+        self.k = k
+        self.row_count = 0
+        self.overall = {}
+        self.stations = {}
+
+    def update(self, df):
+        self.row_count += len(df)
+        if "station" in df.columns:
+            codes, stations = pd.factorize(df["station"])
+        else:
+            codes, stations = None, []
+        for field in self.fields:
+            if field not in df.columns:
+                continue
+            values = pd.to_numeric(df[field], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+            present = ~np.isnan(values)
+            self.overall.setdefault(field, FieldStats(self.k)).update(values[present])
+            for code, station in enumerate(stations):
+                station_values = values[present & (codes == code)]
+                self.stations.setdefault(station, {}).setdefault(field, FieldStats(self.k)).update(station_values)
+
+    def merge(self, other):
+        self.row_count += other.row_count
+        for field, stats in other.overall.items():
+            self.overall.setdefault(field, FieldStats(self.k)).merge(stats)
+        for station, fields in other.stations.items():
+            for field, stats in fields.items():
+                self.stations.setdefault(station, {}).setdefault(field, FieldStats(self.k)).merge(stats)
+        return self
+
+    def to_dict(self):
+        return {
+            "sketch_k": self.k,
+            "rank_error": rank_error(self.k),
+            "fields": {field: stats.to_dict() for field, stats in self.overall.items()},
+            "stations": {
+                station: {field: stats.to_dict() for field, stats in fields.items()}
+                for station, fields in self.stations.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        The accumulator of a metrics dict holding `row_count` and the entries of to_dict, such as an expected metrics file.
+        """
+        accumulator = cls(k=data["sketch_k"])
+        accumulator.row_count = data["row_count"]
+        accumulator.overall = {field: FieldStats.from_dict(stats) for field, stats in data["fields"].items()}
+        accumulator.stations = {
+            station: {field: FieldStats.from_dict(stats) for field, stats in fields.items()}
+            for station, fields in data["stations"].items()
+        }
+        return accumulator
+
+    def summary(self, keys):
+        """
+        The median_, min_ and max_ entries of the expected metrics file for the given fields.
+        """
+        metrics = {}
+        for key in keys:
+            stats = self.overall.get(key)
+            if stats is not None and stats.count:
+                metrics[f"median_{key}"] = stats.sketch.quantile(0.5)
+                metrics[f"min_{key}"] = stats.min
+                metrics[f"max_{key}"] = stats.max
+        return metrics
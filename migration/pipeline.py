@@ -0,0 +1,145 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+
+"""
+Pipelined execution of the migration stages: every step runs in its own threads and consecutive steps are connected
+by bounded queues, so downloading object N+1, transforming N and inserting N-1 overlap.
+I/O steps (S3, MongoDB) simply block their thread; a CPU step hands its work to a process pool and its threads
+only wait for the results, the pool is created by the caller (see jsonl.py and xlsx.py).
+A full queue blocks the step feeding it: at most `queue_size` items wait between two steps, plus the one each worker
+holds, so the memory stays capped whatever the number of items. End to end, the pipeline takes about as long as
+its slowest step; the time every step waited for input or for room downstream is logged to find it.
+"""
+
+logger = logging.getLogger(__name__)
+
+default_queue_size = 2
+
+# Put on a queue after the last item, once per worker of the next step
+end = object()
+
+# Seconds between two checks of a failure while waiting on a queue
+poll_seconds = 0.1
+
+
+class Step:
+    """
+    A named function applied to every item, by `workers` threads. Items may be reordered with several workers.
+    """
+
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+class Pipeline:
+    def __init__(self, steps, queue_size=default_queue_size):
+        self.steps = steps
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.errors = []
+        # Seconds spent waiting for an input item and for room in the output queue, by step
+        self.waits = {step.name: Counter() for step in steps}
+
+    def fail(self, error):
+        with self.lock:
+            self.errors.append(error)
+        self.failed.set()
+
+    def put(self, box, item, name):
+        start = time.perf_counter()
+        while not self.failed.is_set():
+            try:
+                box.put(item, timeout=poll_seconds)
+                break
+            except queue.Full:
+                continue
+        with self.lock:
+            self.waits[name]["output"] += time.perf_counter() - start
+
+    def get(self, box, name):
+        start = time.perf_counter()
+        item = end
+        while not self.failed.is_set():
+            try:
+                item = box.get(timeout=poll_seconds)
+                break
+            except queue.Empty:
+                continue
+        with self.lock:
+            self.waits[name]["input"] += time.perf_counter() - start
+        return item
+
+    def feed(self, items, outbox):
+        try:
+            for item in items:
+                if self.failed.is_set():
+                    return
+                self.put(outbox, item, self.steps[0].name)
+        except Exception as e:
+            self.fail(e)
+            return
+        for _ in range(self.steps[0].workers):
+            self.put(outbox, end, self.steps[0].name)
+
+    def work(self, index, inbox, outbox, remaining):
+        step = self.steps[index]
+        while True:
+            item = self.get(inbox, step.name)
+            if item is end:
+                break
+            try:
+                result = step.function(item)
+            except Exception as e:
+                self.fail(e)
+                break
+            self.put(outbox, result, step.name)
+
+        # The last worker of the step to finish tells the workers of the next one
+        with self.lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last:
+            following = self.steps[index + 1].workers if index + 1 < len(self.steps) else 1
+            for _ in range(following):
+                self.put(outbox, end, step.name)
+
+    def run(self, items):
+        """
+        Run every item through the steps, returns the results of the last step (in completion order).
+        The first error raised by a step, or by the iteration of `items`, stops every step and is raised again.
+        """
+        boxes = [queue.Queue(self.queue_size) for _ in self.steps]
+        # The results are collected as they come, their queue is not bounded
+        boxes.append(queue.Queue())
+        remaining = [step.workers for step in self.steps]
+
+        threads = [threading.Thread(target=self.feed, args=(items, boxes[0]), name="pipeline-feed")]
+        for index, step in enumerate(self.steps):
+            for worker in range(step.workers):
+                threads.append(threading.Thread(target=self.work, args=(index, boxes[index], boxes[index + 1], remaining),
+                                                name=f"pipeline-{step.name}-{worker}"))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+        results = []
+        while not boxes[-1].empty():
+            result = boxes[-1].get()
+            if result is not end:
+                results.append(result)
+        self.log_waits()
+        return results
+
+    def log_waits(self):
+        for name, waits in self.waits.items():
+            logger.info(f"Pipeline step {name}: {waits['input']:.2f}s waiting for input, "
+                        f"{waits['output']:.2f}s waiting for room downstream")
@@ -0,0 +1,181 @@
+import argparse
+import logging
+from datetime import timedelta
+
+from pymongo import ASCENDING, MongoClient
+
+from common import database_name, upper_case, weather_collection
+from verify import number, numeric_fields
+
+"""
+Per-station hourly and daily rollups of the weather collection, kept in the `weather_station_rollups` collection.
+A rollup document holds, for every numeric field of schema.json, the count, sum, min and max of its readings:
+{"_id": {"station", "period", "start"}, "station", "period": "hour" | "day", "start", "count", "fields": {field: {...}}}
+The mean is sum / count, and rollups of several periods or stations merge by adding the counts and sums.
+After a load, only the days touched by its migration tag are recomputed, from the readings for the hours
+and from the hourly rollups for the days, and written with `$merge`, so every other rollup is left as it is.
+The date expressions only use `$dateFromParts`, available on the mongo:4.4 of docker-compose.yml.
+"""
+
+logger = logging.getLogger(__name__)
+
+rollup_collection_name = "weather_station_rollups"
+
+
+def rollup_collection(client):
+    return client[database_name][rollup_collection_name]
+
+
+def truncate(date, period):
+    # Start of the hour or of the day (UTC) of a date expression
+    parts = {"year": {"$year": date}, "month": {"$month": date}, "day": {"$dayOfMonth": date}}
+    if period == "hour":
+        parts["hour"] = {"$hour": date}
+    return {"$dateFromParts": parts}
+
+
+def touched_days(collection, tag):
+    """
+    The days (UTC) holding documents of the migration tag, by station.
+    """
+    pipeline = [
+        {"$match": {"migrated": tag}},
+        {"$group": {"_id": {"station": "$station", "day": truncate("$datetime", "day")}}},
+    ]
+    days = {}
+    for window in collection.aggregate(pipeline, allowDiskUse=True):
+        if window["_id"]["day"] is not None:
+            days.setdefault(window["_id"]["station"], []).append(window["_id"]["day"])
+    return days
+
+
+def day_ranges(days):
+    """
+    Merge the touched days of every station into [start, end) ranges of consecutive days.
+    """
+    ranges = []
+    for station, station_days in sorted(days.items()):
+        start = end = None
+        for day in sorted(station_days):
+            if end is not None and day <= end:
+                end = day + timedelta(days=1)
+                continue
+            if start is not None:
+                ranges.append((station, start, end))
+            start, end = day, day + timedelta(days=1)
+        if start is not None:
+            ranges.append((station, start, end))
+    return ranges
+
+
+def window_match(ranges, date_field):
+    return {"$or": [{"station": station, date_field: {"$gte": start, "$lt": end}} for station, start, end in ranges]}
+
+
+def rollup_document(fields, period):
+    # Nest the flat accumulators of the $group stage under "fields"
+    return {
+        "_id": {"station": "$_id.station", "period": period, "start": "$_id.start"},
+        "station": "$_id.station",
+        "period": period,
+        "start": "$_id.start",
+        "count": "$count",
+        "fields": {field: {stat: f"$f{i}_{stat}" for stat in ("count", "sum", "min", "max")}
+                   for i, field in enumerate(fields)},
+    }
+
+
+def merge_stage():
+    return {"$merge": {"into": rollup_collection_name, "on": "_id", "whenMatched": "replace",
+                       "whenNotMatched": "insert"}}
+
+
+def hourly_pipeline(fields, ranges):
+    group = {"_id": {"station": "$station", "start": truncate("$datetime", "hour")}, "count": {"$sum": 1}}
+    for i, field in enumerate(fields):
+        value = number(field)
+        group[f"f{i}_count"] = {"$sum": {"$cond": [{"$eq": [value, None]}, 0, 1]}}
+        group[f"f{i}_sum"] = {"$sum": value}
+        group[f"f{i}_min"] = {"$min": value}
+        group[f"f{i}_max"] = {"$max": value}
+    return [
+        {"$match": window_match(ranges, "datetime")},
+        {"$group": group},
+        {"$project": rollup_document(fields, "hour")},
+        merge_stage(),
+    ]
+
+
+def daily_pipeline(fields, ranges):
+    group = {"_id": {"station": "$station", "start": truncate("$start", "day")}, "count": {"$sum": "$count"}}
+    for i, field in enumerate(fields):
+        group[f"f{i}_count"] = {"$sum": f"$fields.{field}.count"}
+        group[f"f{i}_sum"] = {"$sum": f"$fields.{field}.sum"}
+        group[f"f{i}_min"] = {"$min": f"$fields.{field}.min"}
+        group[f"f{i}_max"] = {"$max": f"$fields.{field}.max"}
+    return [
+        {"$match": {"period": "hour", **window_match(ranges, "start")}},
+        {"$group": group},
+        {"$project": rollup_document(fields, "day")},
+        merge_stage(),
+    ]
+
+
+def update_rollups(collection, rollups, tag, fields=None):
+    """
+    Recompute the hourly then daily rollups of the days touched by the migration tag.
+    `collection` is the weather collection, `rollups` the rollup collection (same database, as $merge requires).
+    """
+    fields = numeric_fields() if fields is None else fields
+    ranges = day_ranges(touched_days(collection, tag))
+    if not ranges:
+        logger.info(f"No rollup to update for {tag}")
+        return ranges
+    rollups.create_index([("period", ASCENDING), ("station", ASCENDING), ("start", ASCENDING)],
+                         name="period_station_start")
+    collection.aggregate(hourly_pipeline(fields, ranges), allowDiskUse=True)
+    rollups.aggregate(daily_pipeline(fields, ranges), allowDiskUse=True)
+    logger.info(f"Rollups of {len(ranges)} station day ranges updated in {rollup_collection_name} for {tag}")
+    return ranges
+
+
+def schedule_rollups(collection, rollups, tag, timer, deferred=None):
+    """
+    Update the rollups of the migration tag now or, in a bulk load (a DeferredIndexes, see create_collection.py),
+    once the `migrated` index they match on is rebuilt.
+    """
+    def update():
+        with timer.stage("rollups"):
+            update_rollups(collection, rollups, tag)
+
+    if deferred is None:
+        update()
+    else:
+        deferred.after(update)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute the hourly and daily rollups touched by a migration")
+    parser.add_argument("migration_tag", help="The `migrated` tag of the documents whose days are recomputed")
+    parser.add_argument(
+        "--mongodb_address",
+        default="mongodb://localhost:27017/",
+        help="The MongoDB address (default: mongodb://localhost:27017/)"
+    )
+
+    parser.add_argument(
+        "-v", "--verbosity",
+        type=upper_case,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging verbosity level (default: INFO)"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=getattr(logging, args.verbosity))
+    client = MongoClient(args.mongodb_address)
+    update_rollups(weather_collection(client), rollup_collection(client), args.migration_tag)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import fnmatch
+import logging
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from common import bucket_name
+
+"""
+S3 source layer shared by the migration scripts.
+The objects of a source are found by listing the `greencoop-airbyte` prefix (paginated `list_objects_v2`)
+and selected with a pattern and a date range, so a new Airbyte sync needs no code change.
+They are downloaded with ranged GETs of `part_size` bytes, the parts of the next `objects_ahead` objects going through
+one thread pool, so the throughput is bounded by the network bandwidth and not by the latency of one request,
+and the memory by a few objects and not by the whole selection.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Size of the ranged GETs, and number of them in flight
+part_size = 8 * 1024 * 1024
+download_workers = 8
+
+# Objects downloaded ahead of the one being consumed
+objects_ahead = 4
+
+# Airbyte names its files YYYY_MM_DD_<epoch ms>_<part>.jsonl
+airbyte_key_date = re.compile(r"(\d{4})_(\d{2})_(\d{2})_\d+_\d+\.\w+$")
+
+
+def list_objects(s3, prefix, bucket=bucket_name):
+    """
+    Yield every object (Key, Size, ETag, LastModified) under the prefix, one page of 1000 keys at a time.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get('Contents', [])
+
+
+def pattern_prefix(pattern):
+    # The literal start of the pattern is the prefix that S3 can filter on
+    return re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+
+
+def object_date(obj):
+    """
+    Date of the sync an object comes from: the date in the Airbyte file name, else its LastModified date.
+    """
+    match = airbyte_key_date.search(obj['Key'])
+    if match:
+        year, month, day = map(int, match.groups())
+        return obj['LastModified'].date().replace(year=year, month=month, day=day)
+    return obj['LastModified'].date()
+
+
+def select_objects(s3, pattern, since=None, until=None, latest=None, bucket=bucket_name):
+    """
+    Objects whose key matches the shell-style pattern and whose date is within [since, until], oldest first.
+    With `latest`, only the `latest` most recent ones are kept.
+    """
+    objects = [
+        obj for obj in list_objects(s3, pattern_prefix(pattern), bucket)
+        if fnmatch.fnmatchcase(obj['Key'], pattern)
+        and (since is None or object_date(obj) >= since)
+        and (until is None or object_date(obj) <= until)
+    ]
+    objects.sort(key=lambda obj: (object_date(obj), obj['Key']))
+    if latest:
+        objects = objects[-latest:]
+    return objects
+
+
+def part_ranges(size, part_size=part_size):
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+
+def get_range(s3, bucket, key, etag, start, end):
+    # IfMatch makes S3 refuse the part if the object was replaced during the download
+    response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)
+    return start, response['Body'].read()
+
+
+def download_objects(s3, objects, workers=download_workers, part_size=part_size, bucket=bucket_name,
+                     ahead=objects_ahead):
+    """
+    Yield (object, content) for every object, in the given order.
+    Each object is split into ranged GETs submitted to the pool, for at most `ahead` objects besides
+    the one being consumed; the content is a bytearray of the object size filled in place.
+    """
+    def submit(obj):
+        return obj, [executor.submit(get_range, s3, bucket, obj['Key'], obj['ETag'], start, end)
+                     for start, end in part_ranges(obj['Size'], part_size)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        remaining = iter(objects)
+        pending = deque(submit(obj) for obj in islice(remaining, max(ahead, 1)))
+        while pending:
+            obj, futures = pending.popleft()
+            # The next object starts downloading while this one is assembled and consumed
+            for following in islice(remaining, 1):
+                pending.append(submit(following))
+            content = bytearray(obj['Size'])
+            for future in futures:
+                start, data = future.result()
+                content[start:start + len(data)] = data
+            logger.debug(f"Downloaded {obj['Key']} ({obj['Size']} bytes in {len(futures)} parts)")
+            yield obj, content
@@ -0,0 +1,179 @@
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId, json_util
+from pymongo import ReplaceOne
+
+from common import database_name
+from create_collection import load_schema
+
+"""
+Client-side pre-validation of the frames against the `$jsonSchema` of schema.json, before the insert.
+The schema is compiled once into column checks (required, bsonType, minimum / maximum, enum) run on whole columns,
+so the rows the server would refuse with a code-121 error are found before they are encoded and sent.
+The BSON type of a value is the one pymongo gives it at the insert: a NaN is a double in the documents of xlsx.py
+(to_dict keeps it) but null in the documents of jsonl.py (frame_to_documents turns it into None).
+Invalid rows are diverted in bulk to the `weather_station_quarantine` collection or to a JSONL file,
+with the reason of their rejection.
+"""
+
+logger = logging.getLogger(__name__)
+
+quarantine_collection_name = "weather_station_quarantine"
+default_quarantine_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "quarantine")
+
+# BSON type of the Python values pymongo encodes (an int out of the int32 range is a "long")
+python_bson_types = {
+    str: "string", float: "double", np.float64: "double", int: "int", np.int64: "int", bool: "bool",
+    np.bool_: "bool", datetime: "date", pd.Timestamp: "date", ObjectId: "objectId", type(None): "null",
+    dict: "object", list: "array", bytes: "binData",
+}
+
+# The "number" alias of $jsonSchema
+number_types = ["int", "long", "double", "decimal"]
+
+int32_max = 2 ** 31 - 1
+
+
+def bson_types(column, nan_is_null):
+    """
+    The bsonType of every value of the column once inserted, as an array of names.
+    """
+    missing = column.isna().to_numpy()
+    if pd.api.types.is_bool_dtype(column.dtype):
+        types = np.full(len(column), "bool", dtype=object)
+    elif pd.api.types.is_integer_dtype(column.dtype):
+        values = column.to_numpy(dtype="float64", na_value=np.nan)
+        types = np.where(np.abs(values) > int32_max, "long", "int").astype(object)
+    elif pd.api.types.is_float_dtype(column.dtype):
+        types = np.full(len(column), "double", dtype=object)
+        if not nan_is_null:
+            missing = np.zeros(len(column), dtype=bool)
+    elif pd.api.types.is_datetime64_any_dtype(column.dtype):
+        types = np.full(len(column), "date", dtype=object)
+    else:
+        # object column: the type of every value, looked up once per distinct type
+        types = column.map(type).map(python_bson_types).fillna("unknown").to_numpy(dtype=object)
+        values = column.to_numpy(dtype=object)
+        is_int = types == "int"
+        if is_int.any():
+            types[is_int] = np.where(np.abs(values[is_int].astype("float64")) > int32_max, "long", "int")
+        if not nan_is_null:
+            # A float NaN stays a double, only None and NaT are null
+            missing = missing & (types != "double")
+    types[missing] = "null"
+    return types
+
+
+class SchemaCheck:
+    """
+    The rules of a `$jsonSchema` ({"$jsonSchema": {...}} or the schema itself) applied to the columns of a frame.
+    """
+
+    def __init__(self, schema=None, nan_is_null=False):
+        schema = load_schema() if schema is None else schema
+        schema = schema.get("$jsonSchema", schema)
+        self.required = schema.get("required", [])
+        self.properties = schema.get("properties", {})
+        self.additional_properties = schema.get("additionalProperties", True)
+        self.nan_is_null = nan_is_null
+
+    def rules(self, df):
+        """
+        Yield (rule, failed rows mask) for every rule of the schema.
+        """
+        size = len(df)
+        for field in self.required:
+            if field not in df.columns:
+                yield f"{field}: required", np.ones(size, dtype=bool)
+        if self.additional_properties is False:
+            for column in df.columns:
+                if column not in self.properties:
+                    yield f"{column}: not allowed", np.ones(size, dtype=bool)
+
+        for field, rule in self.properties.items():
+            if field not in df.columns:
+                continue
+            column = df[field]
+            if "bsonType" in rule:
+                allowed = rule["bsonType"] if isinstance(rule["bsonType"], list) else [rule["bsonType"]]
+                if "number" in allowed:
+                    allowed = allowed + number_types
+                types = bson_types(column, self.nan_is_null)
+                failed = ~np.isin(types, allowed)
+                if failed.any():
+                    yield f"{field}: bsonType not in {allowed}", failed
+            if "minimum" in rule or "maximum" in rule:
+                numbers = pd.to_numeric(column, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+                with np.errstate(invalid="ignore"):
+                    if "minimum" in rule:
+                        yield f"{field}: below {rule['minimum']}", numbers < rule["minimum"]
+                    if "maximum" in rule:
+                        yield f"{field}: above {rule['maximum']}", numbers > rule["maximum"]
+            if "enum" in rule:
+                yield f"{field}: not in enum", ~column.isin(rule["enum"]).to_numpy()
+
+    def validate(self, df):
+        """
+        Returns the mask of the valid rows and the reason of the first rule failed by every row ("" if valid).
+        """
+        reasons = np.full(len(df), "", dtype=object)
+        for rule, failed in self.rules(df):
+            reasons[failed & (reasons == "")] = rule
+        return reasons == "", pd.Series(reasons, index=df.index)
+
+    def split(self, df):
+        """
+        Returns the valid rows and the invalid ones, with a `quarantine_reason` column, and the counts by reason.
+        """
+        valid, reasons = self.validate(df)
+        if valid.all():
+            return df, df.iloc[:0], Counter()
+        rejected = df[~valid].copy()
+        rejected["quarantine_reason"] = reasons[~valid]
+        counts = Counter(rejected["quarantine_reason"])
+        for reason, count in counts.most_common():
+            logger.warning(f"Schema check: {count} rows rejected, {reason}")
+        return df[valid], rejected, counts
+
+
+def quarantine_collection(client):
+    return client[database_name][quarantine_collection_name]
+
+
+def open_quarantine(client, kind):
+    """
+    The quarantine of the --quarantine option: "collection", "file" (a directory) or "none".
+    """
+    if kind == "collection":
+        return quarantine_collection(client)
+    if kind == "file":
+        return default_quarantine_dir
+    return None
+
+
+def quarantine(documents, target, source, migration_tag):
+    """
+    Store the rejected documents (with their `quarantine_reason`) in a collection, replaced by _id,
+    or in a JSONL file of a directory (target as str). Nothing is kept with no target.
+    """
+    if not documents or target is None:
+        return
+    quarantined_at = datetime.now()
+    for document in documents:
+        document["quarantined_at"] = quarantined_at
+    if isinstance(target, str):
+        os.makedirs(target, exist_ok=True)
+        path = os.path.join(target, f"{migration_tag}.jsonl")
+        with open(path, "a", encoding="utf-8") as f:
+            for document in documents:
+                f.write(json_util.dumps(document, ensure_ascii=False) + "\n")
+        logger.info(f"{len(documents)} {source} documents quarantined in {path}")
+    else:
+        target.bulk_write([ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents],
+                          ordered=False)
+        logger.info(f"{len(documents)} {source} documents quarantined in {target.name}")
@@ -0,0 +1,164 @@
+import argparse
+import json
+import logging
+import os
+
+from pymongo import MongoClient, errors
+
+from common import weather_collection
+
+"""
+Post-migration verification done by MongoDB.
+One aggregation per migration tag computes, for every numeric field of schema.json, overall and per station:
+count, min, max, mean and median. Only the small result goes over the wire, not the migrated documents.
+The median comes from `$median` (MongoDB 7.0+); on older servers, such as the mongo:4.4 of docker-compose.yml,
+the same aggregation gets one more facet per field and grouping, where the numeric values are sorted, pushed
+into one array per group and the middle ones picked. The arrays stay on the server (only the medians are returned),
+but a group's array is held in memory: a few tens of bytes per value, under the 100 MB of a $group stage for
+the few million readings of a station.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Error codes of an unknown accumulator or expression ($median on MongoDB < 7.0)
+unknown_operator_codes = {15952, 168, 5787909}
+
+
+def numeric_fields():
+    """
+    The fields whose bsonType in schema.json accepts int or double.
+    """
+    schema_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.json')
+    with open(schema_path, 'r', encoding='utf-8') as schema_file:
+        properties = json.load(schema_file)["$jsonSchema"]["properties"]
+    fields = []
+    for field, rule in properties.items():
+        types = rule["bsonType"] if isinstance(rule["bsonType"], list) else [rule["bsonType"]]
+        if "int" in types or "double" in types:
+            fields.append(field)
+    return fields
+
+
+def number(field):
+    # The value of the field if it is a number other than NaN, else null (ignored by $min, $max, $avg and $median).
+    # NaN sorts below every number, so it fails the $gte
+    value = f"${field}"
+    is_number = {"$and": [{"$isNumber": value}, {"$gte": [value, float("-inf")]}]}
+    return {"$cond": [is_number, value, None]}
+
+
+def group_stage(fields, key, with_median):
+    group = {"_id": key, "count": {"$sum": 1}}
+    for i, field in enumerate(fields):
+        value = number(field)
+        group[f"f{i}_count"] = {"$sum": {"$cond": [{"$eq": [value, None]}, 0, 1]}}
+        group[f"f{i}_min"] = {"$min": value}
+        group[f"f{i}_max"] = {"$max": value}
+        group[f"f{i}_mean"] = {"$avg": value}
+        if with_median:
+            group[f"f{i}_median"] = {"$median": {"input": value, "method": "approximate"}}
+    return {"$group": group}
+
+
+def middle(values):
+    # Mean of the middle elements of a sorted array expression
+    size = {"$size": values}
+    lower = {"$arrayElemAt": [values, {"$floor": {"$divide": [{"$subtract": [size, 1]}, 2]}}]}
+    upper = {"$arrayElemAt": [values, {"$floor": {"$divide": [size, 2]}}]}
+    return {"$divide": [{"$add": [lower, upper]}, 2]}
+
+
+def median_facets(fields):
+    """
+    Facets computing the exact median of every field, overall (f<i>_overall) and per station (f<i>_stations),
+    for the servers without $median.
+    """
+    facets = {}
+    for i, field in enumerate(fields):
+        # NaN sorts below every number, so it fails the $gte
+        sort = [{"$match": {field: {"$gte": float("-inf")}}}, {"$sort": {field: 1}}]
+        for name, key in [("overall", None), ("stations", "$station")]:
+            facets[f"f{i}_{name}"] = sort + [
+                {"$group": {"_id": key, "values": {"$push": f"${field}"}}},
+                {"$project": {"median": middle("$values")}},
+            ]
+    return facets
+
+
+def to_stats(result, fields):
+    return {
+        field: {
+            "count": result[f"f{i}_count"],
+            "min": result[f"f{i}_min"],
+            "max": result[f"f{i}_max"],
+            "mean": result[f"f{i}_mean"],
+            "median": result.get(f"f{i}_median"),
+        }
+        for i, field in enumerate(fields)
+    }
+
+
+def migration_stats(collection, tag, fields=None):
+    """
+    Statistics of the documents of a migration tag, computed by one aggregation:
+    {"row_count": n, "fields": {field: stats}, "stations": {station: {"row_count": n, "fields": {field: stats}}}}
+    where stats holds count (numeric values), min, max, mean and median.
+    """
+    fields = numeric_fields() if fields is None else fields
+
+    def aggregate(with_median):
+        facets = {
+            "overall": [group_stage(fields, None, with_median)],
+            "stations": [group_stage(fields, "$station", with_median)],
+        }
+        if not with_median:
+            facets.update(median_facets(fields))
+        pipeline = [{"$match": {"migrated": tag}}, {"$facet": facets}]
+        return next(collection.aggregate(pipeline, allowDiskUse=True))
+
+    try:
+        result = aggregate(with_median=True)
+        with_median = True
+    except errors.OperationFailure as e:
+        if e.code not in unknown_operator_codes:
+            raise
+        logger.info("$median is not supported by this server, the medians are computed from sorted arrays")
+        result = aggregate(with_median=False)
+        with_median = False
+
+    overall = result["overall"][0] if result["overall"] else None
+    stats = {
+        "row_count": overall["count"] if overall else 0,
+        "fields": to_stats(overall, fields) if overall else {},
+        "stations": {
+            station["_id"]: {"row_count": station["count"], "fields": to_stats(station, fields)}
+            for station in result["stations"]
+        },
+    }
+
+    if not with_median:
+        for i, field in enumerate(fields):
+            for group in result[f"f{i}_overall"]:
+                stats["fields"][field]["median"] = group["median"]
+            for group in result[f"f{i}_stations"]:
+                stats["stations"][group["_id"]]["fields"][field]["median"] = group["median"]
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print the statistics of a migration, computed by MongoDB")
+    parser.add_argument("migration_tag", help="The `migrated` tag of the documents to check")
+    parser.add_argument(
+        "--mongodb_address",
+        default="mongodb://localhost:27017/",
+        help="The MongoDB address (default: mongodb://localhost:27017/)"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    stats = migration_stats(weather_collection(MongoClient(args.mongodb_address)), args.migration_tag)
+    print(json.dumps(stats, indent=4, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, errors
+
+import jsonl
+import xlsx
+from common import database_name, make_migration_tag, write_metrics
+from dedup import Deduplicator
+from instrument import StageTimer
+from manifest import changed_objects, record_objects, source_watermark
+from metrics import MetricsAccumulator
+from rollups import update_rollups
+from s3_source import download_objects, select_objects
+
+"""
+Distributed migration: several containers running `python -m migration worker` share the work of a job.
+`python -m migration plan <sources>` selects the S3 objects of the sources and writes one work unit per object
+in the `migration_work` collection of `weather_data`, then the job in `migration_jobs`, with one migration tag
+per source. Each worker claims the largest pending unit with an atomic find_one_and_update that sets a lease,
+extended by a heartbeat thread while the unit is processed. The unit of a crashed worker is claimed again by another
+once its lease expires; a unit that failed `max_attempts` times is marked failed.
+The readings are deduplicated per job: before they are sent, the _ids a unit keeps are claimed in the
+`migration_claims` collection, whose _id is unique. A reading shared by several objects of the job (the InfoClimat
+exports overlap) is inserted and counted by the unit claiming it first, and skipped by the others, also in a
+time-series collection, which has no unique index on _id. A retried unit keeps the claims of its lost attempt
+and sends their readings again: those already inserted come back as duplicates and are counted once.
+The claims of a job are deleted once it is finalized.
+An object is the smallest unit: an export is not split in byte ranges, whose bounds would fall inside
+its Airbyte lines.
+Every finished unit stores its summary, metrics (with their KLL sketches) and manifest stats. Once no unit is pending
+or running, one worker takes the job with a lease too, merges the metrics of the units of every source, records
+the objects in the manifest and updates the rollups; then every worker writes the merged expected metrics files.
+The leases compare the clocks of the workers, kept in sync by NTP on EC2.
+"""
+
+logger = logging.getLogger(__name__)
+
+work_collection_name = "migration_work"
+job_collection_name = "migration_jobs"
+claim_collection_name = "migration_claims"
+
+# A unit whose lease is not extended for this long is claimed again
+lease_seconds = 120
+heartbeat_seconds = 30
+max_attempts = 3
+
+# Seconds between two looks at the queue when nothing can be claimed
+poll_seconds = 5
+
+# Fields of the expected metrics files with a median, min and max
+metric_keys = {"xlsx": xlsx.columns_of_interest, "jsonl": jsonl.numeric_keys}
+file_patterns = {"xlsx": xlsx.file_patterns, "jsonl": jsonl.file_patterns}
+
+
+def work_collection(client):
+    return client[database_name][work_collection_name]
+
+
+def job_collection(client):
+    return client[database_name][job_collection_name]
+
+
+def claim_collection(client):
+    return client[database_name][claim_collection_name]
+
+
+def utc_now():
+    # pymongo stores naive datetimes as UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def plan_job(work, jobs, s3, sources, since=None, until=None, latest=1, manifest=None, incremental=False,
+             new_records_only=False):
+    """
+    Write the work units of the selected objects of every source (name: "xlsx" or "jsonl"), then the job.
+    Returns the job id, None if there is nothing to migrate.
+    """
+    job_id = f"{datetime.now().strftime('%Y-%m-%d_%Hh%M%S')}_{uuid.uuid4().hex[:8]}"
+    job_sources = {}
+    units = []
+    for source, kind in sources.items():
+        objects = select_objects(s3, file_patterns[kind][source], since, until, 1 if kind == "xlsx" else latest)
+        if manifest is not None and incremental:
+            objects = changed_objects(manifest, objects)
+        if not objects:
+            logger.info(f"Nothing to migrate for {source}")
+            continue
+        emitted_after = None
+        if kind == "jsonl" and manifest is not None and new_records_only:
+            emitted_after = source_watermark(manifest, source)
+        job_sources[source] = {"kind": kind, "migration_tag": make_migration_tag(source)}
+        for obj in objects:
+            units.append({
+                "_id": f"{job_id}/{obj['Key']}",
+                "job": job_id,
+                "source": source,
+                "kind": kind,
+                "migration_tag": job_sources[source]["migration_tag"],
+                "key": obj["Key"],
+                "etag": obj["ETag"],
+                "size": obj["Size"],
+                "last_modified": obj["LastModified"],
+                "emitted_after": emitted_after,
+                "state": "pending",
+                "owner": None,
+                "lease_expires": None,
+                "attempts": 0,
+            })
+    if not units:
+        return None
+    work.create_index([("job", ASCENDING), ("state", ASCENDING), ("size", DESCENDING)])
+    claim_collection(work.database.client).create_index("job")
+    # The units first: a worker that sees the job sees all its units
+    work.insert_many(units)
+    jobs.insert_one({"_id": job_id, "state": "running", "sources": job_sources, "units": len(units),
+                     "lease_expires": None, "created_at": datetime.now()})
+    logger.info(f"Job {job_id}: {len(units)} work units for {list(job_sources)}")
+    return job_id
+
+
+def claim(work, job_id, worker_id, lease=lease_seconds):
+    """
+    Atomically take the largest unit of the job that is pending or whose lease expired, None if there is none.
+    The largest units go first, so the last ones to finish are small and the workers end together.
+    """
+    now = utc_now()
+    return work.find_one_and_update(
+        {"job": job_id, "attempts": {"$lt": max_attempts},
+         "$or": [{"state": "pending"}, {"state": "running", "lease_expires": {"$lt": now}}]},
+        {"$set": {"state": "running", "owner": worker_id, "lease_expires": now + timedelta(seconds=lease),
+                  "heartbeat_at": now},
+         "$inc": {"attempts": 1}},
+        sort=[("size", DESCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def expire_units(work, job_id):
+    """
+    Mark failed the units whose last attempt lost its lease.
+    """
+    result = work.update_many(
+        {"job": job_id, "state": "running", "lease_expires": {"$lt": utc_now()}, "attempts": {"$gte": max_attempts}},
+        {"$set": {"state": "failed", "error": "lease expired", "lease_expires": None}},
+    )
+    if result.modified_count:
+        logger.error(f"{result.modified_count} units failed {max_attempts} times")
+
+
+class Heartbeat:
+    """
+    Extend the lease of a unit every `interval` seconds while it is processed, from a daemon thread.
+    `lost` is set if another worker took the unit (this worker was considered dead).
+    """
+
+    def __init__(self, work, unit, worker_id, lease=lease_seconds, interval=heartbeat_seconds):
+        self.work = work
+        self.unit = unit
+        self.worker_id = worker_id
+        self.lease = lease
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self.beat, name=f"heartbeat-{unit['key']}", daemon=True)
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            now = utc_now()
+            result = self.work.update_one(
+                {"_id": self.unit["_id"], "owner": self.worker_id, "state": "running"},
+                {"$set": {"lease_expires": now + timedelta(seconds=self.lease), "heartbeat_at": now}},
+            )
+            if result.matched_count == 0:
+                logger.warning(f"Lease of {self.unit['key']} lost, another worker migrates it again")
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+class UnitDeduplicator(Deduplicator):
+    """
+    Deduplicator of a work unit, which also skips the readings claimed by another unit of the job (counted in
+    `skipped_other_unit`) and claims the others. With `skip_duplicates` false, only the claims are checked.
+    """
+
+    def __init__(self, collection, claims, unit, mode="insert", skip_duplicates=True):
+        super().__init__(collection, mode)
+        self.claims = claims
+        self.unit = unit
+        self.skip_duplicates = skip_duplicates
+        if unit["attempts"] > 1:
+            # The documents inserted by a lost attempt are sent again, to be counted in the metrics of the unit
+            self.resumed_tag = unit["migration_tag"]
+
+    def claimed_mask(self, ids):
+        """
+        Mask of the _ids claimed by another unit of the job, the other ones are claimed by this unit.
+        """
+        keys = [f"{self.unit['job']}/{_id}" for _id in ids]
+        try:
+            self.claims.insert_many([{"_id": key, "job": self.unit["job"], "unit": self.unit["_id"]} for key in keys],
+                                    ordered=False)
+            return np.zeros(len(keys), dtype=bool)
+        except errors.BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+        # Already claimed, by another unit or by a lost attempt of this one
+        taken = {document["_id"] for document in
+                 self.claims.find({"_id": {"$in": keys}, "unit": {"$ne": self.unit["_id"]}}, {"_id": 1})}
+        return np.fromiter((key in taken for key in keys), dtype=bool, count=len(keys))
+
+    def filter(self, df):
+        if self.skip_duplicates:
+            df = super().filter(df)
+        if df.empty:
+            return df
+        claimed = self.claimed_mask(df["_id"].to_numpy(dtype=object))
+        self.counts["skipped_other_unit"] += int(claimed.sum())
+        if claimed.any():
+            logger.info(f"{claimed.sum()} readings migrated by another unit of the job skipped")
+            return df[~claimed]
+        return df
+
+
+def process_unit(unit, s3, collection, mongodb_address, chunk_size=5000, workers=4, mode="insert",
+                 quarantine_target=None, raw_bson=False, dedup=True, engine="auto", processes=None, timer=None):
+    """
+    Download, transform and insert the object of a unit. Returns its summary, metrics and manifest stats.
+    """
+    source, migration_tag = unit["source"], unit["migration_tag"]
+    timer = StageTimer(source) if timer is None else timer
+    deduplicator = UnitDeduplicator(collection, claim_collection(collection.database.client), unit, mode, dedup)
+    obj = {"Key": unit["key"], "ETag": unit["etag"], "Size": unit["size"]}
+    with timer.stage("download") as stage:
+        _, content = next(download_objects(s3, [obj]))
+        stage.bytes_in = len(content)
+
+    if unit["kind"] == "xlsx":
+        with timer.stage("parse", bytes_in=len(content)) as stage:
+            raw = xlsx.parse_workbook(content, engine, processes)
+            stage.rows_out = len(raw)
+        with timer.stage("transform", rows_in=len(raw)) as stage:
+            frame = xlsx.convert(raw, source)
+            stage.rows_out = len(frame)
+        summary, final_df2 = xlsx.migrate_frame(frame, collection, source, migration_tag, chunk_size, workers, mode,
+                                                timer, quarantine_target, raw_bson, deduplicator)
+        with timer.stage("metrics", rows_in=len(final_df2)):
+            metrics = xlsx.compute_metrics(final_df2, migration_tag, mongodb_address)
+        stats = {"row_count": len(final_df2)}
+    else:
+        with timer.stage("parse", bytes_in=len(content)) as stage:
+            frame, stats = jsonl.parse_export(unit["key"], content, unit.get("emitted_after"))
+            stage.rows_out = len(frame)
+        accumulator = MetricsAccumulator()
+        summary = jsonl.migrate([frame], collection, migration_tag, mongodb_address, source, chunk_size, workers,
+                                mode, timer, quarantine_target, raw_bson, deduplicator, accumulator)
+        metrics = jsonl.compute_metrics(migration_tag, mongodb_address, accumulator)
+    return summary, metrics, stats
+
+
+def complete(work, unit, worker_id, summary, metrics, stats):
+    result = work.update_one(
+        {"_id": unit["_id"], "owner": worker_id, "state": "running"},
+        {"$set": {"state": "done", "summary": dict(summary), "metrics": metrics, "stats": stats,
+                  "finished_at": utc_now(), "lease_expires": None}},
+    )
+    if result.matched_count == 0:
+        logger.warning(f"{unit['key']} was taken by another worker, its results are left to it")
+
+
+def release(work, unit, worker_id, error):
+    """
+    Give back a unit that failed, to be retried by any worker, or mark it failed after `max_attempts`.
+    """
+    state = "failed" if unit["attempts"] >= max_attempts else "pending"
+    work.update_one(
+        {"_id": unit["_id"], "owner": worker_id, "state": "running"},
+        {"$set": {"state": state, "owner": None, "lease_expires": None, "error": repr(error)}},
+    )
+
+
+def merge_metrics(units, kind):
+    """
+    The expected metrics of a source from the metrics of its units: the accumulators (exact moments and KLL sketches)
+    are merged, the other entries are those of the first unit.
+    """
+    accumulator = MetricsAccumulator.from_dict(units[0]["metrics"])
+    for unit in units[1:]:
+        accumulator.merge(MetricsAccumulator.from_dict(unit["metrics"]))
+    metrics = dict(units[0]["metrics"])
+    metrics["row_count"] = accumulator.row_count
+    metrics.update(accumulator.summary(metric_keys[kind]))
+    metrics.update(accumulator.to_dict())
+    return metrics
+
+
+def finalize(work, jobs, job, collection, manifest=None, rollups=None):
+    """
+    Merge the results of the units of every source into the job, record them in the manifest, update the rollups.
+    A source with a failed unit gets no metrics, its objects are left out of the manifest.
+    """
+    units = list(work.find({"job": job["_id"]}))
+    metrics = {}
+    summary = Counter()
+    failed = [unit["key"] for unit in units if unit["state"] != "done"]
+    for source, info in job["sources"].items():
+        source_units = [unit for unit in units if unit["source"] == source]
+        for unit in source_units:
+            summary.update(unit.get("summary", {}))
+        if any(unit["state"] != "done" for unit in source_units):
+            logger.error(f"{source} has failed units, its metrics are not merged")
+            continue
+        metrics[source] = merge_metrics(source_units, info["kind"])
+        if manifest is not None:
+            objects = [{"Key": unit["key"], "ETag": unit["etag"], "Size": unit["size"],
+                        "LastModified": unit["last_modified"]} for unit in source_units]
+            record_objects(manifest, objects, source, info["migration_tag"],
+                           {unit["key"]: unit["stats"] for unit in source_units})
+        if rollups is not None:
+            update_rollups(collection, rollups, info["migration_tag"])
+    claim_collection(work.database.client).delete_many({"job": job["_id"]})
+    state = "failed" if failed else "done"
+    jobs.update_one({"_id": job["_id"]}, {"$set": {"state": state, "metrics": metrics, "summary": dict(summary),
+                                                   "failed_units": failed, "finished_at": utc_now()}})
+    logger.info(f"Job {job['_id']} {state}: {summary['inserted']} documents inserted by {len(units)} units")
+    return jobs.find_one({"_id": job["_id"]})
+
+
+def finish_job(work, jobs, job_id, worker_id, collection, manifest=None, rollups=None, lease=lease_seconds):
+    """
+    Wait for the job to be finalized, by this worker if it is the first to get there (or if the worker
+    finalizing it died), and return it.
+    """
+    while True:
+        now = utc_now()
+        job = jobs.find_one_and_update(
+            {"_id": job_id, "$or": [{"state": "running"},
+                                    {"state": "finalizing", "lease_expires": {"$lt": now}}]},
+            {"$set": {"state": "finalizing", "owner": worker_id, "lease_expires": now + timedelta(seconds=lease)}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is not None:
+            return finalize(work, jobs, job, collection, manifest, rollups)
+        job = jobs.find_one({"_id": job_id})
+        if job["state"] in ("done", "failed"):
+            return job
+        time.sleep(poll_seconds)
+
+
+def wait_for_job(jobs, job_id=None):
+    """
+    The given job, or the most recent running one, waiting for it to be planned.
+    """
+    query = {"_id": job_id} if job_id else {"state": "running"}
+    while True:
+        job = jobs.find_one(query, sort=[("created_at", DESCENDING)])
+        if job is not None:
+            return job
+        logger.info("Waiting for a job to be planned")
+        time.sleep(poll_seconds)
+
+
+def run_worker(client, s3, collection, mongodb_address, job_id=None, manifest=None, rollups=None, **options):
+    """
+    Process the units of a job until none is left, then finish the job and write its expected metrics files.
+    `options` are those of process_unit. Returns the finished job.
+    """
+    work, jobs = work_collection(client), job_collection(client)
+    worker_id = worker_name()
+    job = wait_for_job(jobs, job_id)
+    logger.info(f"Worker {worker_id} on job {job['_id']}")
+    processed = 0
+    while True:
+        unit = claim(work, job["_id"], worker_id)
+        if unit is None:
+            expire_units(work, job["_id"])
+            if work.count_documents({"job": job["_id"], "state": {"$in": ["pending", "running"]}}) == 0:
+                break
+            # Units of other workers are running, one of them may die
+            time.sleep(poll_seconds)
+            continue
+        logger.info(f"Claimed {unit['key']} (attempt {unit['attempts']})")
+        start = time.perf_counter()
+        try:
+            with Heartbeat(work, unit, worker_id):
+                summary, metrics, stats = process_unit(unit, s3, collection, mongodb_address, **options)
+        except Exception as e:
+            logger.exception(f"Migration of {unit['key']} failed")
+            release(work, unit, worker_id, e)
+            continue
+        complete(work, unit, worker_id, summary, metrics, stats)
+        processed += 1
+        logger.info(f"{unit['key']} migrated in {time.perf_counter() - start:.2f}s")
+
+    logger.info(f"Worker {worker_id} processed {processed} units")
+    job = finish_job(work, jobs, job["_id"], worker_id, collection, manifest, rollups)
+    for source, metrics in job.get("metrics", {}).items():
+        write_metrics(metrics, source)
+    return job
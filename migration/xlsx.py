@@ -2,19 +2,38 @@
 # coding: utf-8
 
 import sys
-import json
-import re
 import argparse
-from datetime import datetime
-from io import BytesIO
+import importlib.util
 import os
-import hashlib
+from contextlib import nullcontext
+from datetime import date
+from io import BytesIO
 import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
+import numpy as np
 import pandas as pd
-import boto3
-from pymongo import MongoClient, errors
-from bson import ObjectId
+from pymongo import MongoClient
+
+from bson_sink import frame_to_raw_documents
+from bulk_insert import insert_documents, log_insert_summary
+from cache import FrameCache, default_cache_dir, default_max_bytes
+from checkpoint import Checkpoint, checkpoint_collection
+from common import (bucket_name, load_secrets, make_migration_tag, process_context, s3_client, upper_case,
+                    weather_collection, write_metrics)
+from create_collection import deferred_indexes, write_mode
+from dedup import Deduplicator
+from ids import generate_objectids
+from instrument import StageTimer, default_profile_dir, write_report
+from manifest import changed_objects, manifest_collection, record_objects
+from metrics import MetricsAccumulator
+from pipeline import Pipeline, Step, default_queue_size
+from rollups import rollup_collection, schedule_rollups
+from schema_check import SchemaCheck, open_quarantine, quarantine
+from s3_source import download_objects, select_objects
 
 
 """
@@ -27,76 +46,188 @@ python xlsx.py [station_name]
 where `station_name` is either `Ichtegem` or `Madeleine` (don't include the brackets).
 If no station name is provided, the script will default to `Ichtegem`.
 """
-parser = argparse.ArgumentParser(description="Process an Excel file")
-parser.add_argument(
-    'file',
-    default='Ichtegem',
-    help='The name of the station to process. Only accepts Ichtegem or Madeleine'
-)
-
-parser.add_argument(
-    "--mongodb_address", 
-    default="mongodb://localhost:27017/", 
-    help="The MongoDB address (default: mongodb://localhost:27017/)"
-)
-
-def upper_case(string):
-    return string.upper()
-parser.add_argument(
-    "-v", "--verbosity",
-    type=upper_case,
-    default="INFO", 
-    choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
-    help="Set the logging verbosity level (default: INFO)"
-)
-
-args = parser.parse_args()
-
-log_level = getattr(logging, args.verbosity)
-logging.basicConfig(level=log_level)
-logger = logging.getLogger(__name__)
-
-
-def load_secrets(file_path):
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    full_path = os.path.join(script_dir, file_path)
-    with open(full_path, 'r') as file:
-        return json.load(file)
-
-secrets = load_secrets('secrets.json')
-
-aws_access_key_id = secrets['AWS_ACCESS_KEY_ID']
-aws_secret_access_key = secrets['AWS_SECRET_ACCESS_KEY']
-aws_region = secrets['AWS_REGION']
-
-mongodb_address = args.mongodb_address
-# After parsing arguments
-logger.info(f"Station: {args.file}")
-logger.info(f"MongoDB adress: {mongodb_address}")  # Debug lines to check the parsed arguments
-
-if not args.file:
-    args.file = ['Ichtegem']
-
-if args.file == 'Ichtegem':
-    file_key = "greencoop-airbyte/Ichtegem.xlsx"
-elif args.file == 'Madeleine':
-    file_key = "greencoop-airbyte/La8Madeleine8FR.xlsx"
-
-s3 = boto3.client('s3', 
-                  aws_access_key_id=aws_access_key_id, 
-                  aws_secret_access_key=aws_secret_access_key, 
-                  region_name=aws_region)
-
-
-bucket_name = 'greencoop-airbyte'
 
+logger = logging.getLogger(__name__)
 
-s3_object = s3.get_object(Bucket=bucket_name, Key=file_key)
-file_content = s3_object['Body'].read()
+# Key pattern of the workbook of every station, the most recent matching object is migrated
+file_patterns = {
+    'Ichtegem': "greencoop-airbyte/Ichtegem*.xlsx",
+    'Madeleine': "greencoop-airbyte/La8Madeleine8FR*.xlsx",
+}
 
-# Charger le fichier Excel avec pandas
-excel_file = pd.ExcelFile(BytesIO(file_content), engine='openpyxl')
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process an Excel file")
+    parser.add_argument(
+        'file',
+        default='Ichtegem',
+        help='The name of the station to process. Only accepts Ichtegem or Madeleine'
+    )
+
+    parser.add_argument(
+        "--mongodb_address",
+        default="mongodb://localhost:27017/",
+        help="The MongoDB address (default: mongodb://localhost:27017/)"
+    )
+
+    parser.add_argument(
+        "-v", "--verbosity",
+        type=upper_case,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging verbosity level (default: INFO)"
+    )
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=5000,
+        help="Number of documents per insert_many call (default: 5000)"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads inserting chunks concurrently (default: 4)"
+    )
+
+    parser.add_argument(
+        "--mode",
+        default="insert",
+        choices=["insert", "upsert"],
+        help="insert: duplicates are rejected by MongoDB; upsert: replace changed documents and re-tag unchanged ones "
+             "so the migration can be run again (default: insert)"
+    )
+
+    parser.add_argument(
+        "--pattern",
+        default=None,
+        help="Shell-style pattern of the S3 key of the workbook, the most recent match is migrated "
+             "(default: the pattern of the station)"
+    )
+
+    parser.add_argument(
+        "--since",
+        type=date.fromisoformat,
+        default=None,
+        help="Only select the objects of this date or later (YYYY-MM-DD)"
+    )
+
+    parser.add_argument(
+        "--until",
+        type=date.fromisoformat,
+        default=None,
+        help="Only select the objects of this date or earlier (YYYY-MM-DD)"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip the workbook if its ETag and size are unchanged in the migration_manifest collection"
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="Do not read nor write the local cache of normalized workbooks"
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        default=default_cache_dir,
+        help="Directory of the local cache of normalized workbooks (default: .cache at the root of the project)"
+    )
+
+    parser.add_argument(
+        "--cache_size_mb",
+        type=int,
+        default=default_max_bytes // 1024 ** 2,
+        help="Size cap of the local cache, the least recently used files are evicted first (default: 2048)"
+    )
+
+    parser.add_argument(
+        "--excel_engine",
+        default="auto",
+        choices=["auto", "calamine", "openpyxl"],
+        help="Excel reader, auto uses calamine when python-calamine is installed (default: auto)"
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes parsing the sheets of large workbooks (default: number of CPUs)"
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Parse, convert and insert the workbook a week of sheets at a time, the stages running concurrently"
+    )
+
+    parser.add_argument(
+        "--raw_bson",
+        action="store_true",
+        help="Encode the documents straight from the columns into BSON, without a dict per row (not with --mode upsert)"
+    )
+
+    parser.add_argument(
+        "--no-dedup",
+        dest="no_dedup",
+        action="store_true",
+        help="Send the duplicate _ids to MongoDB instead of skipping them client-side (see dedup.py)"
+    )
+
+    parser.add_argument(
+        "--bulk_load",
+        action="store_true",
+        help="Drop the secondary indexes of the collection during the load and rebuild them once afterwards"
+    )
+
+    parser.add_argument(
+        "--no-rollups",
+        dest="no_rollups",
+        action="store_true",
+        help="Do not update the hourly and daily rollups of the weather_station_rollups collection"
+    )
+
+    parser.add_argument(
+        "--trace_memory",
+        action="store_true",
+        help="Record the peak Python allocations of every stage with tracemalloc (slower)"
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=default_profile_dir,
+        default=None,
+        help="Dump a cProfile .pstats file of every hot stage in this directory (default: profiles)"
+    )
+
+    parser.add_argument(
+        "--prometheus",
+        action="store_true",
+        help="Also write the stage report in the Prometheus text format"
+    )
+
+    parser.add_argument(
+        "--quarantine",
+        default="collection",
+        choices=["collection", "file", "none"],
+        help="Where the rows that do not match schema.json go: the weather_station_quarantine collection, "
+             "a JSONL file in quarantine/, or nowhere (default: collection)"
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Insert the workbook a week of sheets at a time, save the progress after each and resume "
+             "an interrupted load from its last committed sheets (see checkpoint.py)"
+    )
+    return parser.parse_args(argv)
 
 
 # Define column renaming dictionary (with explicit units)
@@ -115,53 +246,136 @@ column_mapping = {
     "Solar": "solar_w/m²"
 }
 
-def clean_value(value):
-    if isinstance(value, str):
-        match = re.search(r"[-+]?\d*\.?\d+", value)  # Extract numeric part
-        return float(match.group()) if match else None  # Keep None for non-numeric strings
-    return value  # Return unchanged if not a string (including NaN)
+# From this number of sheets (days) on, parse_workbook spreads the sheets over a process pool
+parallel_sheets_threshold = 16
+
+# Sheets parsed together by a step of the pipelined mode, a week of readings
+pipeline_sheets = 7
 
+# Numeric part of a cell such as "56.8 °F" or "0.00 in"
+numeric_pattern = r"([-+]?\d*\.?\d+)"
 
-# List to store processed DataFrames
-dfs = []
 
-# Loop through all sheets
-for sheet_name in excel_file.sheet_names:
-    # Read the current sheet
-    df = excel_file.parse(sheet_name, na_values=["", "None", "NA", "NaN"])
-    # Rename columns for consistency
-    df.rename(columns=column_mapping, inplace=True)
-    
+def clean_column(column):
+    """
+    Extract the numeric part of every string of the column, a string without number becomes NaN.
+    Values that are not strings (numbers, NaN) are kept unchanged.
+    """
+    if column.dtype != object:
+        return column
+
+    # Cells repeat a lot ("0.00 in", "56.8 °F"), so each distinct value is parsed once
+    codes, uniques = pd.factorize(column)
+    if len(uniques) == 0:
+        return column.astype('float64')
+    uniques = pd.Series(uniques, dtype=object)
+    # .str returns NaN for the values that are not strings
+    is_str = uniques.str.len().notna().to_numpy()
+    extracted = uniques.str.extract(numeric_pattern, expand=False).astype('float64').to_numpy()
+
+    if is_str.all():
+        if (codes >= 0).all() and np.isnan(extracted).all():
+            # Not a single number, keep the object column of None that cleaning each cell gives
+            return pd.Series([None] * len(column), index=column.index, dtype=object)
+        # Only strings and missing values, the usual case
+        return pd.Series(np.where(codes >= 0, extracted[codes], np.nan), index=column.index)
+
+    cleaned = np.where(is_str, extracted, uniques.to_numpy())
+    values = np.where(codes >= 0, cleaned[codes], np.nan)
+    return pd.Series(values, index=column.index, dtype=object).infer_objects()
+
+
+def read_sheets(excel_file, sheet_names=None):
+    """
+    Parse every sheet (one per day, named DDMMYY), or the given ones, and concatenate them once.
+    Returns the raw frame and the date of the sheet each row comes from.
+    """
+    frames = []
+    dates = []
+    for sheet_name in excel_file.sheet_names if sheet_names is None else sheet_names:
+        # Read the current sheet
+        df = excel_file.parse(sheet_name, na_values=["", "None", "NA", "NaN"])
+        # Rename columns for consistency
+        df.rename(columns=column_mapping, inplace=True)
+        frames.append(df)
+        # Convert sheet name (DDMMAAAA) to date (YYYY-MM-DD)
+        dates.append(np.repeat(pd.to_datetime(sheet_name, format="%d%m%y").to_datetime64(), len(df)))
+
+    raw_df = pd.concat(frames, ignore_index=True)
+    return raw_df, np.concatenate(dates).astype("datetime64[ns]")
+
+
+def clean_sheets(raw_df, dates):
+    """
+    Clean every column at once and build `datetime` from the sheet date plus the time of the reading.
+    """
+    df = raw_df.copy()
     # Apply cleaning function to all columns (except 'time' and 'wind_dir')
     for col in df.columns:
         if col not in ["time", "wind_dir"]:  # Exclude categorical columns
-            df[col] = df[col].apply(clean_value)
+            df[col] = clean_column(df[col])
+
+    kept = df.notna().any(axis=1).to_numpy()
+    df = df[kept].reset_index(drop=True)
+
+    # A day has a few hundred distinct times, parse them once.
+    # The NaT appended last is picked by the code -1 of missing times
+    codes, times = pd.factorize(df["time"])
+    offsets = pd.to_timedelta(pd.Series(times, dtype=object).astype(str)).to_numpy()
+    time_offset = np.append(offsets, np.timedelta64("NaT", "ns"))[codes]
+    df.insert(0, "datetime", pd.Series(dates[kept] + time_offset, index=df.index))
+    df = df.drop(columns=["time"])
+    return df
+
+
+def excel_engine(engine="auto"):
+    """
+    "auto" picks calamine (Rust reader, several times faster, same frames) when python-calamine is installed.
+    """
+    if engine != "auto":
+        return engine
+    return "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+
+
+def parse_sheets(content, sheet_names, engine):
+    """
+    Open the workbook and parse and clean the given sheets, run in a worker process by parse_workbook.
+    """
+    excel_file = pd.ExcelFile(BytesIO(content), engine=engine)
+    return clean_sheets(*read_sheets(excel_file, sheet_names))
 
-    df = df.dropna(how='all')
 
-    # Convert sheet name (DDMMAAAA) to date (YYYY-MM-DD)
-    date_formatted = pd.to_datetime(sheet_name, format="%d%m%y")
-    
-    # Add the date column
-    df.insert(0, "date", date_formatted)
-    df["time"] = pd.to_datetime(df["time"], format="%H:%M:%S").dt.time
-    df["datetime"] = pd.to_datetime(df["date"].astype(str) + " " + df["time"].astype(str))
-    df = df.drop(columns=["date", "time"])
-    df = df[["datetime"] + [col for col in df.columns if col != "datetime"]]
+def sheet_runs(sheet_names, run_size):
+    return [sheet_names[i:i + run_size] for i in range(0, len(sheet_names), run_size)]
 
-    # Append cleaned DataFrame
-    dfs.append(df)
 
-# Combine all sheets into one DataFrame
-final_df = pd.concat(dfs, ignore_index=True)
+def parse_workbook(content, engine="auto", processes=None):
+    """
+    Parse and clean every sheet of the workbook given as bytes.
+    From `parallel_sheets_threshold` sheets on, the sheets are split in contiguous runs that are parsed and
+    cleaned by a process pool, each worker opening its own copy of the workbook, and the frames are concatenated once.
+    """
+    engine = excel_engine(engine)
+    excel_file = pd.ExcelFile(BytesIO(content), engine=engine)
+    sheet_names = excel_file.sheet_names
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes < 2 or len(sheet_names) < parallel_sheets_threshold:
+        return clean_sheets(*read_sheets(excel_file))
+
+    runs = sheet_runs(sheet_names, -(-len(sheet_names) // (processes * 2)))
+    with ProcessPoolExecutor(max_workers=processes, mp_context=process_context) as executor:
+        frames = list(executor.map(parse_sheets, repeat(content), runs, repeat(engine)))
+    return pd.concat(frames, ignore_index=True)
 
 
 def convertToMetric(df):
     """
     Convert to metric and to other small ajustements for all data to be formated the same way
     """
-    df = df.copy() 
-    	
+    df = df.copy()
+
     df['dew_point_°C'] = ((df['dew_point_°F'] - 32) * 5/9).round(1)
     df['temperature_°C'] = ((df['temperature_°F'] - 32) * 5/9).round(1)
     df['wind_speed_kph'] = (df['wind_speed_mph'] * 1.60934).round(1)
@@ -172,159 +386,386 @@ def convertToMetric(df):
 
     df['humidity_%'] = df['humidity_%'].astype(int)
 
-    df.drop(columns=['temperature_°F', 'wind_speed_mph', 'wind_gust_mph', 'pressure_inHg', 
+    df.drop(columns=['temperature_°F', 'wind_speed_mph', 'wind_gust_mph', 'pressure_inHg',
                      'precip_rate_in/hr', 'precip_accum_in', 'dew_point_°F'], inplace=True)
     return df
 
 
-final_df2 = convertToMetric(final_df)
+dir_to_angle = {
+    'N': 0,
+    'NNE': 22.5,
+    'NE': 45,
+    'ENE': 67.5,
+    'E': 90,
+    'ESE': 112.5,
+    'SE': 135,
+    'SSE': 157.5,
+    'S': 180,
+    'SSW': 202.5,
+    'SW': 225,
+    'WSW': 247.5,
+    'W': 270,
+    'WNW': 292.5,
+    'NW': 315,
+    'NNW': 337.5,
+    'North': 0,
+    'South': 180,
+    'East': 90,
+    'West': 270
+}
+angles = np.array(list(dir_to_angle.values()), dtype='float64')
+
 
 def wind_dir_to_angle(df):
     df = df.copy()
-    dir_to_angle = {
-        'N': 0,
-        'NNE': 22.5,
-        'NE': 45,
-        'ENE': 67.5,
-        'E': 90,
-        'ESE': 112.5,
-        'SE': 135,
-        'SSE': 157.5,
-        'S': 180,
-        'SSW': 202.5,
-        'SW': 225,
-        'WSW': 247.5,
-        'W': 270,
-        'WNW': 292.5,
-        'NW': 315,
-        'NNW': 337.5,
-        'North': 0,
-        'South': 180,
-        'East': 90,
-        'West': 270   
-    }
-    df['wind_dir'] = df['wind_dir'].map(dir_to_angle)
+    # Categorical codes index the angles array, unknown directions get code -1 and become NaN
+    codes = pd.Categorical(df['wind_dir'], categories=list(dir_to_angle)).codes
+    df['wind_dir'] = np.where(codes >= 0, angles[codes], np.nan)
     return df
-final_df2 = wind_dir_to_angle(final_df2)
 
-final_df2["precip_rate_mm/hr"].unique()
 
-final_df2["precip_accum_mm"].unique()
+def normalize(excel_file, station):
+    """
+    Read, clean and convert every sheet of the workbook into the final columns, before the `_id` is added.
+    This typed frame is what the local cache keeps.
+    """
+    return convert(clean_sheets(*read_sheets(excel_file)), station)
 
-final_df2["wind_dir"].unique()   
 
-final_df2['station'] = args.file
+def convert(final_df, station):
+    """
+    Convert the cleaned sheets to metric and select the final columns.
+    """
+    final_df2 = convertToMetric(final_df)
+    final_df2 = wind_dir_to_angle(final_df2)
 
-# Function to generate ObjectId from a unique key
-def generate_objectid(unique_str):
-    hash_hex = hashlib.md5(unique_str.encode()).hexdigest()[:24]  # Ensure 24 chars
-    return ObjectId(hash_hex)
+    final_df2['station'] = station
 
-final_df2['_id'] = final_df2.apply(lambda row: generate_objectid(str(row['datetime']) + row['station']), axis=1)
+    final_df2 = final_df2[['station', 'datetime', 'temperature_°C', 'dew_point_°C', 'humidity_%', 'wind_dir', 'wind_speed_kph',
+             'wind_gust_kph', 'pressure_hPa', 'precip_rate_mm/hr', 'precip_accum_mm',
+             'uv_index', 'solar_w/m²']]
+    return final_df2
 
-final_df2 = final_df2[['station', 'datetime', 'temperature_°C', 'dew_point_°C', 'humidity_%', 'wind_dir', 'wind_speed_kph', 
-         'wind_gust_kph', 'pressure_hPa', 'precip_rate_mm/hr', 'precip_accum_mm',  
-         'uv_index', 'solar_w/m²',  '_id']]   
 
-migration_tag = f"{datetime.now().strftime('%Y-%m-%d_%Hh%M')}_{args.file}"
-final_df2["migrated"] = migration_tag
+def add_ids(final_df2, station):
+    final_df2 = final_df2.copy()
+    final_df2['_id'] = generate_objectids(final_df2['datetime'], station)
+    return final_df2
 
-# MongoDB setup
-client = MongoClient(mongodb_address)
-db = client["weather_data"]
-collection = db["weather_station"]
 
+def transform(excel_file, station):
+    """
+    Read, clean and convert every sheet of the workbook into the final frame (without the migration tag).
+    """
+    return add_ids(normalize(excel_file, station), station)
 
-records = final_df2.to_dict(orient='records')
 
 # Prepare info to make sure the data is rightly migrated
 columns_of_interest = ["temperature_°C", "humidity_%", "pressure_hPa"]
-metrics = {
-    "migration_tag": migration_tag,
-    "mongodb_address": mongodb_address,
-    "row_count": len(final_df2),
-    "columns": final_df2.columns.tolist(),
-}
-for col in columns_of_interest:
-    if col in final_df2.columns:
-        metrics[f"median_{col}"] = float(final_df2[col].median())
-        metrics[f"min_{col}"] = float(final_df2[col].min())
-        metrics[f"max_{col}"] = float(final_df2[col].max())
-
-script_dir = os.path.dirname(os.path.abspath(__file__))
-data_dir = os.path.join(script_dir, "..", "tests","test_data")
-file_path = os.path.join(data_dir, f"expected_{args.file}_metrics.json")
-
-# Ensure the directory exists
-os.makedirs(data_dir, exist_ok=True)
-
-with open(file_path, 'w', encoding='utf-8') as f:
-    json.dump(metrics, f, indent=4, ensure_ascii=False)
-
-# Insert documents
-try:
-    # Insert documents, set 'ordered=False' to continue on duplicate key error
-    result = collection.insert_many(records, ordered=False)
-
-    # Log the number of inserted documents
-    inserted_count = len(result.inserted_ids)
-    logger.info(f"Successfully inserted {inserted_count} documents into MongoDB at {mongodb_address} !")
-
-except errors.BulkWriteError as e:
-    # Extract useful summary info without dumping full error
-    inserted_count = e.details.get('nInserted', 0)
-    write_errors = e.details.get('writeErrors', [])
-    duplicate_count = 0
-    validation_count = 0
-    other_count = 0
-
-    # Separate errors into categories
-    for error in write_errors:
-        if error.get('code') == 11000:  # Duplicate key error
-            duplicate_count += 1
-        elif error.get('code') == 121:  # Validation error
-            validation_count += 1
-        else:  # Other errors
-            other_count += 1
-
-    # Log the counts of different error types
-    logger.warning(f"Duplicate key error: {duplicate_count} documents were skipped.")
-    logger.warning(f"Validation error: {validation_count} documents failed validation.")
-    logger.warning(f"Other errors: {other_count} documents encountered other errors.")
-
-    # Successfully inserted documents
-    logger.info(f"{inserted_count} documents were successfully inserted despite this error.")
-
-    # Log the first 3 duplicate _id values
-    duplicate_key_errors_handled = 0
-    for error in write_errors:
-        if error.get('code') == 11000 and duplicate_key_errors_handled < 3:  # Duplicate key error
-            errmsg = error.get('errmsg', 'No detailed message available')
-            logger.info(f"Duplicate key error: {errmsg}")
-
-            # Extract the duplicate key information from the error details
-            dup_id = error.get('keyValue', {}).get('_id', 'unknown')
-            logger.debug(f"Duplicate _id: {dup_id}")
-
-            # Log the failed document data for duplicate key errors
-            logger.info(f"Failed document data for duplicate key: {error.get('op', {})}")
-            duplicate_key_errors_handled += 1
-
-    if duplicate_count > 3:
-        logger.info(f"...and {duplicate_count - 3} more duplicates were skipped.")
-
-    # Log the first 3 validation errors
-    validation_errors_handled = 0
-    for error in write_errors:
-        if error.get('code') == 121 and validation_errors_handled < 3:  # Validation error
-            errmsg = error.get('errmsg', 'No detailed message available')
-            logger.info(f"Validation failed for document: {errmsg}")
-            logger.info(f"Failed document data for validation error: {error.get('op', {})}")
-            validation_errors_handled += 1
-
-    if validation_count > 3:
-        logger.debug(f"...and {validation_count - 3} more validation errors occurred.")
-
-    # If there are any other errors (non-validation, non-duplicate), log them
-    if other_count > 0:
-        logger.debug(f"...and {other_count} other errors occurred.")
+
+
+def compute_metrics(final_df2, migration_tag, mongodb_address, accumulator=None):
+    # A resumed load passes the accumulator of the whole workbook, its frame only holds the sheets it inserted
+    if accumulator is None:
+        accumulator = MetricsAccumulator()
+        accumulator.update(final_df2)
+    metrics = {
+        "migration_tag": migration_tag,
+        "mongodb_address": mongodb_address,
+        "row_count": accumulator.row_count,
+        "columns": final_df2.columns.tolist(),
+    }
+    metrics.update(accumulator.summary(columns_of_interest))
+    metrics.update(accumulator.to_dict())
+    return metrics
+
+
+def to_documents(final_df2, raw_bson=False):
+    """
+    The documents to insert: dicts, or with raw_bson the same BSON encoded straight from the columns (see bson_sink.py).
+    """
+    if raw_bson:
+        return frame_to_raw_documents(final_df2)
+    return final_df2.to_dict(orient='records')
+
+
+def migrate_pipelined(content, collection, station, migration_tag, chunk_size=5000, workers=4, mode="insert",
+                      engine="auto", processes=None, timer=None, quarantine_target=None, queue_size=default_queue_size,
+                      raw_bson=False, dedup=None, checkpoint=None, cache_writer=None):
+    """
+    Parse, convert and insert the workbook a week of sheets at a time, through a pipeline (see pipeline.py):
+    the next sheets are parsed while the current ones are converted and the previous ones inserted.
+    The sheets are parsed by a pool of `processes` processes (number of CPUs by default, in the thread with less than 2).
+    The frames of a week are dropped once it is inserted, so the memory is bounded by the queues and not by
+    the workbook: the converted frame goes to the `cache_writer` (see cache.py) and the valid one to the metrics.
+    Returns the insert summary, the MetricsAccumulator of the valid rows and their columns.
+    With a Checkpoint, the sheets already committed are skipped and the checkpoint is committed after every inserted
+    week, with the counts and the metrics of the whole load; the summary is then the one of the whole load.
+    """
+    timer = StageTimer(station) if timer is None else timer
+    engine = excel_engine(engine)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    excel_file = pd.ExcelFile(BytesIO(content), engine=engine)
+    check = SchemaCheck()
+    rejected_count = Counter()
+    state = checkpoint.state if checkpoint is not None else None
+    accumulator = MetricsAccumulator()
+    columns = []
+    if state is not None:
+        total = Counter(state["summary"])
+        columns = state.get("columns", [])
+        if state["metrics"]:
+            accumulator = MetricsAccumulator.from_dict(state["metrics"])
+    # The runs reach prepare in any order, they are written to the cache in the order of the workbook
+    cache_order = deque()
+    cache_pending = {}
+
+    def parse(item):
+        index, sheet_names = item
+        with timer.stage("parse") as stage:
+            if executor is None:
+                raw = clean_sheets(*read_sheets(excel_file, sheet_names))
+            else:
+                raw = executor.submit(parse_sheets, content, sheet_names, engine).result()
+            stage.rows_out = len(raw)
+        return index, raw
+
+    def cache_run(index, frame):
+        cache_pending[index] = frame
+        while cache_order and cache_order[0] in cache_pending:
+            cache_writer.write(cache_pending.pop(cache_order.popleft()))
+
+    # A single worker
+    def prepare(item):
+        index, raw = item
+        with timer.stage("transform", rows_in=len(raw)) as stage:
+            converted = convert(raw, station)
+            stage.rows_out = len(converted)
+        if cache_writer is not None:
+            cache_run(index, converted)
+        with timer.stage("ids", rows_in=len(raw)):
+            final = add_ids(converted, station)
+            final["migrated"] = migration_tag
+        with timer.stage("schema_check", rows_in=len(final)) as stage:
+            final, rejected, counts = check.split(final)
+            stage.rows_out = len(final)
+        if len(rejected):
+            rejected_count.update(counts)
+            quarantine(rejected.to_dict(orient='records'), quarantine_target, station, migration_tag)
+        if dedup is not None:
+            with timer.stage("dedup", rows_in=len(final)) as stage:
+                final = dedup.filter(final)
+                stage.rows_out = len(final)
+        with timer.stage("documents", rows_in=len(final)):
+            return index, final, len(rejected), to_documents(final, raw_bson)
+
+    # A single worker too, the accumulator is updated and the checkpoint committed in turn
+    def insert(item):
+        nonlocal columns
+        index, final, rejected, records = item
+        with timer.stage("insert", rows_in=len(records)) as stage:
+            counts = insert_documents(collection, records, chunk_size, workers, mode)
+            stage.rows_out = counts["inserted"]
+        accumulator.update(final)
+        columns = final.columns.tolist()
+        if state is not None:
+            total.update(counts)
+            checkpoint.commit(sheets=state["sheets"] + run_sheets[index], summary=dict(total),
+                              rejected=state["rejected"] + rejected, columns=columns,
+                              metrics={"row_count": accumulator.row_count, **accumulator.to_dict()})
+        return counts
+
+    runs = list(enumerate(sheet_runs(excel_file.sheet_names, pipeline_sheets)))
+    run_sheets = dict(runs)
+    if state is not None:
+        # The weeks whose sheets were all committed by the interrupted load are skipped
+        runs = [(index, sheet_names) for index, sheet_names in runs if not set(sheet_names) <= set(state["sheets"])]
+    cache_order.extend(index for index, _ in runs)
+    steps = [Step("parse", parse, workers=max(processes, 1)), Step("prepare", prepare), Step("insert", insert)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=process_context) if processes >= 2 else nullcontext() as executor, \
+            timer.stage("pipeline", bytes_in=len(content)) as stage:
+        summary = sum(Pipeline(steps, queue_size).run(runs), Counter())
+        stage.rows_out = summary["inserted"]
+    summary["rejected"] = rejected_count.total()
+    if state is not None:
+        # The counts of the whole load, the sheets inserted before the interruption included
+        summary = Counter(state["summary"])
+        summary["rejected"] = state["rejected"]
+    summary["seconds"] = time.perf_counter() - start
+    return summary, accumulator, columns
+
+
+def migrate_frame(frame, collection, station, migration_tag, chunk_size=5000, workers=4, mode="insert", timer=None,
+                  quarantine_target=None, raw_bson=False, dedup=None):
+    """
+    Add the ids and the migration tag to the converted frame of a workbook, quarantine the rows that do not match
+    schema.json, drop the duplicates and insert the documents. Returns the insert summary and the inserted frame.
+    """
+    timer = StageTimer(station) if timer is None else timer
+    with timer.stage("ids", rows_in=len(frame)):
+        final_df2 = add_ids(frame, station)
+        final_df2["migrated"] = migration_tag
+
+    with timer.stage("schema_check", rows_in=len(final_df2)) as stage:
+        final_df2, rejected, _ = SchemaCheck().split(final_df2)
+        stage.rows_out = len(final_df2)
+    if len(rejected):
+        quarantine(rejected.to_dict(orient='records'), quarantine_target, station, migration_tag)
+
+    if dedup is not None:
+        with timer.stage("dedup", rows_in=len(final_df2)) as stage:
+            final_df2 = dedup.filter(final_df2)
+            stage.rows_out = len(final_df2)
+
+    with timer.stage("documents", rows_in=len(final_df2)):
+        records = to_documents(final_df2, raw_bson)
+
+    # Insert documents
+    with timer.stage("insert", rows_in=len(records)) as stage:
+        summary = insert_documents(collection, records, chunk_size, workers, mode)
+        stage.rows_out = summary["inserted"]
+    summary["rejected"] = len(rejected)
+    return summary, final_df2
+
+
+def migrate(s3, collection, station, mongodb_address, chunk_size=5000, workers=4, mode="insert",
+            pattern=None, since=None, until=None, manifest=None, incremental=False, cache=None, engine="auto",
+            processes=None, rollups=None, timer=None, quarantine_target=None, pipeline=False, raw_bson=False,
+            dedup=None, checkpoint=None, deferred=None):
+    """
+    Download the most recent workbook of the station, transform it, write the expected metrics and insert the documents.
+    The S3 client and the collection are passed in, so the runner can share them between sources.
+    With a manifest collection, the workbook is recorded in it and `incremental` skips it if it is unchanged.
+    With a FrameCache, the normalized frame of the workbook is kept on disk, a warm run neither downloads nor parses it.
+    `engine` and `processes` are passed to parse_workbook.
+    With a rollup collection, the hourly and daily rollups of the days of the workbook are recomputed.
+    Every stage is timed by the StageTimer.
+    The rows that do not match schema.json are not sent, they go to `quarantine_target` (see schema_check.py).
+    With `pipeline`, a downloaded workbook is parsed and inserted a week of sheets at a time, see migrate_pipelined.
+    With `raw_bson`, the documents are encoded straight from the columns (see bson_sink.py), in the insert modes only.
+    With a Deduplicator, the duplicate readings and the ones already stored are not sent (see dedup.py).
+    With a Checkpoint, the workbook is inserted in pipeline mode and an interrupted load is resumed (see checkpoint.py).
+    In a bulk load, `deferred` is the DeferredIndexes, the rollups are updated once the indexes are rebuilt.
+    """
+    if raw_bson and mode == "upsert":
+        raise ValueError("--raw_bson can not be used with --mode upsert, which adds a content_hash to every document")
+    timer = StageTimer(station) if timer is None else timer
+    pattern = pattern or file_patterns[station]
+    with timer.stage("list") as stage:
+        objects = select_objects(s3, pattern, since, until, latest=1)
+        stage.rows_out = len(objects)
+    if not objects:
+        raise FileNotFoundError(f"No S3 object matches {pattern}")
+    if manifest is not None and incremental:
+        objects = changed_objects(manifest, objects)
+        if not objects:
+            return Counter()
+    obj = objects[0]
+    logger.info(f"Workbook: {obj['Key']}")
+    migration_tag = make_migration_tag(station)
+    if checkpoint is not None:
+        # The workbook is parsed again, only its committed sheets are skipped
+        migration_tag = checkpoint.open(objects, migration_tag)["migration_tag"]
+        if dedup is not None:
+            dedup.resumed_tag = migration_tag
+        cache = None
+        pipeline = True
+
+    frame = None
+    summary = None
+    if cache is not None:
+        with timer.stage("cache") as stage:
+            frame, _ = cache.load(bucket_name, obj['Key'], obj['ETag'])
+            stage.rows_out = None if frame is None else len(frame)
+    if frame is None:
+        with timer.stage("download") as stage:
+            _, file_content = next(download_objects(s3, objects))
+            stage.bytes_in = len(file_content)
+
+        if pipeline:
+            # The weeks are written to the cache as they are converted
+            with cache.writer(bucket_name, obj['Key'], obj['ETag']) if cache is not None else nullcontext() as writer:
+                summary, accumulator, columns = migrate_pipelined(file_content, collection, station, migration_tag,
+                                                                  chunk_size, workers, mode, engine, processes,
+                                                                  timer, quarantine_target, raw_bson=raw_bson,
+                                                                  dedup=dedup, checkpoint=checkpoint,
+                                                                  cache_writer=writer)
+            final_df2 = pd.DataFrame(columns=columns)
+        else:
+            with timer.stage("parse", bytes_in=len(file_content)) as stage:
+                raw = parse_workbook(file_content, engine, processes)
+                stage.rows_out = len(raw)
+            with timer.stage("transform", rows_in=len(raw)) as stage:
+                frame = convert(raw, station)
+                stage.rows_out = len(frame)
+            if cache is not None:
+                with timer.stage("cache_store", rows_in=len(frame)) as stage:
+                    cache.store(frame, bucket_name, obj['Key'], obj['ETag'])
+                    stage.bytes_out = os.path.getsize(cache.path(bucket_name, obj['Key'], obj['ETag']))
+
+    if summary is None:
+        summary, final_df2 = migrate_frame(frame, collection, station, migration_tag, chunk_size, workers, mode,
+                                           timer, quarantine_target, raw_bson, dedup)
+        accumulator = None
+    if dedup is not None:
+        summary.update(dedup.counts)
+
+    with timer.stage("metrics", rows_in=len(final_df2)):
+        metrics = compute_metrics(final_df2, migration_tag, mongodb_address, accumulator)
+        write_metrics(metrics, station)
+    log_insert_summary(summary, mongodb_address, mode)
+
+    if manifest is not None:
+        with timer.stage("manifest"):
+            record_objects(manifest, objects, station, migration_tag, {obj['Key']: {"row_count": metrics["row_count"]}})
+    if rollups is not None:
+        schedule_rollups(collection, rollups, migration_tag, timer, deferred)
+    if checkpoint is not None:
+        checkpoint.finish()
+    return summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    log_level = getattr(logging, args.verbosity)
+    logging.basicConfig(level=log_level)
+
+    mongodb_address = args.mongodb_address
+    # After parsing arguments
+    logger.info(f"Station: {args.file}")
+    logger.info(f"MongoDB adress: {mongodb_address}")  # Debug lines to check the parsed arguments
+
+    if args.file not in file_patterns:
+        logger.error(f"Unknown station {args.file}, expected one of {list(file_patterns)}")
+        sys.exit(1)
+
+    s3 = s3_client(load_secrets('secrets.json'))
+    client = MongoClient(mongodb_address)
+    collection = weather_collection(client)
+
+    timer = StageTimer(args.file, args.trace_memory, args.profile)
+    try:
+        mode = write_mode(collection, args.mode)
+        with deferred_indexes(collection) if args.bulk_load else nullcontext() as deferred:
+            migrate(s3, collection, args.file, mongodb_address, chunk_size=args.chunk_size, workers=args.workers,
+                    mode=mode, pattern=args.pattern, since=args.since, until=args.until,
+                    manifest=manifest_collection(client), incremental=args.incremental,
+                    cache=None if args.no_cache else FrameCache(args.cache_dir, args.cache_size_mb * 1024 ** 2),
+                    engine=args.excel_engine, processes=args.processes,
+                    rollups=None if args.no_rollups else rollup_collection(client), timer=timer,
+                    quarantine_target=open_quarantine(client, args.quarantine), pipeline=args.pipeline,
+                    raw_bson=args.raw_bson, dedup=None if args.no_dedup else Deduplicator(collection, mode),
+                    checkpoint=Checkpoint(checkpoint_collection(client), args.file) if args.resume else None,
+                    deferred=deferred)
+    except (FileNotFoundError, ValueError) as e:
+        logger.error(e)
+        sys.exit(1)
+    timer.log_summary()
+    write_report(timer, args.prometheus)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+#!/bin/bash
+set -e  # stop on error
+
+MONGO_URI="${MONGO_URI:-mongodb://mongo1:27017/}"
+VERBOSITY="-v INFO"
+
+# Worker mode: the planner container writes the work units (python3 -m migration plan ...),
+# every worker container migrates units until none is left, then writes the merged expected metrics
+python3 -m migration worker --mongodb_address "$MONGO_URI" $VERBOSITY
+
+# Run tests
+for dataset in Ichtegem Madeleine InfoClimat; do
+  pytest -v --input "$dataset"
+done
@@ -1,5 +1,31 @@
-# conftest.py
+import os
+import sys
+
+import boto3
+import pytest
+
+# The migration scripts import each other as plain modules, make them importable from the tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "migration"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+
 def pytest_addoption(parser):
     parser.addoption(
         "--input", action="store", default=None, help="Name of the input to select test data"
     )
+
+
+@pytest.fixture
+def s3():
+    """
+    S3 client on an in-memory moto bucket named like the real one.
+    """
+    from moto import mock_aws
+
+    from common import bucket_name
+
+    with mock_aws():
+        client = boto3.client("s3", region_name="eu-north-1", aws_access_key_id="testing",
+                              aws_secret_access_key="testing")
+        client.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={"LocationConstraint": "eu-north-1"})
+        yield client
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+import jsonl
+import xlsx
+from compare import compare
+from generators import write_airbyte_jsonl, write_wu_workbook
+
+
+def test_generated_workbook_is_read_by_the_scripts(tmp_path):
+    path = tmp_path / "wu.xlsx"
+    rows = write_wu_workbook(path, 500)
+    assert rows == 576
+
+    frame = xlsx.convert(xlsx.parse_workbook(path.read_bytes(), processes=1), "Ichtegem")
+    assert len(frame) == rows
+    assert frame.notna().all().all()
+    assert frame["temperature_°C"].between(-10, 30).all()
+    assert frame["datetime"].is_monotonic_increasing
+
+
+def test_generated_export_is_read_by_the_scripts(tmp_path):
+    path = tmp_path / "export.jsonl"
+    rows = write_airbyte_jsonl(path, 1000, stations=6)
+    assert rows == 7 * 24 * 6
+
+    with open(path, "rb") as f:
+        lines = f.readlines()
+    assert "_params" in json.loads(lines[0])["_airbyte_data"]["hourly"]
+    stats = {}
+    df = jsonl.convert_records(list(jsonl.export_records("key", lines, stats)))
+    assert len(df) == rows and stats["key"]["row_count"] == rows
+    assert df["station"].nunique() == 6
+    assert df["temperature_°C"].notna().all()
+
+
+def test_generators_are_deterministic(tmp_path):
+    write_airbyte_jsonl(tmp_path / "a.jsonl", 100)
+    write_airbyte_jsonl(tmp_path / "b.jsonl", 100)
+    assert (tmp_path / "a.jsonl").read_bytes() == (tmp_path / "b.jsonl").read_bytes()
+
+
+@pytest.mark.parametrize("after, regression", [(1.05, False), (1.5, True)])
+def test_compare_flags_slower_stages(after, regression):
+    baseline = {("jsonl", 100): {"stages": {"parse": {"wall_seconds": 1.0}, "ids": {"wall_seconds": 0.01}}}}
+    current = {("jsonl", 100): {"stages": {"parse": {"wall_seconds": after}, "ids": {"wall_seconds": 0.1}}},
+               ("xlsx", 100): {"stages": {"parse": {"wall_seconds": 1.0}}}}
+    rows = list(compare(baseline, current, threshold=0.1, min_seconds=0.05))
+    assert [(stage, flagged) for _, _, stage, _, _, _, flagged in rows] == [("parse", regression), ("ids", False)]
@@ -0,0 +1,102 @@
+import json
+import os
+from datetime import datetime
+
+import bson
+import numpy as np
+import pandas as pd
+import pytest
+from bson import ObjectId
+
+import jsonl
+import xlsx
+from bson_sink import encode_batch, frame_to_raw_documents
+from bulk_insert import insert_documents
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "scripts", "data")
+
+
+class ListCollection:
+    def __init__(self):
+        self.raw = []
+
+    def insert_many(self, documents, ordered=False):
+        # pymongo leaves inserted_ids empty for RawBSONDocuments
+        self.raw.extend(document.raw for document in documents)
+
+        class Result:
+            inserted_ids = []
+        return Result()
+
+
+def test_workbook_documents_are_the_bytes_of_to_dict():
+    with open(os.path.join(DATA_DIR, "Weather+Underground+-+Ichtegem,+BE.xlsx"), "rb") as f:
+        frame = xlsx.add_ids(xlsx.convert(xlsx.parse_workbook(f.read(), processes=1), "Ichtegem"), "Ichtegem")
+    frame["migrated"] = "tag"
+    documents = frame.to_dict(orient="records")
+    raw = frame_to_raw_documents(frame, batch_size=500)
+    assert [bson.encode(document) for document in documents] == [document.raw for document in raw]
+
+
+def test_export_documents_are_the_bytes_of_frame_to_documents():
+    records = [
+        {"id_station": "07015", "station": "Lille-Lesquin", "dh_utc": "2024-10-01 00:00:00", "temperature": "12.5",
+         "humidite": "80", "nebulosite": "", "temps_omm": None},
+        {"id_station": "07015", "station": "Lille-Lesquin", "dh_utc": "2024-10-01 01:00:00", "temperature": None,
+         "humidite": "", "nebulosite": "8", "pluie_1h": "0.2"},
+        {"id_station": "000R5", "station": "Bergues", "dh_utc": "2024-10-01 01:00:00", "temperature": "-1.5"},
+    ]
+    frame = jsonl.add_ids(jsonl.convert_records(json.loads(json.dumps(records))), "tag")
+    documents = jsonl.frame_to_documents(frame)
+    raw = jsonl.frame_to_documents(frame, raw_bson=True)
+    assert [bson.encode(document) for document in documents] == [document.raw for document in raw]
+    assert raw[1]["temperature_°C"] is None and raw[1]["humidity_%"] is None
+
+
+@pytest.mark.parametrize("nan_is_null", [False, True])
+def test_other_types(nan_is_null):
+    frame = pd.DataFrame({
+        "count": [1, 2 ** 40, -3],
+        "flag": [True, False, True],
+        "level": pd.array([1, None, 2 ** 33], dtype="Int64"),
+        "utc": pd.to_datetime(["2024-10-01 00:00:00.0019", None, "1969-12-31 23:59:59.9995"]).tz_localize("UTC"),
+        "mixed": ["a", np.nan, {"nested": 1}],
+        "name": ["é", None, "é"],
+        "_id": [ObjectId() for _ in range(3)],
+    })
+    if nan_is_null:
+        documents = jsonl.frame_to_documents(frame)
+    else:
+        documents = frame.to_dict(orient="records")
+        documents[1]["utc"] = documents[1]["level"] = None
+    expected = [bson.encode(document) for document in documents]
+    raw, _ = encode_batch(frame, nan_is_null)
+    assert [document.raw for document in raw] == expected
+    assert list(bson.decode(expected[0]))[0] == "_id"
+
+
+def test_reused_buffer_holds_no_byte_of_the_previous_batch():
+    # Long strings first, the next batches are shorter and land on the bytes of the first
+    frame = pd.DataFrame({"_id": [ObjectId() for _ in range(6)],
+                          "name": ["x" * 50, "y" * 40, "a", "b", None, "c"],
+                          "value": [1.5, np.nan, 2.0, 3.0, 4.0, np.nan]})
+    _, buffer = encode_batch(frame.iloc[:4])
+    buffer[:] = 0xFF
+    batch, reused = encode_batch(frame.iloc[4:], buffer=buffer)
+    assert reused is buffer
+    assert [document.raw for document in batch] == [bson.encode(document)
+                                                    for document in frame.iloc[4:].to_dict(orient="records")]
+
+
+def test_raw_documents_are_counted_as_inserted():
+    frame = pd.DataFrame({"_id": [ObjectId() for _ in range(7)], "value": np.arange(7.0)})
+    collection = ListCollection()
+    summary = insert_documents(collection, frame_to_raw_documents(frame, batch_size=3), chunk_size=2, workers=2)
+    assert summary["inserted"] == 7
+    assert sorted(bson.decode(raw)["value"] for raw in collection.raw) == list(np.arange(7.0))
+
+
+def test_datetimes_round_down_to_the_millisecond():
+    frame = pd.DataFrame({"datetime": pd.to_datetime(["2024-10-01 00:00:00.0019"])})
+    raw, _ = encode_batch(frame)
+    assert bson.decode(raw[0].raw)["datetime"] == datetime(2024, 10, 1, 0, 0, 0, 1000)
@@ -0,0 +1,124 @@
+import threading
+from datetime import datetime, timedelta
+
+import mongomock
+from pymongo import errors
+
+from bulk_insert import insert_documents
+
+
+class FakeCollection:
+    """
+    Collection with a unique _id and a validator refusing negative temperatures, like insert_many(ordered=False).
+    """
+
+    def __init__(self, existing_ids=()):
+        self.ids = set(existing_ids)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def insert_many(self, documents, ordered=False):
+        write_errors = []
+        inserted = 0
+        with self.lock:
+            self.calls += 1
+            for index, document in enumerate(documents):
+                if document["_id"] in self.ids:
+                    write_errors.append({"index": index, "code": 11000, "keyValue": {"_id": document["_id"]}})
+                elif document["temperature_°C"] < 0:
+                    write_errors.append({"index": index, "code": 121})
+                else:
+                    self.ids.add(document["_id"])
+                    inserted += 1
+        if write_errors:
+            raise errors.BulkWriteError({"nInserted": inserted, "writeErrors": write_errors})
+
+        class Result:
+            inserted_ids = [document["_id"] for document in documents]
+        return Result()
+
+
+def test_counts_are_aggregated_over_chunks():
+    collection = FakeCollection(existing_ids=range(10))
+    documents = ({"_id": i, "temperature_°C": -1.0 if i % 25 == 0 else 12.5} for i in range(100))
+
+    summary = insert_documents(collection, documents, chunk_size=7, workers=3)
+
+    assert collection.calls == 15
+    assert summary["documents"] == 100
+    assert summary["duplicate"] == 10
+    # 0 is a duplicate, 25, 50 and 75 fail validation
+    assert summary["validation"] == 3
+    assert summary["inserted"] == 87
+    assert summary["other"] == 0
+
+
+class FakeStoredCollection:
+    """
+    Collection keeping the documents by _id, with the find / update_many / bulk_write calls used by upsert_chunk.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.replaced = 0
+
+    def find(self, query, projection):
+        with self.lock:
+            return [dict(self.documents[_id]) for _id in query["_id"]["$in"] if _id in self.documents]
+
+    def update_many(self, query, update):
+        with self.lock:
+            for _id in query["_id"]["$in"]:
+                self.documents[_id].update(update["$set"])
+
+    def bulk_write(self, requests, ordered=False):
+        upserted = matched = 0
+        with self.lock:
+            for request in requests:
+                document = request._doc
+                if document["_id"] in self.documents:
+                    matched += 1
+                else:
+                    upserted += 1
+                self.documents[document["_id"]] = dict(document)
+            self.replaced += len(requests)
+
+        class Result:
+            upserted_count = upserted
+            matched_count = matched
+        return Result()
+
+
+def test_upsert_mode_counts_inserted_updated_and_unchanged():
+    collection = FakeStoredCollection()
+    first = [{"_id": i, "temperature_°C": 12.5, "migrated": "run_1"} for i in range(50)]
+    summary = insert_documents(collection, first, chunk_size=7, workers=3, mode="upsert")
+    assert (summary["inserted"], summary["updated"], summary["unchanged"]) == (50, 0, 0)
+
+    # Second run: 5 readings corrected, 10 new ones, the others are the same
+    second = [{"_id": i, "temperature_°C": 13.0 if i < 5 else 12.5, "migrated": "run_2"} for i in range(60)]
+    summary = insert_documents(collection, second, chunk_size=7, workers=3, mode="upsert")
+
+    assert summary["documents"] == 60
+    assert (summary["inserted"], summary["updated"], summary["unchanged"]) == (10, 5, 45)
+    assert collection.replaced == 65
+    # Every document carries the tag of the last run, so the row count check still works
+    assert all(document["migrated"] == "run_2" for document in collection.documents.values())
+    assert collection.documents[0]["temperature_°C"] == 13.0
+
+
+def test_insert_new_skips_the_stored_documents():
+    # A time-series collection has no unique _id index, mongomock stands for it here
+    collection = mongomock.MongoClient().db.weather_station
+    start = datetime(2024, 10, 1)
+    documents = [{"_id": i, "station": "Ichtegem" if i % 2 else "Bergues", "datetime": start + timedelta(hours=i),
+                  "temperature_°C": 12.5} for i in range(40)]
+    collection.insert_many(documents[:15])
+
+    summary = insert_documents(collection, documents, chunk_size=7, workers=3, mode="insert_new")
+
+    assert summary["documents"] == 40
+    assert summary["duplicate"] == 15
+    assert summary["inserted"] == 25
+    assert collection.count_documents({}) == 40
@@ -0,0 +1,128 @@
+import json
+import os
+
+import pandas as pd
+
+import jsonl
+import xlsx
+from cache import FrameCache
+from common import bucket_name
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "scripts", "data")
+
+
+class FakeCollection:
+    def __init__(self):
+        self.documents = []
+
+    def insert_many(self, documents, ordered=False):
+        self.documents.extend(documents)
+
+        class Result:
+            inserted_ids = [document["_id"] for document in documents]
+        return Result()
+
+
+def no_download(*args, **kwargs):
+    raise AssertionError("the object should come from the cache")
+
+
+def test_round_trip_keeps_dtypes_and_metadata(tmp_path):
+    frame = jsonl.convert_records([
+        {"id_station": "07015", "station": "Lille-Lesquin", "dh_utc": "2024-10-01 00:00:00", "temperature": "12.5",
+         "humidite": "80", "nebulosite": ""},
+        {"id_station": "07015", "station": "Lille-Lesquin", "dh_utc": "2024-10-01 01:00:00", "temperature": None,
+         "humidite": None, "nebulosite": "4"},
+    ])
+    cache = FrameCache(str(tmp_path))
+    assert cache.load(bucket_name, "key", '"etag"') == (None, None)
+
+    cache.store(frame, bucket_name, "key", '"etag"', {"row_count": 2})
+    cached, metadata = cache.load(bucket_name, "key", '"etag"')
+
+    pd.testing.assert_frame_equal(cached, frame)
+    assert metadata == {"row_count": 2}
+    # Another ETag is another object
+    assert cache.load(bucket_name, "key", '"other"') == (None, None)
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    frame = pd.DataFrame({"value": range(10_000)}, dtype="float64")
+    cache = FrameCache(str(tmp_path))
+    cache.store(frame, bucket_name, "a", "1")
+    size = os.path.getsize(cache.path(bucket_name, "a", "1"))
+    cache.max_bytes = 2 * size
+
+    cache.store(frame, bucket_name, "b", "1")
+    os.utime(cache.path(bucket_name, "a", "1"), (0, 0))
+    os.utime(cache.path(bucket_name, "b", "1"), (1, 1))
+    # A hit makes "a" the most recently used
+    cache.load(bucket_name, "a", "1")
+    cache.store(frame, bucket_name, "c", "1")
+
+    assert cache.contains(bucket_name, "a", "1")
+    assert not cache.contains(bucket_name, "b", "1")
+    assert cache.contains(bucket_name, "c", "1")
+
+
+def test_files_removed_during_an_eviction_are_skipped(tmp_path, monkeypatch):
+    frame = pd.DataFrame({"value": range(10_000)}, dtype="float64")
+    cache = FrameCache(str(tmp_path))
+    cache.store(frame, bucket_name, "a", "1")
+    cache.store(frame, bucket_name, "b", "1")
+    cache.max_bytes = 0
+    listdir, remove = os.listdir, os.remove
+
+    def listdir_with_a_gone_file(directory):
+        return listdir(directory) + ["gone.arrow"]
+
+    def remove_after_another_process(path):
+        # Another process evicts the file first
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(os, "listdir", listdir_with_a_gone_file)
+    monkeypatch.setattr(os, "remove", remove_after_another_process)
+    cache.evict()
+    monkeypatch.undo()
+    assert listdir(str(tmp_path)) == []
+    assert cache.load(bucket_name, "a", "1") == (None, None)
+
+
+def test_warm_xlsx_run_skips_download_and_parse(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(xlsx, "write_metrics", lambda metrics, source: None)
+    with open(os.path.join(DATA_DIR, "Weather+Underground+-+Ichtegem,+BE.xlsx"), "rb") as workbook:
+        s3.put_object(Bucket=bucket_name, Key="greencoop-airbyte/Ichtegem.xlsx", Body=workbook.read())
+    cache = FrameCache(str(tmp_path))
+
+    cold = FakeCollection()
+    xlsx.migrate(s3, cold, "Ichtegem", "mongodb://test", cache=cache)
+    monkeypatch.setattr(xlsx, "download_objects", no_download)
+    monkeypatch.setattr(xlsx, "parse_workbook", no_download)
+    warm = FakeCollection()
+    xlsx.migrate(s3, warm, "Ichtegem", "mongodb://test", cache=cache)
+
+    pd.testing.assert_frame_equal(pd.DataFrame(cold.documents).drop(columns="migrated"),
+                                  pd.DataFrame(warm.documents).drop(columns="migrated"))
+
+
+def test_warm_jsonl_run_skips_download(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(jsonl, "write_metrics", lambda metrics, source: None)
+    data = {"stations": [{"id": "07015", "name": "Lille-Lesquin"}],
+            "hourly": {"07015": [{"id_station": "07015", "dh_utc": f"2024-10-01 {hour:02d}:00:00",
+                                  "temperature": "12.5", "pression": "1015.2", "humidite": "80",
+                                  "point_de_rosee": "9.1", "vent_moyen": "10.8"} for hour in range(24)]}}
+    s3.put_object(Bucket=bucket_name, Key="greencoop-airbyte/InfoClimat/2025_03_14_1741977939508_0.jsonl",
+                  Body=json.dumps({"_airbyte_emitted_at": 1741977939508, "_airbyte_data": data}))
+    cache = FrameCache(str(tmp_path))
+
+    def run(collection):
+        return jsonl.run(s3, collection, "InfoClimat", "mongodb://test", pattern="greencoop-airbyte/InfoClimat/*.jsonl",
+                         cache=cache)
+
+    cold = FakeCollection()
+    assert run(cold)["inserted"] == 24
+    monkeypatch.setattr(jsonl, "download_objects", no_download)
+    warm = FakeCollection()
+    assert run(warm)["inserted"] == 24
+    assert [document["_id"] for document in cold.documents] == [document["_id"] for document in warm.documents]
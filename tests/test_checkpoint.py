@@ -0,0 +1,172 @@
+import json
+import os
+
+import mongomock
+import pytest
+
+import jsonl
+import xlsx
+from checkpoint import Checkpoint, checkpoint_collection
+from common import bucket_name
+from dedup import Deduplicator
+from jsonl import lines_with_offsets
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "scripts", "data")
+PREFIX = jsonl.file_patterns["InfoClimat"].replace("*.jsonl", "")
+
+
+def airbyte_line(day, hours):
+    data = {
+        "stations": [{"id": "07015", "name": "Lille-Lesquin"}],
+        "hourly": {"07015": [{"id_station": "07015", "dh_utc": f"2024-10-{day:02d} {hour:02d}:00:00",
+                              "temperature": "12.5", "pression": "1015.2", "humidite": "80",
+                              "point_de_rosee": "9.1", "vent_moyen": "10.8"} for hour in hours]},
+    }
+    return json.dumps({"_airbyte_emitted_at": 1741977939508, "_airbyte_data": data})
+
+
+class RecordingS3:
+    """
+    The S3 client, recording the Range of every GET.
+    """
+
+    def __init__(self, s3):
+        self.s3 = s3
+        self.ranges = []
+
+    def get_object(self, **kwargs):
+        self.ranges.append(kwargs.get("Range"))
+        return self.s3.get_object(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+
+def field_names(value):
+    if isinstance(value, dict):
+        for name, item in value.items():
+            yield name
+            yield from field_names(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from field_names(item)
+
+
+def crash_on(module, monkeypatch, call, insert_first=False):
+    """
+    Make the `call`-th insert of the module fail, after inserting its documents with `insert_first`.
+    """
+    insert_documents = module.insert_documents
+    calls = []
+
+    def insert(collection, documents, *args, **kwargs):
+        calls.append(len(documents))
+        if len(calls) == call:
+            if insert_first:
+                insert_documents(collection, documents, *args, **kwargs)
+            raise ConnectionError("MongoDB unreachable")
+        return insert_documents(collection, documents, *args, **kwargs)
+
+    monkeypatch.setattr(module, "insert_documents", insert)
+    return calls
+
+
+def test_lines_keep_their_end_offsets_across_chunks():
+    content = b'{"a": 1}\n{"b": 22}\n\n{"c": 333}'
+    chunks = [content[i:i + 4] for i in range(0, len(content), 4)]
+    lines = list(lines_with_offsets(chunks))
+    assert lines == [(b'{"a": 1}', 9), (b'{"b": 22}', 19), (b"", 20), (b'{"c": 333}', 30)]
+    # Read again from an offset, like after a ranged GET
+    assert list(lines_with_offsets([content[9:]], 9)) == lines[1:]
+
+
+def test_interrupted_export_resumes_from_its_last_batch(s3, monkeypatch):
+    for day, hours in [(1, range(24)), (2, range(12)), (3, range(6))]:
+        s3.put_object(Bucket=bucket_name, Key=f"{PREFIX}2025_03_1{day}_174197793950{day}_0.jsonl",
+                      Body="\n".join([airbyte_line(day, hours[:len(hours) // 2]),
+                                      airbyte_line(day, hours[len(hours) // 2:])]))
+    client = mongomock.MongoClient()
+    collection = client.weather_data.weather_station
+    written = {}
+    monkeypatch.setattr(jsonl, "write_metrics", lambda metrics, source: written.__setitem__(source, metrics))
+
+    def load(s3):
+        return jsonl.run(s3, collection, "InfoClimat", "mongodb://test", batch_size=5, latest=0,
+                         manifest=client.weather_data.migration_manifest, dedup=Deduplicator(collection),
+                         checkpoint=Checkpoint(checkpoint_collection(client), "InfoClimat"))
+
+    # The fourth batch, the second line of the second export, is inserted but the process dies before its commit
+    crash_on(jsonl, monkeypatch, 4, insert_first=True)
+    with pytest.raises(ConnectionError):
+        load(s3)
+    state = checkpoint_collection(client).find_one({"_id": "InfoClimat"})
+    assert state["done_keys"] == [f"{PREFIX}2025_03_11_1741977939501_0.jsonl"]
+    assert state["metrics"]["row_count"] == 30 and collection.count_documents({}) == 36
+    # MongoDB 4.4 rejects the field names with a dot, such as the S3 keys
+    assert not any("." in name for name in field_names(state))
+    assert state["stats"][0]["key"] == state["done_keys"][0] and state["stats"][0]["row_count"] == 24
+
+    monkeypatch.undo()
+    monkeypatch.setattr(jsonl, "write_metrics", lambda metrics, source: written.__setitem__(source, metrics))
+    recording = RecordingS3(s3)
+    summary = load(recording)
+    # The rest of the second export is read from the offset of the last commit
+    assert recording.ranges == [f"bytes={state['offset']}-", None]
+    assert written["InfoClimat"]["migration_tag"] == state["migration_tag"]
+    assert written["InfoClimat"]["row_count"] == 42
+    assert written["InfoClimat"]["fields"]["temperature_°C"]["count"] == 42
+    assert collection.count_documents({"migrated": state["migration_tag"]}) == 42
+    # The documents of the batch in flight were inserted before the crash, they come back as duplicates
+    assert summary["inserted"] == 36 and summary["duplicate"] == 6
+    assert checkpoint_collection(client).count_documents({}) == 0
+
+
+def test_interrupted_workbook_skips_its_committed_sheets(s3, monkeypatch):
+    with open(os.path.join(DATA_DIR, "Weather+Underground+-+Ichtegem,+BE.xlsx"), "rb") as f:
+        s3.put_object(Bucket=bucket_name, Key="greencoop-airbyte/Ichtegem.xlsx", Body=f.read())
+    client = mongomock.MongoClient()
+    collection = client.weather_data.weather_station
+    written = {}
+    monkeypatch.setattr(xlsx, "write_metrics", lambda metrics, source: written.__setitem__(source, metrics))
+    # The workbook holds a single week, it is inserted two days at a time
+    monkeypatch.setattr(xlsx, "pipeline_sheets", 2)
+
+    def load():
+        return xlsx.migrate(s3, collection, "Ichtegem", "mongodb://test", processes=1,
+                            checkpoint=Checkpoint(checkpoint_collection(client), "Ichtegem"))
+
+    crash_on(xlsx, monkeypatch, 2)
+    with pytest.raises(ConnectionError):
+        load()
+    state = checkpoint_collection(client).find_one({"_id": "Ichtegem"})
+    committed = collection.count_documents({})
+    assert state["sheets"] == ["011024", "021024"] and 0 < committed == state["metrics"]["row_count"] < 1899
+
+    monkeypatch.undo()
+    monkeypatch.setattr(xlsx, "write_metrics", lambda metrics, source: written.__setitem__(source, metrics))
+    monkeypatch.setattr(xlsx, "pipeline_sheets", 2)
+    calls = crash_on(xlsx, monkeypatch, 0)
+    summary = load()
+    # Only the sheets after the committed ones are sent
+    assert sum(calls) == 1899 - committed
+    assert summary["inserted"] == 1899
+    assert written["Ichtegem"]["migration_tag"] == state["migration_tag"]
+    assert written["Ichtegem"]["row_count"] == 1899
+    assert collection.count_documents({"migrated": state["migration_tag"]}) == 1899
+    assert checkpoint_collection(client).count_documents({}) == 0
+
+
+def test_every_mode_migrates_every_airbyte_line(s3, monkeypatch):
+    s3.put_object(Bucket=bucket_name, Key=f"{PREFIX}2025_03_11_1741977939501_0.jsonl",
+                  Body="\n".join([airbyte_line(1, range(12)), airbyte_line(1, range(12, 24))]))
+    monkeypatch.setattr(jsonl, "write_metrics", lambda metrics, source: None)
+    loaded = {}
+    for mode in ["batch", "stream", "pipeline", "resume"]:
+        client = mongomock.MongoClient()
+        collection = client.weather_data.weather_station
+        jsonl.run(s3, collection, "InfoClimat", "mongodb://test", stream=mode == "stream", batch_size=5,
+                  pipeline=mode == "pipeline", processes=1,
+                  checkpoint=Checkpoint(checkpoint_collection(client), "InfoClimat") if mode == "resume" else None)
+        loaded[mode] = sorted(collection.distinct("_id"))
+    assert len(loaded["batch"]) == 24
+    assert loaded["stream"] == loaded["pipeline"] == loaded["resume"] == loaded["batch"]
@@ -0,0 +1,118 @@
+import os
+
+import mongomock
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+from common import collection_name, database_name
+from create_collection import (convert_to_timeseries, create_collection, deferred_indexes, ensure_indexes,
+                               is_timeseries, timeseries_options, write_mode)
+
+# A MongoDB 6.0+ server whose weather collection the tests may drop, the tests needing one are skipped without it
+test_server = os.environ.get("MONGODB_TEST_ADDRESS")
+
+
+def secondary_indexes(collection):
+    return sorted(name for name in collection.index_information() if name != "_id_")
+
+
+def test_ensure_indexes_is_idempotent():
+    collection = mongomock.MongoClient()[database_name][collection_name]
+    ensure_indexes(collection)
+    ensure_indexes(collection)
+    assert secondary_indexes(collection) == ["migrated", "station_datetime"]
+
+    ensure_indexes(collection, partial=True)
+    assert secondary_indexes(collection) == ["datetime_snow", "migrated", "station_datetime", "station_datetime_rain"]
+
+
+def test_deferred_indexes_are_rebuilt_after_the_load():
+    collection = mongomock.MongoClient()[database_name][collection_name]
+    ensure_indexes(collection, partial=True)
+    collection.create_index("temperature_°C", name="custom")
+
+    rebuilt = []
+    with deferred_indexes(collection) as deferred:
+        # Only the indexes of the plan are dropped, station_datetime serves the duplicate checks of the load
+        assert secondary_indexes(collection) == ["custom", "station_datetime"]
+        collection.insert_many([{"station": "Ichtegem", "datetime": i, "migrated": "tag"} for i in range(10)])
+        deferred.after(lambda: rebuilt.append(secondary_indexes(collection)))
+    assert secondary_indexes(collection) == [
+        "custom", "datetime_snow", "migrated", "station_datetime", "station_datetime_rain"]
+    # The callbacks, such as the rollups, run once the indexes are back
+    assert rebuilt == [secondary_indexes(collection)]
+
+    with pytest.raises(RuntimeError):
+        with deferred_indexes(collection) as deferred:
+            deferred.after(lambda: rebuilt.append(None))
+            raise RuntimeError("load failed")
+    assert "migrated" in secondary_indexes(collection)
+    assert len(rebuilt) == 1
+
+
+class OptionsCollection:
+    name = collection_name
+
+    def __init__(self, options):
+        self._options = options
+
+    def options(self):
+        return self._options
+
+
+def test_write_mode_of_a_timeseries_collection():
+    assert write_mode(OptionsCollection({}), "upsert") == "upsert"
+    timeseries = OptionsCollection({"timeseries": timeseries_options})
+    assert write_mode(timeseries, "insert") == "insert_new"
+    with pytest.raises(ValueError):
+        write_mode(timeseries, "upsert")
+
+
+class CreateOptionsClient:
+    """
+    mongomock client recording the options of create_collection, which mongomock does not support.
+    """
+
+    def __init__(self, error=None):
+        self.client = mongomock.MongoClient()
+        self.db = self.client[database_name]
+        self.created = []
+        self.error = error
+        self.db.create_collection = self.create
+
+    def create(self, name, **options):
+        if self.error is not None:
+            raise self.error
+        self.created.append(options)
+        self.db[name].insert_one({"_id": 0})
+        self.db[name].delete_one({"_id": 0})
+
+    def __getitem__(self, name):
+        return self.db
+
+
+def test_timeseries_collection_is_created_without_validator():
+    client = CreateOptionsClient()
+    create_collection(client, timeseries=True)
+    assert client.created == [{"timeseries": timeseries_options}]
+    create_collection(client)
+    assert client.created[1]["validator"]["$jsonSchema"]
+
+
+def test_failed_timeseries_conversion_restores_the_collection():
+    client = CreateOptionsClient(OperationFailure("time-series collections are not supported"))
+    client.db[collection_name].insert_one({"station": "Ichtegem"})
+    with pytest.raises(OperationFailure):
+        convert_to_timeseries(client, "mongodb://test")
+    assert client.db.list_collection_names() == [collection_name]
+    assert client.db[collection_name].count_documents({}) == 1
+
+
+@pytest.mark.skipif(test_server is None, reason="MONGODB_TEST_ADDRESS is not set")
+def test_timeseries_collection_on_a_server():
+    client = MongoClient(test_server)
+    create_collection(client, timeseries=True)
+    collection = client[database_name][collection_name]
+    assert is_timeseries(collection)
+    assert "station_datetime" in collection.index_information()
@@ -0,0 +1,99 @@
+import json
+
+import mongomock
+import pandas as pd
+import pytest
+
+import jsonl
+from common import bucket_name
+from dedup import BloomFilter, Deduplicator
+from ids import generate_objectid, generate_objectids
+
+PREFIX = "greencoop-airbyte/InfoClimat/"
+
+
+def readings(hours, station="Ichtegem"):
+    datetimes = pd.Series(pd.date_range("2024-10-01", periods=24, freq="h")[list(hours)])
+    return pd.DataFrame({"_id": generate_objectids(datetimes, station), "station": station, "datetime": datetimes,
+                         "temperature_°C": 12.5})
+
+
+def stored_collection(hours):
+    collection = mongomock.MongoClient()["weather_data"]["weather_station"]
+    if hours:
+        collection.insert_many(readings(hours).to_dict(orient="records"))
+    return collection
+
+
+def test_duplicates_within_and_across_batches_are_dropped():
+    dedup = Deduplicator(stored_collection([]))
+    first = dedup.filter(pd.concat([readings(range(0, 6)), readings([2, 3])], ignore_index=True))
+    second = dedup.filter(readings(range(4, 10)))
+    assert len(first) == 6 and len(second) == 4
+    assert dedup.counts == {"skipped_in_load": 4, "skipped_stored": 0}
+
+
+def test_ids_of_a_long_load_move_to_a_bloom_filter():
+    collection = stored_collection([])
+    dedup = Deduplicator(collection, seen_limit=4)
+    first = dedup.filter(readings(range(0, 6)))
+    assert dedup.seen == set() and len(dedup.seen_blooms) == 1
+    collection.insert_many(first.to_dict(orient="records"))
+    # The positives of the filter are confirmed against the collection
+    second = dedup.filter(readings(range(3, 9)))
+    assert sorted(second["datetime"].dt.hour) == [6, 7, 8]
+    assert dedup.counts == {"skipped_in_load": 3, "skipped_stored": 0}
+
+
+@pytest.mark.parametrize("set_limit", [1000, 0])
+def test_stored_ids_are_dropped_with_a_set_or_a_bloom_filter(set_limit):
+    dedup = Deduplicator(stored_collection(range(0, 12)), set_limit=set_limit)
+    kept = dedup.filter(pd.concat([readings(range(8, 16)), readings(range(8, 16), "Madeleine")], ignore_index=True))
+    assert sorted(kept["datetime"].dt.hour[kept["station"] == "Ichtegem"]) == [12, 13, 14, 15]
+    assert (kept["station"] == "Madeleine").sum() == 8
+    assert dedup.counts["skipped_stored"] == 4
+
+
+def test_upsert_mode_keeps_the_stored_documents():
+    dedup = Deduplicator(stored_collection(range(0, 12)), mode="upsert")
+    assert len(dedup.filter(readings(range(0, 12)))) == 12
+    assert dedup.counts["skipped_stored"] == 0
+
+
+def test_bloom_filter_has_no_false_negative():
+    stored = [generate_objectid(f"stored {i}") for i in range(5000)]
+    others = [generate_objectid(f"other {i}") for i in range(5000)]
+    bloom = BloomFilter(len(stored), error_rate=0.01)
+    bloom.add(stored)
+    assert bloom.contains(stored).all()
+    assert bloom.contains(others).mean() < 0.03
+
+
+def airbyte_line(hours):
+    data = {
+        "stations": [{"id": "07015", "name": "Lille-Lesquin"}],
+        "hourly": {"07015": [{"id_station": "07015", "dh_utc": f"2024-10-01 {hour:02d}:00:00", "temperature": "12.5",
+                              "pression": "1015.2", "humidite": "80", "point_de_rosee": "9.1", "vent_moyen": "10.8"}
+                             for hour in hours]},
+    }
+    return json.dumps({"_airbyte_emitted_at": 1741977939508, "_airbyte_data": data})
+
+
+def test_overlapping_exports_send_only_new_readings(s3, monkeypatch):
+    monkeypatch.setattr(jsonl, "write_metrics", lambda metrics, source: None)
+    collection = mongomock.MongoClient()["weather_data"]["weather_station"]
+    s3.put_object(Bucket=bucket_name, Key=PREFIX + "2025_03_14_1741977939508_0.jsonl", Body=airbyte_line(range(0, 12)))
+    s3.put_object(Bucket=bucket_name, Key=PREFIX + "2025_03_15_1742064339508_0.jsonl", Body=airbyte_line(range(6, 18)))
+
+    def run():
+        return jsonl.run(s3, collection, "InfoClimat", "mongodb://test", pattern=PREFIX + "*.jsonl", latest=0,
+                         dedup=Deduplicator(collection))
+
+    summary = run()
+    assert summary["documents"] == summary["inserted"] == 18
+    assert summary["skipped_in_load"] == 6 and summary["duplicate"] == 0
+
+    # Run again, every reading is already stored and nothing is sent
+    summary = run()
+    assert summary["documents"] == 0
+    assert summary["skipped_in_load"] == 6 and summary["skipped_stored"] == 18
@@ -0,0 +1,103 @@
+import io
+import os
+from datetime import datetime, timedelta
+
+import mongomock
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+
+from common import bucket_name
+from export import export, upload_object
+from ids import generate_objectid
+
+PREFIX = "exports/weather_station/"
+
+
+def readings(station, start, count, tag):
+    return [{"_id": generate_objectid(f"{station} {start + timedelta(hours=i)}"), "station": station,
+             "datetime": start + timedelta(hours=i), "temperature_°C": float(i), "humidity_%": 80,
+             "solar_w/m²": "n/a" if i == 0 else 12.5, "migrated": tag} for i in range(count)]
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().weather_data
+    db.weather_station.insert_many(readings("Ichtegem", datetime(2024, 10, 1, 12), 24, "first")
+                                   + readings("La Madeleine", datetime(2024, 10, 1), 24, "first"))
+    return db
+
+
+def download(s3, tmp_path):
+    keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket=bucket_name, Prefix=PREFIX).get("Contents", [])]
+    for key in keys:
+        path = tmp_path / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(s3.get_object(Bucket=bucket_name, Key=key)["Body"].read())
+    return sorted(os.path.relpath(key, PREFIX).rsplit("/", 1)[0] for key in keys)
+
+
+def test_documents_are_partitioned_by_station_and_day(s3, db, tmp_path):
+    entry = export(db.weather_station, db.export_manifest, s3, batch_size=7)
+    assert entry["rows"] == 48 and entry["files"] == 3 and entry["tags"] == ["first"]
+
+    assert download(s3, tmp_path) == ["station=Ichtegem/date=2024-10-01", "station=Ichtegem/date=2024-10-02",
+                                      "station=La%20Madeleine/date=2024-10-01"]
+    table = ds.dataset(tmp_path / PREFIX, format="parquet", partitioning="hive").to_table()
+    frame = table.to_pandas().sort_values(["station", "datetime"])
+    assert frame["station"].value_counts().to_dict() == {"Ichtegem": 24, "La Madeleine": 24}
+    first = frame.iloc[0]
+    assert str(first["datetime"]) == "2024-10-01 12:00:00+00:00"
+    assert first["temperature_°C"] == 0.0 and first["humidity_%"] == 80.0
+    # A value that is not a number is null
+    assert frame["solar_w/m²"].isna().sum() == 2
+    assert first["_id"] == str(generate_objectid("Ichtegem 2024-10-01 12:00:00"))
+
+
+def test_incremental_exports(s3, db):
+    collection = db.weather_station
+    assert export(collection, db.export_manifest, s3, incremental="tag", period="month")["rows"] == 48
+    assert export(collection, db.export_manifest, s3, incremental="tag") is None
+
+    collection.insert_many(readings("Ichtegem", datetime(2024, 10, 3), 5, "second"))
+    entry = export(collection, db.export_manifest, s3, incremental="tag")
+    assert entry["rows"] == 5 and entry["tags"] == ["second"]
+
+    # The datetime watermark is the last reading exported so far
+    collection.insert_many(readings("Ichtegem", datetime(2024, 10, 3, 5), 2, "third")
+                           + readings("Ichtegem", datetime(2024, 9, 1), 2, "third"))
+    entry = export(collection, db.export_manifest, s3, incremental="datetime")
+    assert entry["rows"] == 2 and entry["watermark"] == datetime(2024, 10, 3, 6)
+
+
+def test_failed_export_deletes_its_files(s3, db, monkeypatch):
+    import export as module
+
+    calls = []
+
+    def upload(s3, key, content, bucket, part_size):
+        calls.append(key)
+        if len(calls) == 3:
+            raise ConnectionError("upload failed")
+        s3.put_object(Bucket=bucket, Key=key, Body=content)
+
+    monkeypatch.setattr(module, "upload_object", upload)
+    with pytest.raises(ConnectionError):
+        export(db.weather_station, db.export_manifest, s3, workers=1)
+    assert "Contents" not in s3.list_objects_v2(Bucket=bucket_name, Prefix=PREFIX)
+    assert db.export_manifest.count_documents({}) == 0
+
+
+def test_large_files_go_up_in_a_multipart_upload(s3):
+    content = os.urandom(11 * 1024 * 1024)
+    upload_object(s3, "exports/large.parquet", content, part_size=5 * 1024 * 1024)
+    response = s3.get_object(Bucket=bucket_name, Key="exports/large.parquet")
+    assert response["Body"].read() == content
+    assert response["ETag"].endswith('-3"')
+
+
+def test_parquet_files_are_compressed(s3, db):
+    export(db.weather_station, db.export_manifest, s3, compression="zstd")
+    key = s3.list_objects_v2(Bucket=bucket_name, Prefix=PREFIX)["Contents"][0]["Key"]
+    metadata = pq.ParquetFile(io.BytesIO(s3.get_object(Bucket=bucket_name, Key=key)["Body"].read())).metadata
+    assert metadata.row_group(0).column(0).compression == "ZSTD"
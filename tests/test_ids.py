@@ -0,0 +1,32 @@
+from datetime import datetime
+
+import pandas as pd
+
+import ids
+from ids import generate_objectid, generate_objectids
+
+DATETIMES = pd.Series(pd.to_datetime([
+    "2024-10-01 00:04:00",
+    "2024-10-05 23:59:59",
+    "2024-10-05 12:00:00.500000",
+], format="ISO8601"))
+STATIONS = pd.Series(["Ichtegem", "Lille-Lesquin", "Armentières"])
+
+
+def test_same_ids_as_row_by_row_generation():
+    expected = [generate_objectid(str(dt) + station) for dt, station in zip(DATETIMES, STATIONS)]
+    assert generate_objectids(DATETIMES, STATIONS) == expected
+
+
+def test_single_station_and_python_datetimes():
+    python_datetimes = [datetime(2024, 10, 5, 3, 0), datetime(2024, 10, 5, 4, 0)]
+    expected = [generate_objectid(str(dt) + "Bergues") for dt in python_datetimes]
+    assert generate_objectids(python_datetimes, "Bergues") == expected
+
+
+def test_process_pool_gives_the_same_ids(monkeypatch):
+    datetimes = pd.Series(pd.date_range("2024-10-01", periods=200, freq="5min"))
+    expected = generate_objectids(datetimes, "Madeleine")
+
+    monkeypatch.setattr(ids, "parallel_threshold", 10)
+    assert generate_objectids(datetimes, "Madeleine", processes=2) == expected
@@ -0,0 +1,61 @@
+import pstats
+import tracemalloc
+
+import pytest
+
+from instrument import StageTimer, prometheus_text
+
+
+def test_repeated_stages_add_up():
+    timer = StageTimer("InfoClimat")
+    for rows in (10, 20):
+        with timer.stage("parse", bytes_in=100) as stage:
+            stage.rows_out = rows
+    with pytest.raises(RuntimeError):
+        with timer.stage("insert", rows_in=30):
+            raise RuntimeError("insert failed")
+
+    parse = timer.stages["parse"]
+    assert parse["calls"] == 2
+    assert parse["rows_out"] == 30 and parse["bytes_in"] == 200 and parse["rows_in"] is None
+    assert parse["wall_seconds"] >= 0 and parse["cpu_seconds"] >= 0
+    # A failed stage is recorded too
+    assert timer.stages["insert"]["rows_in"] == 30
+
+
+def test_trace_memory_records_the_python_peak():
+    timer = StageTimer("Ichtegem", trace_memory=True)
+    try:
+        with timer.stage("transform"):
+            data = bytearray(5 * 1024 ** 2)
+            del data
+    finally:
+        # Tracing slows down every test that follows
+        tracemalloc.stop()
+    assert timer.stages["transform"]["python_peak_bytes"] >= 5 * 1024 ** 2
+
+
+def test_hot_stages_are_profiled(tmp_path):
+    timer = StageTimer("Madeleine", profile_dir=str(tmp_path))
+    with timer.stage("parse"):
+        sorted(range(1000), key=lambda x: -x)
+    with timer.stage("insert"):
+        pass
+    # A stage run once per batch keeps the profile of every run
+    with timer.stage("parse"):
+        max(range(1000), key=lambda x: -x)
+    assert list(tmp_path.iterdir()) == []
+    timer.dump_profiles()
+    assert [path.name for path in tmp_path.iterdir()] == ["Madeleine_parse.pstats"]
+    functions = {function for _, _, function in pstats.Stats(str(tmp_path / "Madeleine_parse.pstats")).stats}
+    assert "<built-in method builtins.sorted>" in functions and "<built-in method builtins.max>" in functions
+
+
+def test_prometheus_text():
+    timer = StageTimer("Ichtegem")
+    with timer.stage("download", bytes_in=2048):
+        pass
+    text = prometheus_text(timer.report())
+    assert "# TYPE migration_stage_wall_seconds gauge" in text
+    assert 'migration_stage_bytes_in{source="Ichtegem",stage="download"} 2048' in text
+    assert "rows_out" not in text
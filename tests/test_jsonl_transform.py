@@ -0,0 +1,68 @@
+import copy
+from datetime import datetime
+
+from ids import generate_objectid
+from jsonl import add_ids, convert_records, frame_to_documents
+
+
+def legacy_process(document):
+    """
+    Per-document conversion used by jsonl.py before the columnar conversion, kept as the reference.
+    """
+    document = copy.deepcopy(document)
+    document['dh_utc'] = datetime.strptime(document['dh_utc'], '%Y-%m-%d %H:%M:%S')
+    document['temperature'] = float(document['temperature']) if document.get('temperature') else None
+    document['pression'] = float(document['pression']) if document.get('pression') else None
+    document['humidite'] = int(document['humidite']) if document.get('humidite') else None
+    document['point_de_rosee'] = float(document['point_de_rosee']) if document.get('point_de_rosee') else None
+    document['visibilite'] = int(document.get('visibilite', 0)) if document.get('visibilite') else None
+    document['vent_moyen'] = float(document['vent_moyen']) if document.get('vent_moyen') else None
+    document['vent_rafales'] = float(document['vent_rafales']) if document.get('vent_rafales') else None
+    document['vent_direction'] = int(document['vent_direction']) if document.get('vent_direction') else None
+    document['pluie_3h'] = float(document['pluie_3h']) if document.get('pluie_3h') else None
+    document['pluie_1h'] = float(document['pluie_1h']) if document.get('pluie_1h') else None
+    document['neige_au_sol'] = float(document.get('neige_au_sol', 0)) if document.get('neige_au_sol') else None
+    document['nebulosite'] = str(document.get('nebulosite', '')) if document.get('nebulosite') else ''
+    document['temps_omm'] = float(document.get('temps_omm', 0)) if document.get('temps_omm') else None
+
+    mapping = {
+        'dh_utc': 'datetime', 'temperature': 'temperature_°C', 'pression': 'pressure_hPa',
+        'humidite': 'humidity_%', 'point_de_rosee': 'dew_point_°C', 'visibilite': 'visibility_m',
+        'vent_moyen': 'wind_speed_kph', 'vent_rafales': 'wind_gust_kph', 'vent_direction': 'wind_dir',
+        'pluie_3h': 'precip_rate_mm/hr (3hrs)', 'pluie_1h': 'precip_rate_mm/hr', 'neige_au_sol': 'snow_depth_mm',
+        'nebulosite': 'cloud_coverage', 'temps_omm': 'solar_w/m²'
+    }
+    for old_key, new_key in mapping.items():
+        if old_key in document:
+            document[new_key] = document.pop(old_key)
+    document['_id'] = generate_objectid(str(document['datetime']) + document['station'])
+    document['migrated'] = "tag"
+    return document
+
+
+RECORDS = [
+    # Static station: no visibilite/neige_au_sol/nebulosite/temps_omm keys
+    {'id_station': 'STATIC0010', 'dh_utc': '2024-10-05 00:00:00', 'temperature': '4.7', 'pression': '1020.6',
+     'humidite': '97', 'point_de_rosee': '4.2', 'vent_moyen': '0', 'vent_rafales': None, 'vent_direction': '0',
+     'pluie_3h': None, 'pluie_1h': '0', 'station': 'Hazebrouck'},
+    # Synop station with every field
+    {'id_station': '07015', 'dh_utc': '2024-10-05 03:00:00', 'temperature': '6.2', 'pression': '1020.1',
+     'humidite': '95', 'point_de_rosee': '5.5', 'visibilite': '2500', 'vent_moyen': '3.6', 'vent_rafales': '7.2',
+     'vent_direction': '60', 'pluie_3h': '0', 'pluie_1h': '0', 'neige_au_sol': None, 'nebulosite': '',
+     'temps_omm': '10', 'station': 'Lille-Lesquin'},
+    # Empty strings and non empty nebulosite
+    {'id_station': '07015', 'dh_utc': '2024-10-05 04:00:00', 'temperature': '-0.3', 'pression': '',
+     'humidite': '', 'point_de_rosee': '-1.0', 'visibilite': '', 'vent_moyen': '', 'vent_rafales': '',
+     'vent_direction': '', 'pluie_3h': '', 'pluie_1h': '0.2', 'neige_au_sol': '1', 'nebulosite': '8',
+     'temps_omm': '', 'station': 'Lille-Lesquin'},
+]
+
+
+def test_columnar_conversion_matches_per_document_conversion():
+    expected = [legacy_process(record) for record in RECORDS]
+    documents = frame_to_documents(add_ids(convert_records(copy.deepcopy(RECORDS)), "tag"))
+
+    assert documents == expected
+    for document, reference in zip(documents, expected):
+        assert list(document) == list(reference)
+        assert [type(value) for value in document.values()] == [type(value) for value in reference.values()]
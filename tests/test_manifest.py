@@ -0,0 +1,68 @@
+import json
+
+import mongomock
+import pytest
+
+import jsonl
+from common import bucket_name
+from manifest import manifest_collection, source_watermark
+
+PREFIX = "greencoop-airbyte/InfoClimat/"
+
+
+class FakeCollection:
+    def __init__(self):
+        self.documents = []
+
+    def insert_many(self, documents, ordered=False):
+        self.documents.extend(documents)
+
+        class Result:
+            inserted_ids = [document["_id"] for document in documents]
+        return Result()
+
+
+def airbyte_line(day, emitted_at):
+    data = {
+        "stations": [{"id": "07015", "name": "Lille-Lesquin"}],
+        "hourly": {"07015": [{"id_station": "07015", "dh_utc": f"2024-10-{day:02d} {hour:02d}:00:00",
+                              "temperature": "12.5", "pression": "1015.2", "humidite": "80", "point_de_rosee": "9.1",
+                              "vent_moyen": "10.8"} for hour in range(24)]},
+    }
+    return json.dumps({"_airbyte_emitted_at": emitted_at, "_airbyte_data": data})
+
+
+def test_airbyte_emitted_at_formats():
+    assert jsonl.airbyte_emitted_at({"_airbyte_emitted_at": 1741977939508}) == 1741977939508
+    assert jsonl.airbyte_emitted_at({"_airbyte_extracted_at": "2025-03-14T18:45:39.508Z"}) == 1741977939508
+    assert jsonl.airbyte_emitted_at({"_airbyte_data": {}}) is None
+
+
+@pytest.mark.parametrize("stream, pipeline", [(False, False), (True, False), (False, True)])
+def test_incremental_runs_skip_unchanged_exports_and_old_records(s3, monkeypatch, stream, pipeline):
+    monkeypatch.setattr(jsonl, "write_metrics", lambda metrics, source: None)
+    manifest = manifest_collection(mongomock.MongoClient())
+    collection = FakeCollection()
+
+    def run():
+        return jsonl.run(s3, collection, "InfoClimat", "mongodb://test", stream=stream, pattern=PREFIX + "*.jsonl",
+                         latest=0, manifest=manifest, incremental=True, new_records_only=True, pipeline=pipeline)
+
+    key = PREFIX + "2025_03_14_1741977939508_0.jsonl"
+    s3.put_object(Bucket=bucket_name, Key=key, Body=airbyte_line(1, 1000))
+    assert run()["inserted"] == 24
+    assert source_watermark(manifest, "InfoClimat") == 1000
+
+    # Nothing changed in S3
+    assert run()["documents"] == 0
+
+    # A new sync, the old partition being rewritten with its old record first
+    s3.put_object(Bucket=bucket_name, Key=key, Body=airbyte_line(1, 1000) + "\n" + airbyte_line(2, 2000))
+    s3.put_object(Bucket=bucket_name, Key=PREFIX + "2025_03_15_1742000000000_0.jsonl", Body=airbyte_line(3, 3000))
+    summary = run()
+
+    # The record emitted at 1000 is not migrated again
+    assert summary["inserted"] == 48
+    assert len(collection.documents) == 72
+    assert source_watermark(manifest, "InfoClimat") == 3000
+    assert manifest.find_one({"key": key})["row_count"] == 24
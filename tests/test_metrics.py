@@ -0,0 +1,89 @@
+import json
+import statistics
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from metrics import FieldStats, KLLSketch, MetricsAccumulator, rank_error
+
+
+def max_rank_error(sketch, ordered):
+    return max(abs(np.searchsorted(ordered, sketch.quantile(q)) / len(ordered) - q) for q in np.linspace(0.01, 0.99, 99))
+
+
+def test_rank_error_of_the_default_sketch():
+    assert rank_error(200) == pytest.approx(0.0133, abs=1e-4)
+
+
+def test_small_inputs_are_kept_exactly():
+    sketch = KLLSketch()
+    sketch.update([5.0, 1.0, 3.0])
+    assert sketch.quantile(0.5) == 3.0
+    assert sketch.rank_range(3.0) == pytest.approx((1 / 3, 2 / 3))
+
+
+def test_batched_and_merged_sketches_stay_within_the_rank_error():
+    values = np.random.default_rng(0).normal(10, 5, 200_000)
+    ordered = np.sort(values)
+
+    batched = KLLSketch(seed=1)
+    for start in range(0, len(values), 5000):
+        batched.update(values[start:start + 5000])
+    assert sum(len(level) for level in batched.levels) < 1000
+    assert max_rank_error(batched, ordered) <= rank_error()
+
+    # Four workers, merged in a different order than the rows
+    parts = [KLLSketch(seed=seed) for seed in range(4)]
+    for worker, part in enumerate(parts):
+        part.update(values[worker::4])
+    merged = parts[3].merge(parts[1]).merge(parts[0]).merge(parts[2])
+    assert merged.n == len(values)
+    assert max_rank_error(merged, ordered) <= rank_error()
+
+    assert max_rank_error(KLLSketch.from_dict(json.loads(json.dumps(merged.to_dict()))), ordered) <= rank_error()
+
+
+def test_field_stats_moments_are_exact_over_chunks():
+    values = np.random.default_rng(1).uniform(-20, 40, 10_001)
+    left, right = FieldStats(), FieldStats()
+    for start in range(0, 6000, 777):
+        left.update(values[start:min(start + 777, 6000)])
+    right.update(values[6000:])
+
+    merged = FieldStats.from_dict(left.to_dict()).merge(right).to_dict()
+    assert merged["count"] == len(values)
+    assert merged["min"] == values.min() and merged["max"] == values.max()
+    assert merged["mean"] == pytest.approx(values.mean(), rel=1e-12)
+    assert merged["variance"] == pytest.approx(statistics.variance(values), rel=1e-9)
+
+
+def test_accumulator_per_station_and_merge():
+    df = pd.DataFrame({
+        "station": ["Bergues", "Lille-Lesquin", "Bergues", "Bergues", "Lille-Lesquin"],
+        "temperature_°C": [10.0, 12.0, np.nan, 14.0, 11.0],
+        "humidity_%": pd.array([80, None, 90, 70, 60], dtype="Int64"),
+        "solar_w/m²": [None, "n/a", 3.0, None, 5.0],
+    })
+    fields = ["temperature_°C", "humidity_%", "solar_w/m²"]
+    whole = MetricsAccumulator(fields)
+    whole.update(df)
+    halves = MetricsAccumulator(fields)
+    halves.update(df.iloc[:2])
+    other = MetricsAccumulator(fields)
+    other.update(df.iloc[2:])
+    halves.merge(other)
+
+    for accumulator in [whole, halves]:
+        metrics = json.loads(json.dumps(accumulator.to_dict()))
+        assert accumulator.row_count == 5
+        assert metrics["fields"]["temperature_°C"]["count"] == 4
+        assert metrics["fields"]["solar_w/m²"]["count"] == 2
+        bergues = metrics["stations"]["Bergues"]
+        assert bergues["temperature_°C"]["median"] == 10.0
+        assert bergues["humidity_%"] == {**bergues["humidity_%"], "count": 3, "min": 70.0, "max": 90.0, "mean": 80.0}
+        assert accumulator.summary(["temperature_°C"]) == {
+            "median_temperature_°C": accumulator.overall["temperature_°C"].sketch.quantile(0.5),
+            "min_temperature_°C": 10.0,
+            "max_temperature_°C": 14.0,
+        }
@@ -1,8 +1,21 @@
 import pytest
 import pymongo
-import statistics
 import os
 from utils import load_expected_metrics
+from metrics import KLLSketch
+from verify import migration_stats
+
+# Without a sketch in the expected metrics (older files), the medians are compared by value
+median_tolerance = 0.1
+
+
+def median_within_sketch_error(median, sketch, rank_error):
+    """
+    The median found by MongoDB must sit at the middle rank of the migrated values,
+    up to the rank error of the sketch written at migration time.
+    """
+    below, below_or_equal = KLLSketch.from_dict(sketch).rank_range(median)
+    return below - rank_error <= 0.5 <= below_or_equal + rank_error
 
 @pytest.fixture
 def expected_metrics(request):
@@ -25,34 +38,64 @@ def mongo(expected_metrics):
 
 
 @pytest.fixture
-def migrated_docs(mongo, expected_metrics):
+def stats(mongo, expected_metrics):
+    # One aggregation computed by MongoDB, the documents are not loaded
     collection = mongo["weather_station"]
-    tag = expected_metrics["migration_tag"]
-    return list(collection.find({"migrated": tag}))
+    return migration_stats(collection, expected_metrics["migration_tag"])
 
 
-def test_row_count(migrated_docs, expected_metrics):
-    assert len(migrated_docs) == expected_metrics["row_count"], (
-        f"Expected {expected_metrics['row_count']} rows, got {len(migrated_docs)}"
+def test_row_count(stats, expected_metrics):
+    assert stats["row_count"] == expected_metrics["row_count"], (
+        f"Expected {expected_metrics['row_count']} rows, got {stats['row_count']}"
     )
 
 
-def test_median_temperature(migrated_docs, expected_metrics):
-    temps = [doc["temperature_°C"] for doc in migrated_docs if "temperature_°C" in doc]
-    assert round(statistics.median(temps), 1) == round(expected_metrics["median_temperature_°C"], 1), (
-        f"Expected median temp {expected_metrics['median_temperature_°C']}, got {statistics.median(temps)}"
-    )
+def test_median_temperature(stats, expected_metrics):
+    median = stats["fields"]["temperature_°C"]["median"]
+    if "fields" in expected_metrics:
+        sketch = expected_metrics["fields"]["temperature_°C"]["sketch"]
+        assert median_within_sketch_error(median, sketch, expected_metrics["rank_error"]), (
+            f"Median temp {median} is not at the middle rank of the expected sketch"
+        )
+    else:
+        assert abs(median - expected_metrics["median_temperature_°C"]) <= median_tolerance, (
+            f"Expected median temp {expected_metrics['median_temperature_°C']}, got {median}"
+        )
 
 
-def test_min_temperature(migrated_docs, expected_metrics):
-    temps = [doc["temperature_°C"] for doc in migrated_docs if "temperature_°C" in doc]
-    assert min(temps) == expected_metrics["min_temperature_°C"], (
-        f"Expected min temp {expected_metrics['min_temperature_°C']}, got {min(temps)}"
+def test_min_temperature(stats, expected_metrics):
+    minimum = stats["fields"]["temperature_°C"]["min"]
+    assert minimum == expected_metrics["min_temperature_°C"], (
+        f"Expected min temp {expected_metrics['min_temperature_°C']}, got {minimum}"
     )
 
 
-def test_max_temperature(migrated_docs, expected_metrics):
-    temps = [doc["temperature_°C"] for doc in migrated_docs if "temperature_°C" in doc]
-    assert max(temps) == expected_metrics["max_temperature_°C"], (
-        f"Expected max temp {expected_metrics['max_temperature_°C']}, got {max(temps)}"
+def test_max_temperature(stats, expected_metrics):
+    maximum = stats["fields"]["temperature_°C"]["max"]
+    assert maximum == expected_metrics["max_temperature_°C"], (
+        f"Expected max temp {expected_metrics['max_temperature_°C']}, got {maximum}"
     )
+
+
+def test_station_stats_are_consistent(stats):
+    assert sum(station["row_count"] for station in stats["stations"].values()) == stats["row_count"]
+    for station, station_stats in stats["stations"].items():
+        for field, field_stats in station_stats["fields"].items():
+            assert field_stats["count"] <= station_stats["row_count"], (station, field)
+            if field_stats["count"]:
+                assert field_stats["min"] <= field_stats["median"] <= field_stats["max"], (station, field)
+
+
+def test_station_stats_match_expected(stats, expected_metrics):
+    if "stations" not in expected_metrics:
+        pytest.skip("No per-station metrics in this expected metrics file")
+    assert set(stats["stations"]) == set(expected_metrics["stations"])
+    for station, fields in expected_metrics["stations"].items():
+        for field, expected in fields.items():
+            found = stats["stations"][station]["fields"][field]
+            assert found["count"] == expected["count"], (station, field)
+            if expected["count"]:
+                assert found["min"] == expected["min"] and found["max"] == expected["max"], (station, field)
+                assert found["mean"] == pytest.approx(expected["mean"]), (station, field)
+                assert median_within_sketch_error(found["median"], expected["sketch"], expected_metrics["rank_error"]), (
+                    station, field)
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import xlsx
+from cache import FrameCache
+from pipeline import Pipeline, Step
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "scripts", "data")
+
+
+class ListCollection:
+    def __init__(self):
+        self.documents = []
+        self.lock = threading.Lock()
+
+    def insert_many(self, documents, ordered=False):
+        with self.lock:
+            self.documents.extend(documents)
+
+        class Result:
+            inserted_ids = [document["_id"] for document in documents]
+        return Result()
+
+
+def test_every_item_goes_through_every_step():
+    steps = [Step("double", lambda x: 2 * x, workers=3), Step("increment", lambda x: x + 1)]
+    assert sorted(Pipeline(steps).run(range(20))) == [2 * x + 1 for x in range(20)]
+
+
+def test_steps_overlap():
+    def slow(x):
+        time.sleep(0.02)
+        return x
+
+    start = time.perf_counter()
+    Pipeline([Step("download", slow), Step("transform", slow), Step("insert", slow)]).run(range(10))
+    # 30 sequential sleeps would take 0.6s, the pipeline about 12 of them
+    assert time.perf_counter() - start < 0.45
+
+
+def test_bounded_queues_hold_back_the_producer():
+    produced = []
+    consumed = []
+    in_flight = []
+
+    def items():
+        for x in range(30):
+            produced.append(x)
+            in_flight.append(len(produced) - len(consumed))
+            yield x
+
+    def insert(x):
+        time.sleep(0.005)
+        consumed.append(x)
+        return x
+
+    Pipeline([Step("transform", lambda x: x), Step("insert", insert)], queue_size=1).run(items())
+    # One item in each queue and in the hands of each worker, one waiting in the feeder
+    assert max(in_flight) <= 5
+
+
+def test_first_error_stops_the_pipeline():
+    def insert(x):
+        if x == 3:
+            raise ValueError("bad chunk")
+        return x
+
+    with pytest.raises(ValueError, match="bad chunk"):
+        Pipeline([Step("transform", lambda x: x, workers=2), Step("insert", insert)], queue_size=1).run(range(1000))
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_pipelined_workbook_matches_the_sequential_one(processes, tmp_path, monkeypatch):
+    with open(os.path.join(DATA_DIR, "Weather+Underground+-+Ichtegem,+BE.xlsx"), "rb") as f:
+        content = f.read()
+    # Two days per run, so the runs can reach the cache out of order
+    monkeypatch.setattr(xlsx, "pipeline_sheets", 2)
+    collection = ListCollection()
+    cache = FrameCache(str(tmp_path))
+    with cache.writer("bucket", "key", "etag") as writer:
+        summary, accumulator, columns = xlsx.migrate_pipelined(content, collection, "Ichtegem", "tag",
+                                                               chunk_size=500, processes=processes,
+                                                               cache_writer=writer)
+
+    expected = xlsx.convert(xlsx.parse_workbook(content, processes=1), "Ichtegem")
+    frame, _ = cache.load("bucket", "key", "etag")
+    pd.testing.assert_frame_equal(frame, expected.reset_index(drop=True))
+    final = xlsx.add_ids(expected, "Ichtegem")
+    assert summary["inserted"] == accumulator.row_count == len(collection.documents) == 1899
+    assert {document["_id"] for document in collection.documents} == set(final["_id"])
+    assert columns == final.columns.tolist() + ["migrated"]
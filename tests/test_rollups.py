@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+import mongomock
+
+from rollups import daily_pipeline, day_ranges, hourly_pipeline, touched_days
+
+FIELDS = ["temperature_°C", "humidity_%"]
+
+
+def readings():
+    start = datetime(2024, 10, 1)
+    return [{"_id": i, "station": "Ichtegem", "datetime": start + timedelta(minutes=5 * i),
+             "temperature_°C": float(i % 12), "humidity_%": None if i % 3 else 80,
+             "migrated": "new" if i >= 288 else "old"} for i in range(3 * 288)]
+
+
+def test_day_ranges_merge_consecutive_days():
+    days = {"Bergues": [datetime(2024, 10, 3), datetime(2024, 10, 1), datetime(2024, 10, 2)],
+            "Ichtegem": [datetime(2024, 10, 1), datetime(2024, 10, 5)]}
+    assert day_ranges(days) == [
+        ("Bergues", datetime(2024, 10, 1), datetime(2024, 10, 4)),
+        ("Ichtegem", datetime(2024, 10, 1), datetime(2024, 10, 2)),
+        ("Ichtegem", datetime(2024, 10, 5), datetime(2024, 10, 6)),
+    ]
+
+
+def test_rollups_of_the_touched_days():
+    # mongomock has no $merge, the pipelines are run without it
+    db = mongomock.MongoClient().weather_data
+    db.weather_station.insert_many(readings())
+
+    ranges = day_ranges(touched_days(db.weather_station, "new"))
+    assert ranges == [("Ichtegem", datetime(2024, 10, 2), datetime(2024, 10, 4))]
+
+    hours = list(db.weather_station.aggregate(hourly_pipeline(FIELDS, ranges)[:-1]))
+    assert len(hours) == 48
+    first = next(hour for hour in hours if hour["start"] == datetime(2024, 10, 2))
+    assert first["_id"] == {"station": "Ichtegem", "period": "hour", "start": datetime(2024, 10, 2)}
+    assert first["count"] == 12
+    assert first["fields"]["temperature_°C"] == {"count": 12, "sum": 66.0, "min": 0.0, "max": 11.0}
+    assert first["fields"]["humidity_%"] == {"count": 4, "sum": 320, "min": 80, "max": 80}
+
+    db.weather_station_rollups.insert_many(hours)
+    days = list(db.weather_station_rollups.aggregate(daily_pipeline(FIELDS, ranges)[:-1]))
+    assert sorted(day["start"] for day in days) == [datetime(2024, 10, 2), datetime(2024, 10, 3)]
+    assert all(day["count"] == 288 and day["fields"]["temperature_°C"]["sum"] == 24 * 66.0 for day in days)
@@ -0,0 +1,107 @@
+import importlib.util
+import json
+import os
+import threading
+from argparse import Namespace
+
+import mongomock
+import pytest
+
+import jsonl
+import xlsx
+from common import bucket_name
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "scripts", "data")
+WORKBOOKS = {
+    "Ichtegem": "Weather+Underground+-+Ichtegem,+BE.xlsx",
+    "Madeleine": "Weather+Underground+-+La+Madeleine,+FR.xlsx",
+}
+
+spec = importlib.util.spec_from_file_location(
+    "migration_runner", os.path.join(os.path.dirname(__file__), "..", "migration", "__main__.py"))
+runner = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(runner)
+
+
+class FakeCollection:
+    def __init__(self):
+        self.documents = []
+        self.lock = threading.Lock()
+
+    def options(self):
+        return {}
+
+    def find(self, query, projection=None):
+        # The station and datetime range query of dedup.py
+        return [{"_id": document["_id"]} for document in self.documents
+                if document["station"] in query["station"]["$in"]
+                and query["datetime"]["$gte"] <= document["datetime"] <= query["datetime"]["$lte"]]
+
+    def count_documents(self, query):
+        return len(self.find(query))
+
+    def insert_many(self, documents, ordered=False):
+        with self.lock:
+            self.documents.extend(documents)
+
+        class Result:
+            inserted_ids = [document["_id"] for document in documents]
+        return Result()
+
+
+def airbyte_line():
+    data = {
+        "stations": [{"id": "07015", "name": "Lille-Lesquin"}],
+        "hourly": {
+            "07015": [{"id_station": "07015", "dh_utc": f"2024-10-01 0{hour}:00:00", "temperature": "12.5",
+                       "pression": "1015.2", "humidite": "80", "point_de_rosee": "9.1",
+                       "vent_moyen": "10.8"} for hour in range(5)],
+            "_params": ["temperature"],
+        },
+    }
+    return json.dumps({"_airbyte_data": data}).encode()
+
+
+@pytest.mark.parametrize("stream, pipeline, raw_bson", [(False, False, False), (True, False, True), (False, True, True)])
+def test_sources_share_clients_and_keep_their_tags(s3, monkeypatch, stream, pipeline, raw_bson):
+    objects = {xlsx.file_patterns[station].replace("*", ""): open(os.path.join(DATA_DIR, name), "rb").read()
+               for station, name in WORKBOOKS.items()}
+    objects[jsonl.file_patterns["InfoClimat"].replace("*", "2025_03_14_1741977939508_0")] = airbyte_line()
+    for key, body in objects.items():
+        s3.put_object(Bucket=bucket_name, Key=key, Body=body)
+    collection = FakeCollection()
+
+    metrics = {}
+    monkeypatch.setattr(xlsx, "write_metrics", lambda m, source: metrics.__setitem__(source, m))
+    monkeypatch.setattr(jsonl, "write_metrics", lambda m, source: metrics.__setitem__(source, m))
+    monkeypatch.setattr(runner, "weather_collection", lambda client: collection)
+    reports = {}
+    monkeypatch.setattr(runner, "write_report", lambda timer, prometheus: reports.__setitem__(timer.source, timer))
+
+    args = Namespace(sources=["Ichtegem", "Madeleine", "InfoClimat"], mongodb_address="mongodb://test",
+                     create_collection=False, stream=stream, batch_size=5000, chunk_size=1000, workers=2,
+                     mode="insert", since=None, until=None, latest=1, incremental=True, new_records_only=False,
+                     no_cache=True, cache_dir=None, cache_size_mb=0, excel_engine="auto", processes=1,
+                     pipeline=pipeline, raw_bson=raw_bson, no_dedup=False, resume=False, bulk_load=False, partial_indexes=False, no_rollups=True,
+                     trace_memory=False, profile=None, prometheus=False, quarantine="none")
+    client = mongomock.MongoClient()
+    summaries, failed = runner.run(args, s3, client)
+
+    assert failed == []
+    assert {source: summary["inserted"] for source, summary in summaries.items()} == {
+        "Ichtegem": 1899, "Madeleine": 1908, "InfoClimat": 5}
+    for source in args.sources:
+        tagged = [document for document in collection.documents if document["migrated"] == metrics[source]["migration_tag"]]
+        assert metrics[source]["migration_tag"].endswith(f"_{source}")
+        assert len(tagged) == metrics[source]["row_count"] == summaries[source]["documents"]
+    assert reports["Ichtegem"].stages["insert"]["rows_out"] == 1899
+    assert reports["Madeleine"].stages["download"]["bytes_in"] > 0
+    assert "stream" in reports["InfoClimat"].stages if stream else "parse" in reports["InfoClimat"].stages
+    assert ("pipeline" in reports["Madeleine"].stages) == pipeline
+
+    # Every object is now in the manifest, an incremental run has nothing to do
+    assert client["weather_data"]["migration_manifest"].count_documents({}) == 3
+    summaries, failed = runner.run(args, s3, client)
+    assert failed == []
+    assert all(summary["documents"] == 0 for summary in summaries.values())
+    assert len(collection.documents) == 1899 + 1908 + 5
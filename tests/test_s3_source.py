@@ -0,0 +1,75 @@
+from datetime import date
+
+import pytest
+
+from common import bucket_name
+from s3_source import download_objects, object_date, part_ranges, select_objects
+
+PREFIX = "greencoop-airbyte/InfoClimat/"
+
+
+def put(s3, key, body):
+    s3.put_object(Bucket=bucket_name, Key=key, Body=body)
+
+
+def test_part_ranges_cover_the_object():
+    assert part_ranges(10, 4) == [(0, 3), (4, 7), (8, 9)]
+    assert part_ranges(8, 4) == [(0, 3), (4, 7)]
+    assert part_ranges(0, 4) == []
+
+
+def test_select_objects_lists_every_page_and_filters(s3):
+    # More than one page of list_objects_v2
+    for day in range(1, 29):
+        for part in range(40):
+            put(s3, f"{PREFIX}2025_02_{day:02d}_1740000000000_{part}.jsonl", b"")
+    put(s3, f"{PREFIX}notes.txt", b"")
+    put(s3, "greencoop-airbyte/Ichtegem.xlsx", b"")
+
+    pattern = PREFIX + "*.jsonl"
+    assert len(select_objects(s3, pattern)) == 28 * 40
+
+    selected = select_objects(s3, pattern, since=date(2025, 2, 10), until=date(2025, 2, 11))
+    assert len(selected) == 80
+    assert {object_date(obj) for obj in selected} == {date(2025, 2, 10), date(2025, 2, 11)}
+
+    latest = select_objects(s3, pattern, latest=1)
+    assert [obj["Key"] for obj in latest] == [f"{PREFIX}2025_02_28_1740000000000_9.jsonl"]
+
+    assert select_objects(s3, "greencoop-airbyte/Ichtegem*.xlsx")[0]["Key"] == "greencoop-airbyte/Ichtegem.xlsx"
+
+
+@pytest.mark.parametrize("part_size", [100, 1 << 20])
+def test_download_objects_reassembles_ranged_parts(s3, part_size):
+    bodies = {f"{PREFIX}2025_03_{day:02d}_1741977939508_0.jsonl": bytes(range(256)) * day for day in range(1, 6)}
+    for key, body in bodies.items():
+        put(s3, key, body)
+    put(s3, f"{PREFIX}2025_03_06_1741977939508_0.jsonl", b"")
+
+    objects = select_objects(s3, PREFIX + "*.jsonl")
+    downloaded = list(download_objects(s3, objects, workers=4, part_size=part_size))
+
+    assert [obj["Key"] for obj, _ in downloaded] == [obj["Key"] for obj in objects]
+    for obj, content in downloaded:
+        assert bytes(content) == bodies.get(obj["Key"], b"")
+
+
+def test_download_objects_bounds_the_objects_in_flight(s3, monkeypatch):
+    import s3_source
+
+    for day in range(1, 9):
+        put(s3, f"{PREFIX}2025_03_{day:02d}_1741977939508_0.jsonl", bytes(range(256)) * day)
+    requested = []
+    get_range = s3_source.get_range
+
+    def recording(s3, bucket, key, *args):
+        requested.append(key)
+        return get_range(s3, bucket, key, *args)
+
+    monkeypatch.setattr(s3_source, "get_range", recording)
+    objects = select_objects(s3, PREFIX + "*.jsonl")
+    downloads = download_objects(s3, objects, part_size=100, ahead=2)
+    obj, _ = next(downloads)
+    # The first object and the two after it
+    assert set(requested) <= {other["Key"] for other in objects[:3]}
+    assert len(list(downloads)) == 7 and len(set(requested)) == 8
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+from bson import ObjectId, json_util
+
+from schema_check import SchemaCheck, bson_types, quarantine
+
+schema = {
+    "$jsonSchema": {
+        "bsonType": "object",
+        "required": ["_id", "station", "temperature_°C"],
+        "properties": {
+            "_id": {"bsonType": "objectId"},
+            "station": {"bsonType": "string"},
+            "temperature_°C": {"bsonType": ["int", "double"], "minimum": -60, "maximum": 60},
+            "wind_dir": {"bsonType": ["int", "double", "null"]},
+        },
+    }
+}
+
+
+def frame():
+    return pd.DataFrame({
+        "_id": [ObjectId() for _ in range(4)],
+        "station": ["Ichtegem", "Ichtegem", 7015, "Ichtegem"],
+        "temperature_°C": [12.5, np.nan, 11.0, 80.0],
+        "wind_dir": [180.0, np.nan, None, 90.0],
+    })
+
+
+def test_nan_is_a_double_in_xlsx_documents_and_null_in_jsonl_ones():
+    column = pd.Series([1.5, np.nan])
+    assert list(bson_types(column, nan_is_null=False)) == ["double", "double"]
+    assert list(bson_types(column, nan_is_null=True)) == ["double", "null"]
+
+
+def test_large_integers_are_longs():
+    assert list(bson_types(pd.Series([1, 2 ** 40]), False)) == ["int", "long"]
+    assert list(bson_types(pd.Series([1, 2 ** 40, "a"], dtype=object), False)) == ["int", "long", "string"]
+
+
+def test_split_gives_the_first_failed_rule_of_every_row():
+    valid, rejected, counts = SchemaCheck(schema).split(frame())
+    assert list(valid.index) == [0, 1]
+    assert list(rejected["quarantine_reason"]) == ["station: bsonType not in ['string']", "temperature_°C: above 60"]
+    assert counts == {"station: bsonType not in ['string']": 1, "temperature_°C: above 60": 1}
+
+
+def test_nan_temperature_only_fails_when_it_becomes_null():
+    df = frame().iloc[[1]]
+    assert SchemaCheck(schema, nan_is_null=False).validate(df)[0].all()
+    assert not SchemaCheck(schema, nan_is_null=True).validate(df)[0].any()
+
+
+def test_missing_required_column_rejects_every_row():
+    valid, reasons = SchemaCheck(schema).validate(frame().drop(columns="station"))
+    assert not valid.any()
+    assert set(reasons) == {"station: required"}
+
+
+def test_valid_frame_is_returned_as_is():
+    df = frame().iloc[[0]]
+    valid, rejected, counts = SchemaCheck(schema).split(df)
+    assert valid is df and rejected.empty and not counts
+
+
+def test_quarantine_appends_to_a_jsonl_file(tmp_path):
+    documents = [{"_id": ObjectId(), "station": 7015, "quarantine_reason": "station: bsonType not in ['string']"}]
+    quarantine(documents, str(tmp_path), "Ichtegem", "tag")
+    quarantine([dict(documents[0])], str(tmp_path), "Ichtegem", "tag")
+    lines = (tmp_path / "tag.jsonl").read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 2
+    stored = json_util.loads(lines[0])
+    assert stored["_id"] == documents[0]["_id"] and "quarantined_at" in stored
+
+
+def test_quarantine_without_target_keeps_nothing(tmp_path):
+    documents = [{"_id": ObjectId()}]
+    quarantine(documents, None, "Ichtegem", "tag")
+    assert "quarantined_at" not in documents[0]
@@ -0,0 +1,59 @@
+import json
+
+import jsonl
+
+
+def airbyte_line(day, hours):
+    data = {
+        "stations": [{"id": "07015", "name": "Lille-Lesquin"}],
+        "hourly": {"07015": [{"id_station": "07015", "dh_utc": f"2024-10-{day:02d} {hour:02d}:00:00",
+                              "temperature": str(10 + hour / 4), "pression": "1015.2", "humidite": "80",
+                              "point_de_rosee": "9.1", "vent_moyen": "10.8"} for hour in hours]},
+    }
+    return json.dumps({"_airbyte_emitted_at": 1741977939508 + day, "_airbyte_data": data}).encode()
+
+
+class RecordingCollection:
+    def __init__(self):
+        self.documents = []
+
+    def insert_many(self, documents, ordered=False):
+        self.documents.extend(documents)
+
+        class Result:
+            inserted_ids = [document["_id"] for document in documents]
+        return Result()
+
+
+def test_stream_holds_one_batch_of_a_multi_line_body(monkeypatch):
+    read = []
+
+    def body():
+        for day in range(1, 21):
+            read.append(day)
+            yield airbyte_line(day, range(24))
+
+    convert_records = jsonl.convert_records
+    batches = []
+
+    def recorded(records):
+        batches.append((len(records), len(read)))
+        return convert_records(records)
+
+    written = {}
+    monkeypatch.setattr(jsonl, "convert_records", recorded)
+    monkeypatch.setattr(jsonl, "write_metrics", lambda metrics, source: written.__setitem__(source, metrics))
+    collection = RecordingCollection()
+    summary = jsonl.migrate_stream([({"Key": "export.jsonl"}, body())], collection, "tag", "mongodb://test",
+                                   "InfoClimat", batch_size=5, chunk_size=5, workers=1)
+
+    assert summary["inserted"] == len(collection.documents) == 480
+    assert written["InfoClimat"]["row_count"] == 480
+    assert written["InfoClimat"]["fields"]["temperature_°C"]["count"] == 480
+    assert written["InfoClimat"]["max_temperature_°C"] == 10 + 23 / 4
+    # Every batch is converted as soon as its lines are read, the body is never read ahead
+    assert all(size <= 5 for size, _ in batches)
+    converted = 0
+    for size, lines in batches:
+        converted += size
+        assert lines == -(-converted // 24)
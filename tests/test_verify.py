@@ -0,0 +1,62 @@
+import math
+import statistics
+
+import mongomock
+import pytest
+
+from utils import MockServer
+from verify import migration_stats, numeric_fields
+
+
+def test_numeric_fields_come_from_the_schema():
+    fields = numeric_fields()
+    assert {"temperature_°C", "humidity_%", "pressure_hPa", "precip_rate_mm/hr (3hrs)"} <= set(fields)
+    assert "station" not in fields and "cloud_coverage" not in fields
+
+
+@pytest.mark.parametrize("count", [101, 100])
+def test_stats_match_python_per_station(count):
+    collection = mongomock.MongoClient().db.weather_station
+    documents = [
+        {"_id": i, "station": "Bergues" if i % 3 else "Lille-Lesquin", "migrated": "tag",
+         # NaN and missing values are not numbers
+         "temperature_°C": float(i % 17) - 3 if i % 10 else float("nan"), "humidity_%": i,
+         **({"uv_index": i / 2} if i % 4 else {})}
+        for i in range(count)
+    ]
+    collection.insert_many(documents + [{"_id": "other", "station": "Bergues", "migrated": "old", "humidity_%": 500}])
+
+    stats = migration_stats(MockServer(collection), "tag", ["temperature_°C", "humidity_%", "uv_index"])
+
+    assert stats["row_count"] == count
+    for station in ["Bergues", "Lille-Lesquin", None]:
+        selected = [document for document in documents if station is None or document["station"] == station]
+        result = stats["fields"] if station is None else stats["stations"][station]["fields"]
+        for field in ["temperature_°C", "humidity_%", "uv_index"]:
+            values = [document[field] for document in selected if field in document and not math.isnan(document[field])]
+            assert result[field]["count"] == len(values)
+            assert result[field]["min"] == min(values)
+            assert result[field]["max"] == max(values)
+            assert result[field]["median"] == statistics.median(values)
+            assert result[field]["mean"] == pytest.approx(statistics.mean(values))
+
+
+def test_medians_without_median_operator_come_from_the_same_aggregation():
+    collection = mongomock.MongoClient().db.weather_station
+    collection.insert_many([{"_id": i, "station": "Bergues", "migrated": "tag", "humidity_%": i} for i in range(10)])
+    server = MockServer(collection)
+    pipelines = []
+    aggregate = server.aggregate
+
+    def recorded(pipeline, **kwargs):
+        pipelines.append(pipeline)
+        return aggregate(pipeline, **kwargs)
+
+    server.aggregate = recorded
+    # No query besides the aggregation
+    server.find = None
+    stats = migration_stats(server, "tag", ["humidity_%"])
+    # The first one is refused ($median), the second one returns everything
+    assert len(pipelines) == 2
+    assert stats["fields"]["humidity_%"]["median"] == 4.5
+    assert stats["stations"]["Bergues"]["fields"]["humidity_%"]["median"] == 4.5
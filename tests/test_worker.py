@@ -0,0 +1,157 @@
+import json
+import os
+import time
+from datetime import timedelta
+
+import mongomock
+import pytest
+
+import jsonl
+import worker
+from common import bucket_name
+from worker import Heartbeat, claim, complete, plan_job, run_worker, utc_now
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "scripts", "data")
+PREFIX = jsonl.file_patterns["InfoClimat"].replace("*.jsonl", "")
+SOURCES = {"Ichtegem": "xlsx", "InfoClimat": "jsonl"}
+
+
+def airbyte_line(day, hours):
+    data = {
+        "stations": [{"id": "07015", "name": "Lille-Lesquin"}],
+        "hourly": {"07015": [{"id_station": "07015", "dh_utc": f"2024-10-{day:02d} {hour:02d}:00:00",
+                              "temperature": "12.5", "pression": "1015.2", "humidite": "80",
+                              "point_de_rosee": "9.1", "vent_moyen": "10.8"} for hour in hours]},
+    }
+    return json.dumps({"_airbyte_emitted_at": 1741977939508, "_airbyte_data": data})
+
+
+@pytest.fixture
+def client(s3, monkeypatch):
+    monkeypatch.setattr(worker, "poll_seconds", 0.01)
+    with open(os.path.join(DATA_DIR, "Weather+Underground+-+Ichtegem,+BE.xlsx"), "rb") as f:
+        s3.put_object(Bucket=bucket_name, Key="greencoop-airbyte/Ichtegem.xlsx", Body=f.read())
+    for day, hours in [(1, range(24)), (2, range(12)), (3, range(6))]:
+        s3.put_object(Bucket=bucket_name, Key=f"{PREFIX}2025_03_1{day}_174197793950{day}_0.jsonl",
+                      Body=airbyte_line(day, hours))
+    return mongomock.MongoClient()
+
+
+def plan(client, s3, sources=SOURCES):
+    return plan_job(worker.work_collection(client), worker.job_collection(client), s3, sources, latest=0)
+
+
+def test_claims_are_exclusive_and_expired_leases_are_taken_over(client, s3):
+    job_id = plan(client, s3, {"InfoClimat": "jsonl"})
+    work = worker.work_collection(client)
+    first = claim(work, job_id, "a")
+    second = claim(work, job_id, "b")
+    third = claim(work, job_id, "c")
+    assert first["size"] > second["size"] > third["size"]
+    assert claim(work, job_id, "d") is None
+
+    # Worker a stops sending heartbeats
+    work.update_one({"_id": first["_id"]}, {"$set": {"lease_expires": utc_now() - timedelta(seconds=1)}})
+    taken = claim(work, job_id, "d")
+    assert taken["_id"] == first["_id"] and taken["owner"] == "d" and taken["attempts"] == 2
+    complete(work, first, "a", {}, {}, {})
+    assert work.find_one({"_id": first["_id"]})["state"] == "running"
+
+
+def test_heartbeat_extends_the_lease_until_it_is_lost(client, s3):
+    job_id = plan(client, s3, {"InfoClimat": "jsonl"})
+    work = worker.work_collection(client)
+    unit = claim(work, job_id, "a", lease=1)
+    with Heartbeat(work, unit, "a", lease=60, interval=0.01) as heartbeat:
+        time.sleep(0.1)
+        assert work.find_one({"_id": unit["_id"]})["lease_expires"] > utc_now() + timedelta(seconds=30)
+        work.update_one({"_id": unit["_id"]}, {"$set": {"owner": "b"}})
+        time.sleep(0.1)
+    assert heartbeat.lost
+
+
+def test_workers_finish_the_job_of_a_crashed_one(client, s3, monkeypatch):
+    job_id = plan(client, s3)
+    work = worker.work_collection(client)
+    # A worker dies with a unit in hand
+    dead = claim(work, job_id, "dead")
+    work.update_one({"_id": dead["_id"]}, {"$set": {"lease_expires": utc_now() - timedelta(seconds=1)}})
+    written = {}
+    monkeypatch.setattr(worker, "write_metrics", lambda metrics, source: written.__setitem__(source, metrics))
+
+    collection = client.weather_data.weather_station
+    job = run_worker(client, s3, collection, "mongodb://test", job_id, client.weather_data.migration_manifest)
+    assert job["state"] == "done" and job["failed_units"] == []
+    assert set(written) == set(SOURCES)
+    assert written["InfoClimat"]["row_count"] == 42
+    assert written["InfoClimat"]["fields"]["temperature_°C"]["count"] == 42
+    assert written["Ichtegem"]["row_count"] == 1899
+    for source, info in job["sources"].items():
+        assert collection.count_documents({"migrated": info["migration_tag"]}) == written[source]["row_count"]
+    assert client.weather_data.migration_manifest.count_documents({}) == 4
+
+
+def test_retried_unit_counts_the_documents_of_its_lost_attempt(client, s3, monkeypatch):
+    job_id = plan(client, s3, {"InfoClimat": "jsonl"})
+    work = worker.work_collection(client)
+    collection = client.weather_data.weather_station
+    # A worker inserts the documents of its unit and dies before completing it
+    dead = claim(work, job_id, "dead")
+    worker.process_unit(dead, s3, collection, "mongodb://test")
+    assert collection.count_documents({}) == 24
+    work.update_one({"_id": dead["_id"]}, {"$set": {"lease_expires": utc_now() - timedelta(seconds=1)}})
+    written = {}
+    monkeypatch.setattr(worker, "write_metrics", lambda metrics, source: written.__setitem__(source, metrics))
+
+    job = run_worker(client, s3, collection, "mongodb://test", job_id)
+    assert job["state"] == "done"
+    assert written["InfoClimat"]["row_count"] == 42
+    assert collection.count_documents({"migrated": job["sources"]["InfoClimat"]["migration_tag"]}) == 42
+    retried = work.find_one({"_id": dead["_id"]})
+    assert retried["attempts"] == 2 and retried["summary"]["duplicate"] == 24
+
+
+def test_readings_shared_by_units_are_counted_once(s3, monkeypatch):
+    monkeypatch.setattr(worker, "poll_seconds", 0.01)
+    # The second export repeats the afternoon of the first one
+    s3.put_object(Bucket=bucket_name, Key=f"{PREFIX}2025_03_11_1741977939501_0.jsonl", Body=airbyte_line(1, range(24)))
+    s3.put_object(Bucket=bucket_name, Key=f"{PREFIX}2025_03_12_1741977939502_0.jsonl",
+                  Body="\n".join([airbyte_line(1, range(12, 24)), airbyte_line(2, range(24))]))
+    client = mongomock.MongoClient()
+    job_id = plan(client, s3, {"InfoClimat": "jsonl"})
+    work = worker.work_collection(client)
+    collection = client.weather_data.weather_station
+    # The second export is migrated, then the first one by a worker that dies before completing it
+    second = claim(work, job_id, "b")
+    complete(work, second, "b", *worker.process_unit(second, s3, collection, "mongodb://test"))
+    dead = claim(work, job_id, "dead")
+    worker.process_unit(dead, s3, collection, "mongodb://test")
+    work.update_one({"_id": dead["_id"]}, {"$set": {"lease_expires": utc_now() - timedelta(seconds=1)}})
+    written = {}
+    monkeypatch.setattr(worker, "write_metrics", lambda metrics, source: written.__setitem__(source, metrics))
+
+    job = run_worker(client, s3, collection, "mongodb://test", job_id)
+    assert job["state"] == "done"
+    assert collection.count_documents({"migrated": job["sources"]["InfoClimat"]["migration_tag"]}) == 48
+    assert written["InfoClimat"]["row_count"] == 48
+    assert written["InfoClimat"]["fields"]["temperature_°C"]["count"] == 48
+    retried = work.find_one({"_id": dead["_id"]})
+    assert retried["summary"]["skipped_other_unit"] == 12 and retried["summary"]["duplicate"] == 12
+    assert worker.claim_collection(client).count_documents({}) == 0
+
+
+def test_a_unit_failing_every_attempt_fails_the_job(client, s3, monkeypatch):
+    job_id = plan(client, s3)
+    process_unit = worker.process_unit
+
+    def flaky(unit, *args, **kwargs):
+        if unit["kind"] == "jsonl" and unit["key"].endswith("2_0.jsonl"):
+            raise ConnectionError("S3 unreachable")
+        return process_unit(unit, *args, **kwargs)
+
+    monkeypatch.setattr(worker, "process_unit", flaky)
+    monkeypatch.setattr(worker, "write_metrics", lambda metrics, source: None)
+    job = run_worker(client, s3, client.weather_data.weather_station, "mongodb://test", job_id)
+    assert job["state"] == "failed" and len(job["failed_units"]) == 1
+    assert worker.work_collection(client).find_one({"state": "failed"})["attempts"] == worker.max_attempts
+    assert list(job["metrics"]) == ["Ichtegem"]
@@ -0,0 +1,98 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from xlsx import clean_column, column_mapping, dir_to_angle, transform
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "scripts", "data")
+WORKBOOKS = {
+    "Ichtegem": "Weather+Underground+-+Ichtegem,+BE.xlsx",
+    "Madeleine": "Weather+Underground+-+La+Madeleine,+FR.xlsx",
+}
+
+
+def clean_value(value):
+    """
+    Per-cell cleaning used by xlsx.py before the column operations, kept as the reference.
+    """
+    if isinstance(value, str):
+        match = re.search(r"[-+]?\d*\.?\d+", value)
+        return float(match.group()) if match else None
+    return value
+
+
+def legacy_sheets(excel_file):
+    """
+    Per-sheet reading, cleaning and datetime parsing of xlsx.py before the column operations.
+    """
+    dfs = []
+    for sheet_name in excel_file.sheet_names:
+        df = excel_file.parse(sheet_name, na_values=["", "None", "NA", "NaN"])
+        df.rename(columns=column_mapping, inplace=True)
+        for col in df.columns:
+            if col not in ["time", "wind_dir"]:
+                df[col] = df[col].apply(clean_value)
+        df = df.dropna(how='all')
+        df.insert(0, "date", pd.to_datetime(sheet_name, format="%d%m%y"))
+        df["time"] = pd.to_datetime(df["time"], format="%H:%M:%S").dt.time
+        df["datetime"] = pd.to_datetime(df["date"].astype(str) + " " + df["time"].astype(str))
+        df = df.drop(columns=["date", "time"])
+        df = df[["datetime"] + [col for col in df.columns if col != "datetime"]]
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+
+@pytest.mark.parametrize("column", [
+    pd.Series(["56.8 °F", np.nan, "abc", "-3 in", None], dtype=object),
+    pd.Series(["1.5 w/m²", 3, np.nan, 2.5], dtype=object),
+    pd.Series(["+.5", "1.2.3", "--4"], dtype=object),
+    pd.Series(["calm", "n/a"], dtype=object),
+    pd.Series([np.nan, np.nan], dtype=object),
+    pd.Series([1.0, np.nan]),
+])
+def test_clean_column_matches_clean_value(column):
+    pd.testing.assert_series_equal(clean_column(column), column.apply(clean_value))
+
+
+@pytest.mark.parametrize("station", WORKBOOKS)
+def test_transform_is_identical_to_per_sheet_cleaning(station, monkeypatch):
+    import xlsx
+
+    path = os.path.join(DATA_DIR, WORKBOOKS[station])
+    legacy_final_df = legacy_sheets(pd.ExcelFile(path, engine="openpyxl"))
+    # Run the rest of transform() on the legacy frame to get the reference final_df2
+    monkeypatch.setattr(xlsx, "clean_sheets", lambda raw_df, dates: legacy_final_df)
+    expected = transform(pd.ExcelFile(path, engine="openpyxl"), station)
+    monkeypatch.undo()
+
+    result = transform(pd.ExcelFile(path, engine="openpyxl"), station)
+
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
+    for col in result.columns:
+        if result[col].dtype.kind == "f":
+            assert result[col].to_numpy().tobytes() == expected[col].to_numpy().tobytes(), col
+
+    expected_wind = legacy_final_df["wind_dir"].map(dir_to_angle)
+    assert result["wind_dir"].to_numpy().tobytes() == expected_wind.to_numpy().tobytes()
+
+
+@pytest.mark.parametrize("engine", ["openpyxl", "calamine"])
+@pytest.mark.parametrize("processes", [1, 3])
+@pytest.mark.parametrize("station", WORKBOOKS)
+def test_parse_workbook_matches_sequential_parsing(station, processes, engine, monkeypatch):
+    import xlsx
+
+    if engine == "calamine":
+        pytest.importorskip("python_calamine")
+    monkeypatch.setattr(xlsx, "parallel_sheets_threshold", 0)
+    path = os.path.join(DATA_DIR, WORKBOOKS[station])
+    with open(path, "rb") as workbook:
+        content = workbook.read()
+
+    expected = xlsx.normalize(pd.ExcelFile(path, engine="openpyxl"), station)
+    result = xlsx.convert(xlsx.parse_workbook(content, engine, processes), station)
+
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
@@ -1,5 +1,7 @@
 import json
 
+from pymongo import errors
+
 def load_expected_metrics(metrics_file: str):
     """
     Load the expected migration metrics from a JSON file.
@@ -18,3 +20,22 @@ def load_expected_metrics(metrics_file: str):
         raise ValueError(f"Missing 'mongodb_address' in {metrics_file}")
 
     return metrics
+
+
+class MockServer:
+    """
+    mongomock collection answering like a MongoDB server without $median, so verify falls back to sorted arrays.
+    Used by the tests and the benchmarks.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def aggregate(self, pipeline, **kwargs):
+        try:
+            return self.collection.aggregate(pipeline, **kwargs)
+        except NotImplementedError as e:
+            raise errors.OperationFailure(str(e), code=15952)
+
+    def find(self, *args, **kwargs):
+        return self.collection.find(*args, **kwargs)